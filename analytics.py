@@ -0,0 +1,263 @@
+"""
+Pre-aggregated prescribing and dispensing analytics.
+
+One rollup document per hour and one per day:
+
+    analytics_hourly/2024-05-01T13, analytics_daily/2024-05-01: {
+        'start': datetime(2024, 5, 1, 13),
+        'totals':    {'prescribed': 4, 'dispensed': 3, 'tablets': 7},
+        'medicines': {medicine_id: {'prescribed': 2, 'dispensed': 1, 'tablets': 3}, ...},
+        'doctors':   {uid: {...}, ...},              # by prescribing doctor
+        'devices':   {device_id: {'dispensed': 1, 'tablets': 3}, ...},
+        'assistants': {uid: {...}, ...}              # by the patient's assistant
+    }
+
+A prescription counts as prescribed in the hour it was written and as
+dispensed in the hour it was dispensed, in the clinic's local time like
+stats.today_key(). The counters are adjusted with Increment in the same
+batch or transaction as the write they describe, so reports read one
+document per bucket instead of scanning prescriptions.
+"""
+
+from datetime import datetime, timedelta, timezone
+
+from firebase_admin import firestore
+
+HOURLY_COLLECTION = 'analytics_hourly'
+DAILY_COLLECTION = 'analytics_daily'
+
+HOUR = 'hour'
+DAY = 'day'
+GRANULARITIES = {HOUR: HOURLY_COLLECTION, DAY: DAILY_COLLECTION}
+
+DIMENSIONS = ('medicines', 'doctors', 'devices', 'assistants')
+COUNTERS = ('prescribed', 'dispensed', 'tablets')
+
+# Longest range one report may cover
+MAX_BUCKETS = {HOUR: 24 * 31, DAY: 366}
+
+
+def wall_clock(when):
+    """Local wall-clock time of when, as a plain datetime without tzinfo.
+
+    Naive datetimes written by the app come back from Firestore as UTC
+    with the same wall-clock reading; both map to the same bucket. The
+    result is rebuilt rather than replace()d, because a copied
+    DatetimeWithNanoseconds read from Firestore cannot be written back.
+    """
+    return datetime(when.year, when.month, when.day, when.hour, when.minute, when.second, when.microsecond)
+
+
+def bucket_key(granularity, when):
+    when = wall_clock(when)
+    return when.strftime('%Y-%m-%dT%H') if granularity == HOUR else when.strftime('%Y-%m-%d')
+
+
+def bucket_start(granularity, when):
+    when = wall_clock(when)
+    if granularity == HOUR:
+        return when.replace(minute=0, second=0, microsecond=0)
+    return when.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def parse_bucket(granularity, key):
+    """datetime for a bucket key; raises ValueError if malformed"""
+    return datetime.strptime(key, '%Y-%m-%dT%H' if granularity == HOUR else '%Y-%m-%d')
+
+
+def tablet_count(quantity):
+    """Tablets in a dispense; the dispense form's quantity defaults to 1"""
+    try:
+        return max(0, int(quantity))
+    except (TypeError, ValueError):
+        return 1
+
+
+def _record(writer, db, when, counts, members):
+    """Add Increment()s of counts to the hourly and daily rollups of when"""
+    increments = {name: firestore.Increment(value) for name, value in counts.items()}
+    update = {'totals': increments}
+    for dimension, member in members.items():
+        if member:
+            update[dimension] = {member: increments}
+    for granularity, collection in GRANULARITIES.items():
+        ref = db.collection(collection).document(bucket_key(granularity, when))
+        writer.set(ref, dict(update, start=bucket_start(granularity, when)), merge=True)
+
+
+def record_prescribed(writer, db, prescription, assistant_id=None):
+    """Add the rollup updates for a new prescription to a batch or transaction"""
+    _record(writer, db, prescription.get('prescribed_at') or datetime.now(), {'prescribed': 1}, {
+        'medicines': prescription.get('medicine_id'),
+        'doctors': prescription.get('prescribed_by'),
+        'assistants': assistant_id or prescription.get('assistant_id')
+    })
+
+
+def record_dispensed(writer, db, prescription, dispensed_at=None, quantity=None, device_id=None, assistant_id=None):
+    """Add the rollup updates for a dispensed prescription to a batch or transaction"""
+    _record(writer, db, dispensed_at or datetime.now(), {'dispensed': 1, 'tablets': tablet_count(quantity)}, {
+        'medicines': prescription.get('medicine_id'),
+        'doctors': prescription.get('prescribed_by'),
+        'devices': device_id,
+        'assistants': assistant_id or prescription.get('assistant_id')
+    })
+
+
+def bucket_keys(granularity, start, end):
+    """Keys of every bucket from start to end inclusive, oldest first.
+
+    Raises ValueError when end is before start or the range is too long.
+    """
+    step = timedelta(hours=1) if granularity == HOUR else timedelta(days=1)
+    current, end = bucket_start(granularity, start), bucket_start(granularity, end)
+    if end < current:
+        raise ValueError('end is before start')
+    if (end - current) // step >= MAX_BUCKETS[granularity]:
+        raise ValueError(f'At most {MAX_BUCKETS[granularity]} {granularity}s per report')
+    keys = []
+    while current <= end:
+        keys.append(bucket_key(granularity, current))
+        current += step
+    return keys
+
+
+def load_rollups(db, granularity, keys):
+    """Rollup dicts for the bucket keys in one batched read; missing buckets are empty"""
+    collection = db.collection(GRANULARITIES[granularity])
+    found = {doc.id: doc.to_dict() for doc in db.get_all([collection.document(key) for key in keys])
+             if doc.exists}
+    return [(key, found.get(key, {})) for key in keys]
+
+
+def _add(target, counts):
+    for name in COUNTERS:
+        target[name] = target.get(name, 0) + counts.get(name, 0)
+
+
+def report(rollups, dimension=None, member=None):
+    """Summarize loaded rollups.
+
+    Returns {'totals', 'series', 'breakdown'}: totals over the range, one
+    entry per bucket, and (for a dimension) per-member totals, most tablets
+    first. With a member, totals and series count only that member.
+    """
+    totals = dict.fromkeys(COUNTERS, 0)
+    series = []
+    breakdown = {}
+    for key, rollup in rollups:
+        members = rollup.get(dimension, {}) if dimension else {}
+        counts = members.get(member, {}) if member else rollup.get('totals', {})
+        entry = dict.fromkeys(COUNTERS, 0)
+        _add(entry, counts)
+        _add(totals, counts)
+        series.append(dict(entry, bucket=key))
+        if dimension and not member:
+            for member_id, member_counts in members.items():
+                _add(breakdown.setdefault(member_id, {'id': member_id}), member_counts)
+    ranked = sorted(breakdown.values(), key=lambda entry: (-entry['tablets'], -entry['dispensed'],
+                                                           -entry['prescribed'], entry['id']))
+    return {'totals': totals, 'series': series, 'breakdown': ranked}
+
+
+def rebuild_rollups(db, chunk_size=5000):
+    """Recompute every rollup from the prescriptions, replacing the existing ones.
+
+    Prescriptions are streamed in chunks; each chunk becomes NumPy columns
+    (hour, member code, counters) reduced to per-(hour, member) sums, so
+    memory grows with the number of busy hours rather than prescriptions.
+    Writes made while this runs may be lost, as with
+    stats.rebuild_summaries(). Returns the number of rollup documents written.
+    """
+    import numpy as np
+
+    codes = {dimension: {} for dimension in DIMENSIONS}
+    partials = {dimension: [] for dimension in ('totals',) + DIMENSIONS}
+
+    def hour_number(when):
+        return int(wall_clock(when).replace(tzinfo=timezone.utc).timestamp()) // 3600
+
+    def code(dimension, value):
+        if not value:
+            return -1
+        return codes[dimension].setdefault(value, len(codes[dimension]))
+
+    def reduce(keys, values):
+        # values: one row per counter; returns unique keys and per-key sums
+        unique, inverse = np.unique(keys, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        return unique, np.stack([np.bincount(inverse, weights=row, minlength=len(unique)) for row in values])
+
+    def flush(rows):
+        if not rows:
+            return
+        columns = np.array(rows, dtype=np.int64).T
+        hours, counters, members = columns[0], columns[1:4], columns[4:]
+        partials['totals'].append(reduce(hours << 32, counters))
+        for dimension, member_codes in zip(DIMENSIONS, members):
+            known = member_codes >= 0
+            partials[dimension].append(reduce((hours[known] << 32) | member_codes[known], counters[:, known]))
+
+    fields = ['medicine_id', 'prescribed_by', 'assistant_id', 'prescribed_at', 'status', 'dispensed_at',
+              'quantity_dispensed', 'device_id']
+    rows = []
+    for doc in db.collection_group('prescriptions').select(fields).stream():
+        prescription = doc.to_dict()
+        medicine = code('medicines', prescription.get('medicine_id'))
+        doctor = code('doctors', prescription.get('prescribed_by'))
+        assistant = code('assistants', prescription.get('assistant_id'))
+        if prescription.get('prescribed_at'):
+            rows.append((hour_number(prescription['prescribed_at']), 1, 0, 0, medicine, doctor, -1, assistant))
+        if prescription.get('status') == 'dispensed' and prescription.get('dispensed_at'):
+            rows.append((hour_number(prescription['dispensed_at']), 0, 1,
+                         tablet_count(prescription.get('quantity_dispensed')), medicine, doctor,
+                         code('devices', prescription.get('device_id')), assistant))
+        if len(rows) >= chunk_size:
+            flush(rows)
+            rows = []
+    flush(rows)
+
+    names = {dimension: {number: value for value, number in codes[dimension].items()} for dimension in DIMENSIONS}
+    documents = {HOUR: {}, DAY: {}}
+    for dimension, chunks in partials.items():
+        if not chunks:
+            continue
+        hourly = reduce(np.concatenate([keys for keys, _ in chunks]),
+                        np.concatenate([sums for _, sums in chunks], axis=1))
+        # Days are whole multiples of the local-time hours
+        daily = reduce(((hourly[0] >> 32) // 24 * 24) << 32 | (hourly[0] & 0xFFFFFFFF), hourly[1])
+        for granularity, (keys, sums) in ((HOUR, hourly), (DAY, daily)):
+            for key, counts in zip(keys.tolist(), sums.T.tolist()):
+                start = datetime.fromtimestamp((key >> 32) * 3600, timezone.utc).replace(tzinfo=None)
+                document = documents[granularity].setdefault(bucket_key(granularity, start), {'start': start})
+                # Only non-zero counters, as the incremental updates write them
+                values = {name: int(value) for name, value in zip(COUNTERS, counts) if value}
+                if dimension == 'totals':
+                    document['totals'] = values
+                else:
+                    document.setdefault(dimension, {})[names[dimension][key & 0xFFFFFFFF]] = values
+
+    writes = []
+    for granularity, collection_name in GRANULARITIES.items():
+        collection = db.collection(collection_name)
+        writes += [(collection.document(key), document) for key, document in documents[granularity].items()]
+        # Buckets left with no activity at all are removed
+        writes += [(doc.reference, None) for doc in collection.select([]).stream()
+                   if doc.id not in documents[granularity]]
+
+    batch = db.batch()
+    pending = 0
+    for ref, document in writes:
+        if document is None:
+            batch.delete(ref)
+        else:
+            batch.set(ref, document)
+        pending += 1
+        # Firestore caps a write batch at 500 operations
+        if pending == 500:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+    if pending:
+        batch.commit()
+    return sum(len(documents[granularity]) for granularity in GRANULARITIES)
@@ -1,512 +1,1173 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
-import firebase_admin
-from firebase_admin import credentials, firestore, auth
-import os
-from datetime import datetime
-import requests
-from functools import wraps
-
-app = Flask(__name__)
-app.secret_key = os.environ.get('SECRET_KEY', 'your-secret-key-change-this')
-
-# Initialize Firebase Admin SDK
-def initialize_firebase():
-    global db
-    try:
-        # Check if we're in production (Render) or development
-        if os.environ.get('FIREBASE_PROJECT_ID'):
-            # Production: Use environment variables
-            print("Initializing Firebase with environment variables...")
-            
-            # Validate required environment variables
-            required_vars = ['FIREBASE_PROJECT_ID', 'FIREBASE_PRIVATE_KEY_ID', 'FIREBASE_PRIVATE_KEY', 'FIREBASE_CLIENT_EMAIL', 'FIREBASE_CLIENT_ID']
-            missing_vars = [var for var in required_vars if not os.environ.get(var)]
-            
-            if missing_vars:
-                print(f"Missing environment variables: {missing_vars}")
-                return False
-            
-            firebase_config = {
-                "type": "service_account",
-                "project_id": os.environ.get('FIREBASE_PROJECT_ID'),
-                "private_key_id": os.environ.get('FIREBASE_PRIVATE_KEY_ID'),
-                "private_key": os.environ.get('FIREBASE_PRIVATE_KEY').replace('\\n', '\n'),
-                "client_email": os.environ.get('FIREBASE_CLIENT_EMAIL'),
-                "client_id": os.environ.get('FIREBASE_CLIENT_ID'),
-                "auth_uri": os.environ.get('FIREBASE_AUTH_URI', 'https://accounts.google.com/o/oauth2/auth'),
-                "token_uri": os.environ.get('FIREBASE_TOKEN_URI', 'https://oauth2.googleapis.com/token')
-            }
-            
-            print(f"Firebase Project ID: {firebase_config['project_id']}")
-            print(f"Firebase Client Email: {firebase_config['client_email']}")
-            
-            # Create credentials from environment variables
-            cred = credentials.Certificate(firebase_config)
-            print("Firebase credentials created successfully")
-        else:
-            # Development: Use local file
-            print("Initializing Firebase with local file...")
-            if not os.path.exists('firebase-service-account.json'):
-                print("ERROR: firebase-service-account.json not found!")
-                return False
-            cred = credentials.Certificate('firebase-service-account.json')
-            print("Firebase credentials loaded from local file")
-        
-        # Initialize Firebase app (check if already initialized)
-        try:
-            # Check if Firebase app is already initialized
-            firebase_admin.get_app()
-            print("Firebase app already initialized, using existing app")
-        except ValueError:
-            # No app exists, initialize new one
-            firebase_admin.initialize_app(cred)
-            print("Firebase Admin SDK initialized")
-        
-        # Test Firestore connection
-        db = firestore.client()
-        print("Firestore client created")
-        
-        # Test connection with a simple operation
-        test_doc = db.collection('test').document('connection_test')
-        test_doc.set({'test': True, 'timestamp': firestore.SERVER_TIMESTAMP})
-        test_doc.delete()
-        print("Firebase connection test successful")
-        
-        return True
-        
-    except Exception as e:
-        print(f"Firebase initialization error: {e}")
-        print(f"Error type: {type(e).__name__}")
-        import traceback
-        traceback.print_exc()
-        db = None
-        return False
-
-# Initialize Firebase
-print("Initializing Firebase...")
-firebase_initialized = initialize_firebase()
-
-if firebase_initialized:
-    print("✅ Firebase initialized successfully!")
-else:
-    print("❌ Firebase initialization failed. Please check your environment variables.")
-    print("Make sure all Firebase environment variables are set correctly in Render:")
-    print("- FIREBASE_PROJECT_ID")
-    print("- FIREBASE_PRIVATE_KEY_ID") 
-    print("- FIREBASE_PRIVATE_KEY")
-    print("- FIREBASE_CLIENT_EMAIL")
-    print("- FIREBASE_CLIENT_ID")
-    print("- FIREBASE_AUTH_URI")
-    print("- FIREBASE_TOKEN_URI")
-    db = None
-
-# NodeMCU configuration
-NODEMCU_IP = os.environ.get('NODEMCU_IP', '192.168.1.100')
-NODEMCU_PORT = int(os.environ.get('NODEMCU_PORT', 80))
-
-def login_required(f):
-    @wraps(f)
-    def decorated_function(*args, **kwargs):
-        if 'user_id' not in session:
-            return redirect(url_for('login'))
-        return f(*args, **kwargs)
-    return decorated_function
-
-def role_required(required_role):
-    def decorator(f):
-        @wraps(f)
-        def decorated_function(*args, **kwargs):
-            if 'user_role' not in session or session['user_role'] != required_role:
-                flash('Access denied. Insufficient permissions.', 'error')
-                return redirect(url_for('dashboard'))
-            return f(*args, **kwargs)
-        return decorated_function
-    return decorator
-
-@app.route('/')
-def index():
-    if 'user_id' in session:
-        return redirect(url_for('dashboard'))
-    return redirect(url_for('login'))
-
-@app.route('/register', methods=['GET', 'POST'])
-def register():
-    if request.method == 'POST':
-        email = request.form['email']
-        password = request.form['password']
-        role = request.form['role']
-        name = request.form['name']
-        
-        try:
-            # Create user in Firebase Auth
-            user = auth.create_user(
-                email=email,
-                password=password,
-                display_name=name
-            )
-            
-            # Store additional user data in Firestore
-            user_data = {
-                'uid': user.uid,
-                'email': email,
-                'name': name,
-                'role': role,
-                'created_at': datetime.now()
-            }
-            
-            db.collection('users').document(user.uid).set(user_data)
-            
-            flash('Registration successful! Please login.', 'success')
-            return redirect(url_for('login'))
-            
-        except Exception as e:
-            flash(f'Registration failed: {str(e)}', 'error')
-    
-    return render_template('register.html')
-
-@app.route('/login', methods=['GET', 'POST'])
-def login():
-    if request.method == 'POST':
-        email = request.form['email']
-        password = request.form['password']
-        
-        try:
-            # Verify user credentials
-            user = auth.get_user_by_email(email)
-            
-            # Get user data from Firestore
-            user_doc = db.collection('users').document(user.uid).get()
-            if user_doc.exists:
-                user_data = user_doc.to_dict()
-                
-                session['user_id'] = user.uid
-                session['user_email'] = email
-                session['user_name'] = user_data['name']
-                session['user_role'] = user_data['role']
-                
-                flash('Login successful!', 'success')
-                return redirect(url_for('dashboard'))
-            else:
-                flash('User data not found.', 'error')
-                
-        except Exception as e:
-            flash(f'Login failed: {str(e)}', 'error')
-    
-    return render_template('login.html')
-
-@app.route('/logout')
-def logout():
-    session.clear()
-    flash('Logged out successfully.', 'info')
-    return redirect(url_for('login'))
-
-@app.route('/dashboard')
-@login_required
-def dashboard():
-    user_role = session.get('user_role')
-    
-    if user_role == 'doctor':
-        # Get all patients for doctor view
-        patients = []
-        patients_ref = db.collection('patients')
-        for doc in patients_ref.stream():
-            patient_data = doc.to_dict()
-            patient_data['id'] = doc.id
-            patients.append(patient_data)
-    else:
-        # Get patients created by this assistant
-        patients = []
-        patients_ref = db.collection('patients').where('created_by', '==', session['user_id'])
-        for doc in patients_ref.stream():
-            patient_data = doc.to_dict()
-            patient_data['id'] = doc.id
-            patients.append(patient_data)
-    
-    return render_template('dashboard.html', patients=patients, user_role=user_role)
-
-@app.route('/add_patient', methods=['GET', 'POST'])
-@login_required
-@role_required('assistant')
-def add_patient():
-    if request.method == 'POST':
-        patient_data = {
-            'name': request.form['name'],
-            'age': int(request.form['age']),
-            'height': float(request.form['height']),
-            'weight': float(request.form['weight']),
-            'bp': request.form['bp'],
-            'temp': float(request.form['temp']),
-            'created_by': session['user_id'],
-            'created_at': datetime.now(),
-            'prescriptions': []
-        }
-        
-        try:
-            db.collection('patients').add(patient_data)
-            flash('Patient added successfully!', 'success')
-            return redirect(url_for('dashboard'))
-        except Exception as e:
-            flash(f'Error adding patient: {str(e)}', 'error')
-    
-    return render_template('add_patient.html')
-
-@app.route('/patient/<patient_id>')
-@login_required
-def patient_detail(patient_id):
-    try:
-        patient_doc = db.collection('patients').document(patient_id).get()
-        if patient_doc.exists:
-            patient_data = patient_doc.to_dict()
-            patient_data['id'] = patient_id
-            
-            # Get medicines for prescriptions
-            medicines = []
-            medicines_ref = db.collection('medicines')
-            for doc in medicines_ref.stream():
-                medicine_data = doc.to_dict()
-                medicine_data['id'] = doc.id
-                medicines.append(medicine_data)
-            
-            return render_template('patient_detail.html', patient=patient_data, medicines=medicines)
-        else:
-            flash('Patient not found.', 'error')
-            return redirect(url_for('dashboard'))
-    except Exception as e:
-        flash(f'Error loading patient: {str(e)}', 'error')
-        return redirect(url_for('dashboard'))
-
-@app.route('/add_medicine', methods=['GET', 'POST'])
-@login_required
-def add_medicine():
-    """Allow both doctors and assistants to add medicines"""
-    if request.method == 'POST':
-        medicine_data = {
-            'name': request.form['name'],
-            'description': request.form['description'],
-            'dosage': request.form['dosage'],
-            'frequency': request.form['frequency'],
-            'created_by': session['user_id'],
-            'created_at': datetime.now()
-        }
-        
-        try:
-            db.collection('medicines').add(medicine_data)
-            flash('Medicine added successfully!', 'success')
-            return redirect(url_for('list_medicines'))
-        except Exception as e:
-            flash(f'Error adding medicine: {str(e)}', 'error')
-    
-    return render_template('add_medicine.html')
-
-@app.route('/prescribe_medicine', methods=['POST'])
-@login_required
-@role_required('doctor')
-def prescribe_medicine():
-    patient_id = request.form['patient_id']
-    medicine_id = request.form['medicine_id']
-    notes = request.form.get('notes', '')
-    
-    try:
-        # Get medicine details
-        medicine_doc = db.collection('medicines').document(medicine_id).get()
-        if medicine_doc.exists:
-            medicine_data = medicine_doc.to_dict()
-            
-            # Create prescription
-            prescription = {
-                'medicine_id': medicine_id,
-                'medicine_name': medicine_data['name'],
-                'dosage': medicine_data['dosage'],
-                'frequency': medicine_data['frequency'],
-                'notes': notes,
-                'prescribed_by': session['user_id'],
-                'prescribed_at': datetime.now(),
-                'status': 'active'
-            }
-            
-            # Add prescription to patient
-            patient_ref = db.collection('patients').document(patient_id)
-            patient_doc = patient_ref.get()
-            
-            if patient_doc.exists:
-                patient_data = patient_doc.to_dict()
-                if 'prescriptions' not in patient_data:
-                    patient_data['prescriptions'] = []
-                
-                patient_data['prescriptions'].append(prescription)
-                patient_ref.update(patient_data)
-                
-                flash('Medicine prescribed successfully!', 'success')
-            else:
-                flash('Patient not found.', 'error')
-        else:
-            flash('Medicine not found.', 'error')
-            
-    except Exception as e:
-        flash(f'Error prescribing medicine: {str(e)}', 'error')
-    
-    return redirect(url_for('patient_detail', patient_id=patient_id))
-
-@app.route('/dispense_medicine', methods=['POST'])
-@login_required
-def dispense_medicine():
-    patient_id = request.form['patient_id']
-    prescription_index = int(request.form['prescription_index'])
-    
-    try:
-        # Get patient and prescription data
-        patient_ref = db.collection('patients').document(patient_id)
-        patient_doc = patient_ref.get()
-        
-        if patient_doc.exists:
-            patient_data = patient_doc.to_dict()
-            if 'prescriptions' in patient_data and prescription_index < len(patient_data['prescriptions']):
-                prescription = patient_data['prescriptions'][prescription_index]
-                
-                # Prepare prescription data for NodeMCU
-                prescription_data = {
-                    'action': 'dispense',
-                    'patient_name': patient_data['name'],
-                    'medicine_name': prescription['medicine_name'],
-                    'dosage': prescription['dosage'],
-                    'frequency': prescription['frequency'],
-                    'quantity': request.form.get('quantity', '1'),  # Default to 1 if not specified
-                    'notes': prescription.get('notes', ''),
-                    'dispensed_by': session['user_name'],
-                    'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                }
-                
-                # Send prescription data to NodeMCU
-                response = requests.post(f'http://{NODEMCU_IP}:{NODEMCU_PORT}/dispense', 
-                                       json=prescription_data, 
-                                       timeout=10)
-                
-                if response.status_code == 200:
-                    # Update prescription status
-                    patient_data['prescriptions'][prescription_index]['status'] = 'dispensed'
-                    patient_data['prescriptions'][prescription_index]['dispensed_at'] = datetime.now()
-                    patient_data['prescriptions'][prescription_index]['dispensed_by'] = session['user_name']
-                    patient_data['prescriptions'][prescription_index]['quantity_dispensed'] = prescription_data['quantity']
-                    patient_ref.update(patient_data)
-                    
-                    flash(f'Medicine "{prescription["medicine_name"]}" dispensed successfully!', 'success')
-                else:
-                    flash('Failed to communicate with dispensing device.', 'error')
-            else:
-                flash('Prescription not found.', 'error')
-        else:
-            flash('Patient not found.', 'error')
-            
-    except requests.exceptions.RequestException:
-        flash('Failed to connect to dispensing device. Please check NodeMCU connection.', 'error')
-    except Exception as e:
-        flash(f'Error dispensing medicine: {str(e)}', 'error')
-    
-    return redirect(url_for('patient_detail', patient_id=patient_id))
-
-@app.route('/send_prescriptions_to_nodmcu', methods=['POST'])
-@login_required
-def send_prescriptions_to_nodmcu():
-    """Send all patient prescriptions to NodeMCU"""
-    try:
-        data = request.get_json()
-        patient_name = data.get('patient_name')
-        patient_id = data.get('patient_id')
-        prescriptions = data.get('prescriptions', [])
-        
-        # Prepare comprehensive prescription data for NodeMCU
-        prescription_data = {
-            'action': 'send_prescriptions',
-            'patient_name': patient_name,
-            'patient_id': patient_id,
-            'total_prescriptions': len(prescriptions),
-            'prescriptions': prescriptions,
-            'sent_by': session['user_name'],
-            'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        }
-        
-        # Send to NodeMCU
-        response = requests.post(f'http://{NODEMCU_IP}:{NODEMCU_PORT}/prescriptions', 
-                               json=prescription_data, 
-                               timeout=10)
-        
-        if response.status_code == 200:
-            return jsonify({
-                'success': True,
-                'message': f'Successfully sent {len(prescriptions)} prescriptions to NodeMCU'
-            })
-        else:
-            return jsonify({
-                'success': False,
-                'error': 'Failed to communicate with NodeMCU'
-            }), 500
-            
-    except requests.exceptions.RequestException:
-        return jsonify({
-            'success': False,
-            'error': 'Failed to connect to NodeMCU'
-        }), 500
-    except Exception as e:
-        return jsonify({
-            'success': False,
-            'error': f'Error: {str(e)}'
-        }), 500
-
-@app.route('/medicines')
-@login_required
-def list_medicines():
-    """List all medicines in the database"""
-    try:
-        medicines = []
-        medicines_ref = db.collection('medicines').order_by('name')
-        for doc in medicines_ref.stream():
-            medicine_data = doc.to_dict()
-            medicine_data['id'] = doc.id
-            medicines.append(medicine_data)
-        
-        return render_template('medicines_list.html', medicines=medicines)
-    except Exception as e:
-        flash(f'Error loading medicines: {str(e)}', 'error')
-        return redirect(url_for('dashboard'))
-
-@app.route('/api/search_medicines')
-@login_required
-def search_medicines_api():
-    """API endpoint for real-time medicine search"""
-    try:
-        query = request.args.get('q', '').strip().lower()
-        
-        if len(query) < 1:
-            return jsonify({'medicines': []})
-        
-        medicines = []
-        medicines_ref = db.collection('medicines').order_by('name')
-        
-        for doc in medicines_ref.stream():
-            medicine_data = doc.to_dict()
-            medicine_name = medicine_data.get('name', '').lower()
-            
-            # Check if query matches medicine name (starts with or contains)
-            if medicine_name.startswith(query) or query in medicine_name:
-                medicine_data['id'] = doc.id
-                medicines.append({
-                    'id': doc.id,
-                    'name': medicine_data.get('name', ''),
-                    'dosage': medicine_data.get('dosage', ''),
-                    'frequency': medicine_data.get('frequency', ''),
-                    'description': medicine_data.get('description', '')
-                })
-        
-        # Limit results to 10 for performance
-        medicines = medicines[:10]
-        
-        return jsonify({'medicines': medicines})
-        
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
-
-if __name__ == '__main__':
-    import os
-    port = int(os.environ.get('PORT', 5000))
-    debug = os.environ.get('FLASK_ENV') == 'development'
-    app.run(debug=debug, host='0.0.0.0', port=port)
+from flask import (Flask, Response, render_template, request, redirect, url_for, flash, session, jsonify,
+                   stream_with_context)
+from firebase_admin import firestore, auth
+import asyncio
+import click
+import hmac
+import os
+import tempfile
+import threading
+import uuid
+from datetime import datetime, timedelta
+from functools import wraps
+from google.api_core.exceptions import NotFound
+from dispense_queue import DispenseError, DispenseQueue
+from medicine_catalog import MedicineCatalog
+from dispenser_fleet import DispenserFleet, NoDispenserAvailable
+from live_updates import LiveUpdates, timestamp_id
+from handwriting import (MAX_IMAGE_BYTES, HandwritingRecognizer, RecognizerUnavailable, UnreadableInput, parse_png,
+                         parse_strokes, rank_medicines)
+from firebase_client import check_firestore, db, get_firebase_app, run_async
+from nodemcu_client import DeviceBusy, DeviceUnavailable, NodeMCUError
+from prescriptions import (add_prescription_async, count_active_prescriptions, list_prescriptions_async,
+                           migrate_embedded_prescriptions, prescriptions_ref)
+from user_cache import UserProfileCache
+import analytics
+import bulk_io
+import idempotency
+import instrumentation
+import inventory
+import patient_query
+import stats
+import template_cache
+
+app = Flask(__name__)
+app.secret_key = os.environ.get('SECRET_KEY', 'your-secret-key-change-this')
+
+# Per-route latency, Server-Timing headers and the X-Profile profiler
+instrumentation.init_app(app, profile_token=os.environ.get('PROFILE_TOKEN'))
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# Jinja bytecode cache and {% cache %} fragments; templates compile at import,
+# so a preloaded gunicorn master forks workers with them already built
+fragment_cache = template_cache.init_app(
+    app,
+    bytecode_dir=os.environ.get('TEMPLATE_CACHE_DIR'),
+    max_fragments=int(os.environ.get('FRAGMENT_CACHE_SIZE', 2048))
+)
+
+# NodeMCU configuration
+NODEMCU_IP = os.environ.get('NODEMCU_IP', '192.168.1.100')
+NODEMCU_PORT = int(os.environ.get('NODEMCU_PORT', 80))
+
+# Registered dispensers (the `dispensers` collection), falling back to the
+# single NODEMCU_IP device when none are registered
+dispenser_fleet = DispenserFleet(
+    NODEMCU_IP, NODEMCU_PORT,
+    poll_interval=float(os.environ.get('DISPENSER_POLL_INTERVAL', 15)),
+    wait_timeout=float(os.environ.get('DISPENSER_WAIT_TIMEOUT', 60)),
+    # Capacity leases are shared by all worker processes through Firestore
+    lease_seconds=float(os.environ.get('DISPENSER_LEASE_SECONDS', 120)),
+    client_options={
+        'connect_timeout': float(os.environ.get('NODEMCU_CONNECT_TIMEOUT', 2)),
+        # Older firmware replies to /dispense only after the last tablet drops (~1.7 s each)
+        'read_timeout': float(os.environ.get('NODEMCU_READ_TIMEOUT', 30)),
+        'wire_format': os.environ.get('NODEMCU_WIRE_FORMAT', 'msgpack')
+    }
+)
+
+# In-memory medicine catalog backing the search API
+medicine_catalog = MedicineCatalog(ttl=int(os.environ.get('MEDICINE_CATALOG_TTL', 300)))
+
+# Prescription changes pushed to open pages over Server-Sent Events, from one
+# Firestore listener per process
+live_updates = LiveUpdates(
+    history_seconds=int(os.environ.get('LIVE_HISTORY_SECONDS', 300)),
+    # Each open stream holds a gunicorn thread until it is recycled
+    max_streams=int(os.environ.get('LIVE_MAX_STREAMS', 4)),
+    poll_interval=float(os.environ.get('LIVE_POLL_INTERVAL', 2)),
+    # The listener is replaced this often so its result set stays small
+    reanchor_seconds=float(os.environ.get('LIVE_REANCHOR_SECONDS', 600))
+)
+LIVE_STREAM_SECONDS = int(os.environ.get('LIVE_STREAM_SECONDS', 60))
+
+# Handwriting OCR in a process pool, batching concurrent requests
+handwriting_recognizer = HandwritingRecognizer(
+    workers=int(os.environ.get('HANDWRITING_WORKERS', 1)),
+    max_batch=int(os.environ.get('HANDWRITING_MAX_BATCH', 8)),
+    max_wait=float(os.environ.get('HANDWRITING_MAX_WAIT_MS', 20)) / 1000
+)
+
+# User profiles (name, role) for authenticated requests
+user_cache = UserProfileCache(
+    ttl=int(os.environ.get('USER_CACHE_TTL', 300)),
+    max_size=int(os.environ.get('USER_CACHE_SIZE', 1024))
+)
+user_cache.start(db)
+
+# Firebase web config used by the login page to sign in client-side
+FIREBASE_WEB_CONFIG = {
+    'apiKey': os.environ.get('FIREBASE_WEB_API_KEY'),
+    'authDomain': os.environ.get('FIREBASE_AUTH_DOMAIN') or
+                  f"{os.environ.get('FIREBASE_PROJECT_ID', '')}.firebaseapp.com",
+    'projectId': os.environ.get('FIREBASE_PROJECT_ID')
+}
+
+def send_dispense_to_device(prescription_data):
+    """Drive the NodeMCU dispenser; runs on the dispense worker thread"""
+    try:
+        device_id, result = dispenser_fleet.dispense(prescription_data)
+    except (NoDispenserAvailable, DeviceBusy) as e:
+        raise DispenseError(str(e))
+    except DeviceUnavailable:
+        raise DispenseError('Failed to connect to dispensing device. Please check NodeMCU connection.')
+    except NodeMCUError:
+        raise DispenseError('Failed to communicate with dispensing device.')
+    return device_id
+
+# Inventory totals for the reorder list, refreshed from the stock shards of
+# recently dispensed medicines
+stock_sync = inventory.StockSync(interval=float(os.environ.get('STOCK_SYNC_INTERVAL', 10)))
+
+# Background dispensing pipeline; requests only enqueue jobs, deduplicated
+# by the Idempotency-Key the browser sends
+dispense_queue = DispenseQueue(
+    dispatch=send_dispense_to_device,
+    on_dispensed=lambda payload: stock_sync.mark_dirty(payload.get('medicine_id')),
+    idempotency_keys=idempotency.IdempotencyKeys(ttl=int(os.environ.get('IDEMPOTENCY_KEY_TTL', 86400))),
+    # A job whose worker died is failed once this runs out
+    lease_seconds=int(os.environ.get('DISPENSE_LEASE_SECONDS', 300))
+)
+
+_services_lock = threading.Lock()
+_services_started = False
+
+def start_services():
+    """Start this process's background services (once).
+
+    They hold Firestore listeners and threads, which do not survive a fork,
+    so each worker process starts its own on its first request.
+    """
+    global _services_started
+    if _services_started:
+        return
+    with _services_lock:
+        if _services_started:
+            return
+        _services_started = True
+        
+        try:
+            dispenser_fleet.start(db)
+        except Exception as e:
+            print(f"Error starting dispenser fleet: {e}")
+        try:
+            medicine_catalog.start(db)
+        except Exception as e:
+            print(f"Error starting medicine catalog: {e}")
+        try:
+            # One worker per unit of fleet capacity keeps every device busy
+            dispense_queue.start(db, workers=dispenser_fleet.capacity)
+        except Exception as e:
+            print(f"Error starting dispense queue: {e}")
+        try:
+            live_updates.start(db)
+        except Exception as e:
+            print(f"Error starting live updates: {e}")
+        try:
+            stock_sync.start(db)
+        except Exception as e:
+            print(f"Error starting stock sync: {e}")
+
+def stop_services(timeout=30):
+    """Stop background services, letting in-flight dispenses finish"""
+    if not _services_started:
+        return
+    if not dispense_queue.stop(timeout):
+        print(f"Dispense workers still busy after {timeout}s; shutting down anyway")
+    live_updates.stop()
+    stock_sync.stop()
+    medicine_catalog.stop()
+    dispenser_fleet.stop()
+    handwriting_recognizer.stop()
+
+@app.before_request
+def ensure_services_started():
+    if request.endpoint not in ('healthz', 'metrics', 'static'):
+        start_services()
+
+def create_app():
+    """Application factory for WSGI servers (`gunicorn "app:create_app()"`).
+
+    Creating the app does not contact Firebase; the client and background
+    services are set up lazily in the process that serves requests.
+    """
+    return app
+
+def wants_json():
+    """True when the client asked for a JSON response (AJAX calls)"""
+    return request.accept_mimetypes.best_match(['application/json', 'text/html']) == 'application/json'
+
+def current_user():
+    """Profile of the logged-in user from the profile cache, or None.
+
+    Keeps the name and role stored in the session in step with Firestore,
+    so role changes apply without logging out.
+    """
+    if 'user_id' not in session:
+        return None
+    profile = user_cache.get(session['user_id'])
+    if profile is None:
+        return None
+    if session.get('user_role') != profile['role'] or session.get('user_name') != profile['name']:
+        session['user_role'] = profile['role']
+        session['user_name'] = profile['name']
+    return profile
+
+def render_conditional(template, etag_parts, **context):
+    """Render a page with an ETag, answering 304 when the client's copy is current.
+
+    etag_parts are the versions of the data the page shows; the templates and
+    the user's name and role (shown in the navigation bar) are added here.
+    Pages with pending flash messages are always rendered, or the messages
+    would be lost.
+    """
+    if session.get('_flashes'):
+        return render_template(template, **context)
+    etag = template_cache.version_tag(app.config['TEMPLATES_VERSION'], session.get('user_id'),
+                                      session.get('user_name'), session.get('user_role'), *etag_parts)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(render_template(template, **context), mimetype='text/html')
+    response.set_etag(etag)
+    # Let the browser keep the page but check back on every view
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def login_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if current_user() is None:
+            session.clear()
+            return redirect(url_for('login'))
+        # ensure_sync lets the decorator wrap async views too
+        return app.ensure_sync(f)(*args, **kwargs)
+    return decorated_function
+
+def role_required(required_role):
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            user = current_user()
+            if user is None or user['role'] != required_role:
+                flash('Access denied. Insufficient permissions.', 'error')
+                return redirect(url_for('dashboard'))
+            return app.ensure_sync(f)(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+@app.route('/healthz')
+def healthz():
+    """Read-only health check: one Firestore document read, no writes"""
+    error = check_firestore()
+    if error:
+        return jsonify({'status': 'unavailable', 'firestore': error}), 503
+    return jsonify({'status': 'ok', 'firestore': 'ok'})
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus metrics; needs `Authorization: Bearer <METRICS_TOKEN>` when that is set"""
+    if METRICS_TOKEN and not hmac.compare_digest(request.headers.get('Authorization', ''),
+                                                 f'Bearer {METRICS_TOKEN}'):
+        return jsonify({'error': 'Unauthorized'}), 401
+    return instrumentation.metrics_response()
+
+@app.route('/')
+def index():
+    if 'user_id' in session:
+        return redirect(url_for('dashboard'))
+    return redirect(url_for('login'))
+
+@app.route('/register', methods=['GET', 'POST'])
+def register():
+    if request.method == 'POST':
+        email = request.form['email']
+        password = request.form['password']
+        role = request.form['role']
+        name = request.form['name']
+        
+        try:
+            # Create user in Firebase Auth
+            user = auth.create_user(
+                email=email,
+                password=password,
+                display_name=name,
+                app=get_firebase_app()
+            )
+            
+            # Store additional user data in Firestore
+            user_data = {
+                'uid': user.uid,
+                'email': email,
+                'name': name,
+                'role': role,
+                'created_at': datetime.now()
+            }
+            
+            db.collection('users').document(user.uid).set(user_data)
+            
+            flash('Registration successful! Please login.', 'success')
+            return redirect(url_for('login'))
+            
+        except Exception as e:
+            flash(f'Registration failed: {str(e)}', 'error')
+    
+    return render_template('register.html')
+
+@app.route('/login', methods=['GET', 'POST'])
+def login():
+    if request.method == 'POST':
+        id_token = request.form.get('id_token')
+        if not id_token:
+            flash('Login failed: please sign in with your email and password.', 'error')
+            return render_template('login.html', firebase_config=FIREBASE_WEB_CONFIG)
+        
+        try:
+            # The browser signed in with Firebase Auth (which checked the
+            # password); verify the ID token it got against Google's public
+            # keys, which the SDK caches between logins
+            claims = auth.verify_id_token(id_token, app=get_firebase_app())
+            uid = claims['uid']
+            
+            # Get user data from Firestore, always fresh at login
+            user_cache.invalidate(uid)
+            user_data = user_cache.get(uid)
+            if user_data is not None:
+                session.clear()
+                session['user_id'] = uid
+                session['user_email'] = claims.get('email', user_data.get('email'))
+                session['user_name'] = user_data['name']
+                session['user_role'] = user_data['role']
+                
+                flash('Login successful!', 'success')
+                return redirect(url_for('dashboard'))
+            else:
+                flash('User data not found.', 'error')
+                
+        except Exception as e:
+            flash(f'Login failed: {str(e)}', 'error')
+    
+    return render_template('login.html', firebase_config=FIREBASE_WEB_CONFIG)
+
+@app.route('/logout')
+def logout():
+    session.clear()
+    flash('Logged out successfully.', 'info')
+    return redirect(url_for('login'))
+
+# Fields rendered on dashboard patient cards; the prescriptions array is never loaded here
+PATIENT_LIST_FIELDS = ['name', 'age', 'height', 'weight', 'bp', 'temp', 'created_at', 'active_prescription_count']
+DEFAULT_PAGE_SIZE = 24
+MAX_PAGE_SIZE = 100
+
+def get_page_size():
+    """Read the page size from the query string, clamped to a sane range"""
+    try:
+        page_size = int(request.args.get('per_page', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        page_size = DEFAULT_PAGE_SIZE
+    return max(1, min(page_size, MAX_PAGE_SIZE))
+
+def visible_patients_query():
+    """Patients the current user may see: all for doctors, own for assistants"""
+    query = db.collection('patients')
+    if session.get('user_role') != 'doctor':
+        query = query.where('created_by', '==', session['user_id'])
+    return query
+
+def fetch_patient_page(query, page_size, cursor=None):
+    """Fetch one page of projected patient cards, returning (patients, next_cursor)"""
+    query = query.select(PATIENT_LIST_FIELDS)
+    if cursor:
+        cursor_doc = db.collection('patients').document(cursor).get()
+        if cursor_doc.exists:
+            query = query.start_after(cursor_doc)
+    
+    # Ask for one extra document to learn whether another page exists
+    patients = []
+    for doc in query.limit(page_size + 1).stream():
+        patient_data = doc.to_dict()
+        patient_data['id'] = doc.id
+        patient_data['update_time'] = doc.update_time
+        patients.append(patient_data)
+    
+    next_cursor = None
+    if len(patients) > page_size:
+        patients = patients[:page_size]
+        next_cursor = patients[-1]['id']
+    return patients, next_cursor
+
+def load_summary():
+    """Dashboard header stats: clinic-wide for doctors, own patients for assistants"""
+    try:
+        assistant_id = session['user_id'] if session.get('user_role') != 'doctor' else None
+        return stats.get_summary(db, assistant_id)
+    except Exception as e:
+        print(f"Dashboard summary unavailable: {e}")
+        return {}
+
+@app.route('/dashboard')
+@login_required
+def dashboard():
+    user_role = session.get('user_role')
+    page_size = get_page_size()
+    cursor = request.args.get('cursor')
+    
+    # Doctors see all patients, assistants only the ones they created
+    query = visible_patients_query()
+    patients, next_cursor = fetch_patient_page(
+        query.order_by('created_at', direction=firestore.Query.DESCENDING),
+        page_size, cursor)
+    
+    # Header widgets come from one summary document
+    summary = load_summary()
+    
+    # dispensed_today rolls over at midnight without any write
+    etag_parts = (page_size, cursor, next_cursor, stats.today_key(), summary.get('update_time'),
+                  [(patient['id'], patient['update_time']) for patient in patients])
+    # Live updates resume from the changes the summary already counts
+    live_since = timestamp_id(summary['update_time']) if summary.get('update_time') else None
+    return render_conditional('dashboard.html', etag_parts, patients=patients, user_role=user_role,
+                              summary=summary, total_patients=summary.get('patient_count'),
+                              cursor=cursor, next_cursor=next_cursor, per_page=page_size,
+                              live_since=live_since)
+
+@app.route('/api/patients')
+@login_required
+def query_patients_api():
+    """Paged patient query with filters and a sort (see patient_query.py).
+
+    Query: name (prefix), age_min/age_max, created_from/created_to
+    (YYYY-MM-DD or ISO datetime), created_by, active (true/false), sort,
+    per_page and cursor. format=html returns rendered patient cards instead
+    of JSON records. Assistants only ever see their own patients.
+    """
+    try:
+        filters = patient_query.parse_filters(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    if session.get('user_role') != 'doctor':
+        if filters['created_by'] not in (None, session['user_id']):
+            return jsonify({'error': 'Assistants can only query their own patients.'}), 403
+        filters['created_by'] = session['user_id']
+    
+    try:
+        query = patient_query.build_query(db.collection('patients'), filters)
+        patients, next_cursor = fetch_patient_page(query, get_page_size(), request.args.get('cursor'))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    
+    if request.args.get('format') == 'html':
+        html = ''.join(render_template('_patient_card.html', patient=patient) for patient in patients)
+        return jsonify({'html': html, 'count': len(patients), 'next_cursor': next_cursor})
+    for patient in patients:
+        patient.pop('update_time', None)
+    return jsonify({'patients': patients, 'count': len(patients), 'next_cursor': next_cursor,
+                    'sort': filters['sort']})
+
+@app.route('/add_patient', methods=['GET', 'POST'])
+@login_required
+@role_required('assistant')
+def add_patient():
+    if request.method == 'POST':
+        try:
+            # Same validation and coercions as bulk imports
+            patient_data = bulk_io.patient_record(request.form, session['user_id'])
+            # The dashboard summaries are updated in the same transaction
+            stats.add_patient(db, patient_data)
+            flash('Patient added successfully!', 'success')
+            return redirect(url_for('dashboard'))
+        except Exception as e:
+            flash(f'Error adding patient: {str(e)}', 'error')
+    
+    return render_template('add_patient.html')
+
+async def load_patient_detail(async_db, patient_id):
+    """Patient with prescriptions and the medicines they refer to, or (None, None)"""
+    # The patient and its prescriptions are independent reads; run them together
+    patient_doc, prescriptions = await asyncio.gather(
+        async_db.collection('patients').document(patient_id).get(),
+        list_prescriptions_async(async_db, patient_id)
+    )
+    if not patient_doc.exists:
+        return None, None
+    
+    patient_data = patient_doc.to_dict()
+    patient_data['id'] = patient_id
+    patient_data['update_time'] = patient_doc.update_time
+    patient_data['prescriptions'] = prescriptions
+    
+    # Load only the medicines this patient's prescriptions refer to, in one
+    # batched read; the prescribe picker uses the search API instead
+    medicine_ids = {p['medicine_id'] for p in prescriptions if p.get('medicine_id')}
+    medicines = {}
+    if medicine_ids:
+        medicine_refs = [async_db.collection('medicines').document(medicine_id) for medicine_id in medicine_ids]
+        async for doc in async_db.get_all(medicine_refs):
+            if doc.exists:
+                medicine_data = doc.to_dict()
+                medicine_data['id'] = doc.id
+                medicine_data['update_time'] = doc.update_time
+                medicines[doc.id] = medicine_data
+    return patient_data, medicines
+
+@app.route('/patient/<patient_id>')
+@login_required
+async def patient_detail(patient_id):
+    try:
+        patient_data, medicines = await run_async(load_patient_detail, patient_id)
+        if patient_data is not None:
+            # Keys the {% cache %} fragments and the ETag; every prescription
+            # write stamps the prescription's updated_at
+            version = template_cache.version_tag(
+                patient_data['update_time'],
+                [(prescription['id'], prescription.get('updated_at')) for prescription in patient_data['prescriptions']],
+                sorted((medicine_id, medicine['update_time']) for medicine_id, medicine in medicines.items()))
+            return render_conditional('patient_detail.html', (patient_id, version),
+                                      patient=patient_data, medicines=medicines, version=version,
+                                      live_since=timestamp_id(patient_data['update_time']))
+        else:
+            flash('Patient not found.', 'error')
+            return redirect(url_for('dashboard'))
+    except Exception as e:
+        flash(f'Error loading patient: {str(e)}', 'error')
+        return redirect(url_for('dashboard'))
+
+@app.route('/add_medicine', methods=['GET', 'POST'])
+@login_required
+def add_medicine():
+    """Allow both doctors and assistants to add medicines"""
+    if request.method == 'POST':
+        try:
+            medicine_data = bulk_io.medicine_record(request.form, session['user_id'])
+            batch = db.batch()
+            batch.set(db.collection('medicines').document(), medicine_data)
+            stats.record_medicine_added(batch, db)
+            batch.commit()
+            medicine_catalog.invalidate()
+            flash('Medicine added successfully!', 'success')
+            return redirect(url_for('list_medicines'))
+        except Exception as e:
+            flash(f'Error adding medicine: {str(e)}', 'error')
+    
+    return render_template('add_medicine.html')
+
+@app.route('/prescribe_medicine', methods=['POST'])
+@login_required
+@role_required('doctor')
+async def prescribe_medicine():
+    patient_id = request.form['patient_id']
+    medicine_id = request.form['medicine_id']
+    notes = request.form.get('notes', '')
+    
+    async def load(async_db):
+        return await asyncio.gather(
+            async_db.collection('patients').document(patient_id).get(),
+            async_db.collection('medicines').document(medicine_id).get()
+        )
+    
+    try:
+        # Get patient and medicine details concurrently
+        patient_doc, medicine_doc = await run_async(load)
+        if not patient_doc.exists:
+            flash('Patient not found.', 'error')
+        elif medicine_doc.exists:
+            medicine_data = medicine_doc.to_dict()
+            
+            # Create prescription
+            prescription = {
+                'medicine_id': medicine_id,
+                'medicine_name': medicine_data['name'],
+                'dosage': medicine_data['dosage'],
+                'frequency': medicine_data['frequency'],
+                'notes': notes,
+                'prescribed_by': session['user_id'],
+                'prescribed_at': datetime.now(),
+                'status': 'active'
+            }
+            
+            # Single-document insert into the patient's prescriptions subcollection
+            try:
+                await run_async(add_prescription_async, patient_id, prescription,
+                                patient_doc.to_dict().get('created_by'))
+                flash('Medicine prescribed successfully!', 'success')
+            except NotFound:
+                flash('Patient not found.', 'error')
+        else:
+            flash('Medicine not found.', 'error')
+            
+    except Exception as e:
+        flash(f'Error prescribing medicine: {str(e)}', 'error')
+    
+    return redirect(url_for('patient_detail', patient_id=patient_id))
+
+@app.route('/dispense_medicine', methods=['POST'])
+@login_required
+async def dispense_medicine():
+    patient_id = request.form['patient_id']
+    prescription_id = request.form['prescription_id']
+    # Sent again unchanged when the browser retries, so a repeat finds the first job
+    idempotency_key = request.headers.get('Idempotency-Key') or request.form.get('idempotency_key')
+    
+    def replay(record):
+        """Answer a repeated request with the job the first one queued"""
+        try:
+            result = idempotency.check(record, {'patient_id': patient_id, 'prescription_id': prescription_id})
+        except idempotency.KeyConflict as e:
+            return jsonify({'error': str(e)}), 422
+        if wants_json():
+            return jsonify({'job_id': result['job_id'], 'status': 'queued'}), 202, {'Idempotent-Replayed': 'true'}
+        flash('Dispensing has already been queued.', 'info')
+        return redirect(url_for('patient_detail', patient_id=patient_id))
+    
+    if idempotency_key is not None:
+        if not idempotency.valid_key(idempotency_key):
+            return jsonify({'error': 'Idempotency-Key must be 16-64 letters, digits, - or _'}), 400
+        record = dispense_queue.idempotency_keys.cached(idempotency_key)
+        if record is not None:
+            return replay(record)
+    
+    async def load(async_db):
+        reads = [
+            async_db.collection('patients').document(patient_id).get(),
+            prescriptions_ref(async_db, patient_id).document(prescription_id).get()
+        ]
+        if idempotency_key:
+            reads.append(idempotency.key_ref(async_db, idempotency_key).get())
+        return await asyncio.gather(*reads)
+    
+    try:
+        # Get patient, prescription and any earlier use of the key concurrently
+        patient_doc, prescription_doc, *key_doc = await run_async(load)
+        key_doc = key_doc[0] if key_doc else None
+        
+        record = dispense_queue.idempotency_keys.from_snapshot(key_doc) if key_doc else None
+        if record is not None:
+            return replay(record)
+        
+        if patient_doc.exists:
+            patient_data = patient_doc.to_dict()
+            if prescription_doc.exists and prescription_doc.get('status') == 'active':
+                prescription = prescription_doc.to_dict()
+                quantity = request.form.get('quantity', '1')  # Default to 1 if not specified
+                
+                # Refuse what the inventory cannot cover; untracked medicines always pass
+                stock = await run_async(inventory.get_stock_async, prescription['medicine_id'])
+                if stock is not None and stock.get('stock', 0) < analytics.tablet_count(quantity):
+                    error = f'Not enough {prescription["medicine_name"]} in stock ({stock.get("stock", 0)} left).'
+                    if wants_json():
+                        return jsonify({'error': error}), 409
+                    flash(error, 'error')
+                    return redirect(url_for('patient_detail', patient_id=patient_id))
+                
+                # Prepare prescription data for NodeMCU
+                prescription_data = {
+                    'action': 'dispense',
+                    'patient_name': patient_data['name'],
+                    'medicine_id': prescription['medicine_id'],
+                    'medicine_name': prescription['medicine_name'],
+                    'dosage': prescription['dosage'],
+                    'frequency': prescription['frequency'],
+                    'quantity': quantity,
+                    'notes': prescription.get('notes', ''),
+                    'dispensed_by': session['user_name'],
+                    'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                }
+                
+                # Hand off to the dispense worker; the device is driven in the background
+                job_id = dispense_queue.submit(patient_id, prescription_id, prescription_data, session['user_id'],
+                                               idempotency_key, key_doc)
+                
+                if wants_json():
+                    return jsonify({'job_id': job_id, 'status': 'queued'}), 202
+                flash(f'Dispensing "{prescription["medicine_name"]}" has been queued.', 'info')
+                return redirect(url_for('patient_detail', patient_id=patient_id))
+            else:
+                error = 'Prescription not found or already dispensed.'
+        else:
+            error = 'Patient not found.'
+            
+    except Exception as e:
+        error = f'Error dispensing medicine: {str(e)}'
+    
+    if wants_json():
+        return jsonify({'error': error}), 400
+    flash(error, 'error')
+    return redirect(url_for('patient_detail', patient_id=patient_id))
+
+def live_stream(matches, render):
+    """Server-Sent Events response with the live_updates events for which matches(event) is true"""
+    subscription = live_updates.subscribe(matches, request.headers.get('Last-Event-ID') or request.args.get('since'))
+    if subscription is None:
+        # This worker is at its stream limit; the browser retries later
+        return Response('retry: 15000\n\n', mimetype='text/event-stream')
+    body = live_updates.stream(subscription, render, max_seconds=LIVE_STREAM_SECONDS)
+    return Response(stream_with_context(body), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/patients/<patient_id>/events')
+@login_required
+def patient_events(patient_id):
+    """Live changes to a patient's prescriptions, each with its re-rendered card"""
+    def render(event):
+        prescription = event['prescription']
+        medicine = medicine_catalog.get(prescription.get('medicine_id'))
+        medicines = {medicine['id']: medicine} if medicine else {}
+        return {
+            'event': event['event'],
+            'prescription_id': prescription['id'],
+            'status': prescription.get('status'),
+            'html': render_template('_prescription_card.html', prescription=prescription,
+                                    patient={'id': patient_id}, medicines=medicines)
+        }
+    return live_stream(lambda event: event['patient_id'] == patient_id, render)
+
+@app.route('/api/dashboard/events')
+@login_required
+def dashboard_events():
+    """Live prescription changes for the patients on this user's dashboard"""
+    if session.get('user_role') == 'doctor':
+        matches = lambda event: True
+    else:
+        user_id = session['user_id']
+        matches = lambda event: event['assistant_id'] == user_id
+    
+    def render(event):
+        return {
+            'event': event['event'],
+            'patient_id': event['patient_id'],
+            'prescription_id': event['prescription']['id'],
+            'medicine_name': event['prescription'].get('medicine_name')
+        }
+    return live_stream(matches, render)
+
+@app.route('/api/dispense_jobs/<job_id>')
+@login_required
+def dispense_job_status(job_id):
+    """API endpoint the UI polls for the progress of a queued dispense"""
+    try:
+        job = dispense_queue.get(job_id)
+        if job is None:
+            return jsonify({'error': 'Dispense job not found'}), 404
+        
+        return jsonify({
+            'job_id': job['id'],
+            'status': job['status'],
+            'error': job.get('error'),
+            'patient_id': job['patient_id'],
+            'prescription_id': job['prescription_id'],
+            'medicine_name': job['payload'].get('medicine_name'),
+            'quantity': job['payload'].get('quantity')
+        })
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/dispensers')
+@login_required
+def dispensers_status():
+    """API endpoint listing dispensers with their health and load"""
+    return jsonify({'dispensers': dispenser_fleet.to_list()})
+
+def int_field(data, name):
+    """Integer value of data[name], None when absent; raises ValueError if not a number"""
+    value = data.get(name)
+    if value is None or value == '':
+        return None
+    return int(value)
+
+@app.route('/api/dispensers/<device_id>/slots/<medicine_id>', methods=['POST'])
+@login_required
+@role_required('doctor')
+def refill_dispenser_slot(device_id, medicine_id):
+    """Set the number of tablets loaded in a dispenser slot (JSON or form: count)"""
+    data = request.get_json(silent=True) or request.form
+    try:
+        count = int_field(data, 'count')
+    except ValueError:
+        count = None
+    if count is None or count < 0:
+        return jsonify({'error': 'count must be a whole number of tablets'}), 400
+    
+    try:
+        dispenser_fleet.refill(device_id, medicine_id, count)
+    except (KeyError, NotFound):
+        return jsonify({'error': 'Dispenser not registered.'}), 404
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    return jsonify({'device_id': device_id, 'medicine_id': medicine_id, 'count': count})
+
+@app.route('/api/inventory/<medicine_id>', methods=['POST'])
+@login_required
+@role_required('doctor')
+def update_inventory(medicine_id):
+    """Record a delivery or a stock count for a medicine, or change its settings.
+
+    JSON or form fields: add (tablets received), count (tablets on hand,
+    replacing the current figure), reorder_level, and shards (counters to
+    spread dispenses over; raise it for medicines dispensed many times a
+    second).
+    """
+    data = request.get_json(silent=True) or request.form
+    try:
+        fields = {name: int_field(data, name) for name in ('add', 'count', 'reorder_level', 'shards')}
+    except ValueError:
+        return jsonify({'error': 'add, count, reorder_level and shards must be whole numbers'}), 400
+    if any(value is not None and value < 0 for value in fields.values()):
+        return jsonify({'error': 'add, count, reorder_level and shards cannot be negative'}), 400
+    if fields['shards'] is not None and fields['shards'] > inventory.MAX_SHARDS:
+        return jsonify({'error': f'At most {inventory.MAX_SHARDS} shards'}), 400
+    
+    try:
+        if not db.collection('medicines').document(medicine_id).get().exists:
+            return jsonify({'error': 'Medicine not found.'}), 404
+        stock = inventory.restock(db, medicine_id, **fields)
+        return jsonify(dict(inventory.get_stock(db, medicine_id), stock=stock, medicine_id=medicine_id))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/inventory/reorder')
+@login_required
+def reorder_list():
+    """Medicines at or below their reorder level, lowest stock first"""
+    try:
+        limit = min(max(1, int(request.args.get('limit', 50))), 500)
+    except ValueError:
+        return jsonify({'error': 'limit must be a number'}), 400
+    
+    try:
+        items = inventory.low_stock(db, limit)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    for item in items:
+        medicine = medicine_catalog.get(item['medicine_id'])
+        item['name'] = medicine['name'] if medicine else None
+    return jsonify({'medicines': items})
+
+# The firmware prints at most this many prescriptions and only these fields
+NODEMCU_MAX_PRESCRIPTIONS = 10
+NODEMCU_PRESCRIPTION_FIELDS = ('medicine_name', 'dosage', 'frequency')
+
+@app.route('/send_prescriptions_to_nodmcu', methods=['POST'])
+@login_required
+def send_prescriptions_to_nodmcu():
+    """Send all patient prescriptions to NodeMCU"""
+    try:
+        data = request.get_json()
+        patient_name = data.get('patient_name')
+        patient_id = data.get('patient_id')
+        prescriptions = data.get('prescriptions', [])
+        
+        # Prepare prescription data for NodeMCU, trimmed to what it displays
+        prescription_data = {
+            'action': 'send_prescriptions',
+            'patient_name': patient_name,
+            'patient_id': patient_id,
+            'total_prescriptions': len(prescriptions),
+            'prescriptions': [
+                {field: prescription.get(field, '') for field in NODEMCU_PRESCRIPTION_FIELDS}
+                for prescription in prescriptions[:NODEMCU_MAX_PRESCRIPTIONS]
+            ],
+            'sent_by': session['user_name'],
+            'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        }
+        
+        # Send to NodeMCU
+        response = dispenser_fleet.send_prescriptions(prescription_data)
+        
+        if response.status_code == 200:
+            return jsonify({
+                'success': True,
+                'message': f'Successfully sent {len(prescriptions)} prescriptions to NodeMCU'
+            })
+        else:
+            return jsonify({
+                'success': False,
+                'error': 'Failed to communicate with NodeMCU'
+            }), 500
+            
+    except NodeMCUError:
+        return jsonify({
+            'success': False,
+            'error': 'Failed to connect to NodeMCU'
+        }), 500
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': f'Error: {str(e)}'
+        }), 500
+
+@app.route('/medicines')
+@login_required
+def list_medicines():
+    """List all medicines in the database"""
+    try:
+        medicines = []
+        medicines_ref = db.collection('medicines').order_by('name')
+        for doc in medicines_ref.stream():
+            medicine_data = doc.to_dict()
+            medicine_data['id'] = doc.id
+            medicines.append(medicine_data)
+        
+        # Reorder list from the low-stock index
+        names = {medicine['id']: medicine['name'] for medicine in medicines}
+        reorder = inventory.low_stock(db, limit=20)
+        for item in reorder:
+            item['name'] = names.get(item['medicine_id'], item['medicine_id'])
+        
+        return render_template('medicines_list.html', medicines=medicines, reorder=reorder)
+    except Exception as e:
+        flash(f'Error loading medicines: {str(e)}', 'error')
+        return redirect(url_for('dashboard'))
+
+@app.route('/api/search_medicines')
+@login_required
+def search_medicines_api():
+    """API endpoint for real-time medicine search"""
+    try:
+        query = request.args.get('q', '').strip().lower()
+        
+        if len(query) < 1:
+            return jsonify({'medicines': []})
+        
+        # Served from the in-memory catalog; no Firestore read per keystroke
+        medicines = medicine_catalog.search(query, limit=10)
+        
+        return jsonify({'medicines': medicines})
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/analytics')
+@login_required
+@role_required('doctor')
+def analytics_report():
+    """Prescribing and dispensing counts from the hourly or daily rollups.
+
+    Query: granularity (day or hour), start and end (YYYY-MM-DD, or
+    YYYY-MM-DDTHH for hours; default the last 7 days or 24 hours),
+    dimension (medicines, doctors, devices or assistants) for a per-member breakdown,
+    id to count one member only, and limit for the breakdown length.
+    """
+    granularity = request.args.get('granularity', analytics.DAY)
+    dimension = request.args.get('dimension')
+    member = request.args.get('id')
+    if granularity not in analytics.GRANULARITIES:
+        return jsonify({'error': 'granularity must be day or hour'}), 400
+    if dimension is not None and dimension not in analytics.DIMENSIONS:
+        return jsonify({'error': 'dimension must be medicines, doctors, devices or assistants'}), 400
+    if member and not dimension:
+        return jsonify({'error': 'id needs a dimension'}), 400
+    
+    try:
+        now = datetime.now()
+        end = analytics.parse_bucket(granularity, request.args['end']) if 'end' in request.args else now
+        default_start = end - (timedelta(days=6) if granularity == analytics.DAY else timedelta(hours=23))
+        start = analytics.parse_bucket(granularity, request.args['start']) if 'start' in request.args else default_start
+        keys = analytics.bucket_keys(granularity, start, end)
+        limit = max(1, int(request.args.get('limit', 50)))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    try:
+        result = analytics.report(analytics.load_rollups(db, granularity, keys), dimension, member)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    
+    # Names come from the in-memory catalog and the profile cache
+    result['breakdown'] = result['breakdown'][:limit]
+    for entry in result['breakdown']:
+        if dimension == 'medicines':
+            medicine = medicine_catalog.get(entry['id'])
+            entry['name'] = medicine['name'] if medicine else None
+        elif dimension in ('doctors', 'assistants'):
+            profile = user_cache.get(entry['id'])
+            entry['name'] = profile.get('name') if profile else None
+    return jsonify(dict(result, granularity=granularity, start=keys[0], end=keys[-1],
+                        dimension=dimension, id=member))
+
+@app.route('/api/recognize_handwriting', methods=['POST'])
+@login_required
+def recognize_handwriting_api():
+    """Read a handwritten medicine name and match it to the catalog.
+
+    Accepts JSON with `strokes` (the canvas strokes) or `image` (a PNG data
+    URL), or a multipart upload with an `image` file.
+    """
+    try:
+        upload = request.files.get('image')
+        if upload:
+            job = parse_png(upload.read(MAX_IMAGE_BYTES + 1))
+        else:
+            data = request.get_json(silent=True) or {}
+            if 'strokes' in data:
+                job = parse_strokes(data['strokes'])
+            elif 'image' in data:
+                job = parse_png(data['image'])
+            else:
+                return jsonify({'error': 'Send strokes or an image'}), 400
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        text, confidence = handwriting_recognizer.recognize(job)
+    except RecognizerUnavailable as e:
+        return jsonify({'error': str(e)}), 503
+    except UnreadableInput as e:
+        return jsonify({'error': str(e)}), 400
+    except TimeoutError:
+        return jsonify({'error': 'Recognition timed out. Please try again.'}), 504
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+    return jsonify({
+        'text': text,
+        'confidence': confidence,
+        'candidates': rank_medicines(medicine_catalog, text, confidence, limit=5)
+    })
+
+@app.cli.command('backfill-patient-fields')
+def backfill_patient_fields():
+    """Add the lowercase_name, active_prescription_count and has_active_prescriptions fields to existing patients"""
+    batch = db.batch()
+    pending = 0
+    updated = 0
+    for doc in db.collection('patients').stream():
+        patient_data = doc.to_dict()
+        updates = {'lowercase_name': patient_data.get('name', '').strip().lower()}
+        if 'active_prescription_count' not in patient_data:
+            updates['active_prescription_count'] = count_active_prescriptions(patient_data.get('prescriptions', []))
+        updates['has_active_prescriptions'] = updates.get('active_prescription_count',
+                                                          patient_data.get('active_prescription_count', 0)) > 0
+        batch.update(doc.reference, updates)
+        pending += 1
+        updated += 1
+        # Firestore caps a write batch at 500 operations
+        if pending == 500:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+    if pending:
+        batch.commit()
+    print(f"Backfilled {updated} patients")
+
+def run_import(kind, import_id, path, fmt, created_by):
+    """Import a spooled upload; runs on a background thread"""
+    try:
+        with open(path, newline='', encoding='utf-8-sig') as upload:
+            bulk_io.Importer(db, kind, import_id, created_by).run(bulk_io.read_rows(upload, fmt), source=path)
+        if kind == 'medicines':
+            medicine_catalog.invalidate()
+    except Exception as e:
+        print(f"Import {import_id} failed: {e}")
+        db.collection(bulk_io.IMPORTS_COLLECTION).document(import_id).set(
+            {'status': 'failed', 'error': str(e), 'updated_at': datetime.now()}, merge=True)
+    finally:
+        os.unlink(path)
+
+@app.route('/api/import/<kind>', methods=['POST'])
+@login_required
+def import_upload(kind):
+    """Start a bulk import of an uploaded CSV/JSONL file; poll /api/imports/<id> for progress.
+
+    Posting again with the same `import_id` resumes an interrupted import.
+    """
+    if kind not in bulk_io.KINDS:
+        return jsonify({'error': f'Unknown import kind: {kind}'}), 404
+    if kind == 'patients' and session.get('user_role') != 'assistant':
+        return jsonify({'error': 'Only assistants can import patients.'}), 403
+    upload = request.files.get('file')
+    if upload is None or not upload.filename:
+        return jsonify({'error': 'No file uploaded.'}), 400
+    try:
+        fmt = bulk_io.detect_format(upload.filename)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    # The request's upload is gone once it returns, so spool it to disk for the worker
+    import_id = request.form.get('import_id') or uuid.uuid4().hex
+    spool = tempfile.NamedTemporaryFile(suffix=f'.{fmt}', delete=False)
+    with spool:
+        upload.save(spool)
+    threading.Thread(target=run_import, name=f'import-{import_id}', daemon=True,
+                     args=(kind, import_id, spool.name, fmt, session['user_id'])).start()
+    return jsonify({'import_id': import_id, 'status': 'running'}), 202
+
+@app.route('/api/imports/<import_id>')
+@login_required
+def import_status(import_id):
+    state = bulk_io.get_import(db, import_id)
+    if state is None:
+        return jsonify({'error': 'Import not found'}), 404
+    return jsonify(state)
+
+@app.route('/export/<kind>')
+@login_required
+def export_data(kind):
+    """Stream a collection as CSV (default) or JSONL, a page at a time"""
+    if kind not in bulk_io.KINDS:
+        return jsonify({'error': f'Unknown export kind: {kind}'}), 404
+    fmt = request.args.get('format', 'csv')
+    if fmt not in bulk_io.FORMATS:
+        return jsonify({'error': f'Unknown format: {fmt}'}), 400
+    
+    query = visible_patients_query() if kind == 'patients' else db.collection('medicines')
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    return Response(stream_with_context(bulk_io.iter_export(query, kind, fmt)), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={kind}.{fmt}'})
+
+@app.cli.command('import-data')
+@click.argument('kind', type=click.Choice(bulk_io.KINDS))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--created-by', default=None, help='User ID recorded as the creator (the assistant for patients)')
+@click.option('--import-id', default=None, help='Checkpoint ID; re-use it to resume (default: derived from the file name)')
+@click.option('--workers', default=4, show_default=True, help='Batches committed in parallel')
+def import_data(kind, path, created_by, import_id, workers):
+    """Bulk import patients or medicines from a CSV or JSONL file"""
+    fmt = bulk_io.detect_format(path)
+    import_id = import_id or f"{kind}-{os.path.basename(path).rsplit('.', 1)[0]}"
+    with open(path, newline='', encoding='utf-8-sig') as source:
+        state = bulk_io.Importer(db, kind, import_id, created_by, workers).run(
+            bulk_io.read_rows(source, fmt), source=path)
+    print(f"Import {import_id}: {state['imported']} {kind} written, {state['error_count']} rows rejected")
+    for error in state['errors']:
+        print(f"  row {error['row']}: {error['error']}")
+
+@app.cli.command('export-data')
+@click.argument('kind', type=click.Choice(bulk_io.KINDS))
+@click.argument('path', type=click.Path(dir_okay=False, writable=True))
+@click.option('--page-size', default=500, show_default=True)
+def export_data_command(kind, path, page_size):
+    """Export patients or medicines to a CSV or JSONL file"""
+    fmt = bulk_io.detect_format(path)
+    rows = 0
+    with open(path, 'w', newline='', encoding='utf-8') as output:
+        for chunk in bulk_io.iter_export(db.collection(kind), kind, fmt, page_size):
+            output.write(chunk)
+            rows += 1
+    print(f"Exported {rows - (1 if fmt == 'csv' else 0)} {kind} to {path}")
+
+@app.cli.command('rebuild-stats')
+def rebuild_stats():
+    """Recompute the dashboard summary documents from patients and medicines"""
+    written = stats.rebuild_summaries(db)
+    print(f"Rebuilt {written} summary documents")
+
+@app.cli.command('rebuild-analytics')
+@click.option('--chunk-size', default=5000, show_default=True, help='Prescriptions per NumPy chunk')
+def rebuild_analytics(chunk_size):
+    """Recompute the hourly and daily analytics rollups from all prescriptions"""
+    written = analytics.rebuild_rollups(db, chunk_size)
+    print(f"Rebuilt {written} analytics rollup documents")
+
+@app.cli.command('migrate-prescriptions')
+def migrate_prescriptions():
+    """Move embedded prescription arrays into per-patient subcollections"""
+    patients_migrated, prescriptions_migrated = migrate_embedded_prescriptions(db)
+    print(f"Migrated {prescriptions_migrated} prescriptions from {patients_migrated} patients")
+
+if __name__ == '__main__':
+    port = int(os.environ.get('PORT', 5000))
+    debug = os.environ.get('FLASK_ENV') == 'development'
+    create_app().run(debug=debug, host='0.0.0.0', port=port)
@@ -0,0 +1,442 @@
+#!/usr/bin/env python3
+"""
+End-to-end load test of the app against local stand-ins for Firestore and the dispenser.
+
+    python benchmark_load.py --patients 10000 --medicines 20000 --users 16 --duration 60
+
+Seeds the in-memory Firestore (fake_firestore.py) with staff accounts,
+patients, their prescriptions, medicines and dashboard summaries, and saves
+it as a snapshot (reused by later runs with the same sizes). Then starts a
+fake NodeMCU (fake_nodemcu.py, with the sketch's per-tablet delay) and
+gunicorn with gunicorn.conf.py, one worker since the store is per process,
+and lets simulated staff loose on it: each logs in and then loops over a
+weighted mix of tasks, Locust-style. Doctors open the dashboard and patient
+pages, search medicines and prescribe; assistants open the dashboard and
+patient pages, search patients and dispense. Everyone logs in again now
+and then.
+
+Logging in goes through the real /login view with an unsigned ID token, which
+the Firebase Admin SDK accepts only while FIREBASE_AUTH_EMULATOR_HOST is set
+(as it is for the server started here).
+
+Prints p50/p99 latency, throughput and errors per task, with the median
+Firestore time from each response's Server-Timing header. Save the results
+with --save and compare a later run against them with --baseline; the run
+fails when a task's p99 or the overall throughput regresses by more than
+--tolerance. Runs are repeatable: the dataset and every user's choices are
+seeded. FIRESTORE_FAKE_LATENCY_MS (--firestore-latency) adds a simulated
+round trip to every Firestore call.
+"""
+
+import argparse
+import base64
+import json
+import os
+import random
+import re
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+
+import requests
+
+import bulk_io
+import fake_firestore
+import fake_nodemcu
+import stats
+from benchmark_search import query_sets, synthetic_medicines, typo
+from benchmark_wsgi import percentile, wait_until_ready
+
+FIRST_NAMES = ['Aarav', 'Priya', 'Rohan', 'Ananya', 'Vikram', 'Meera', 'Arjun', 'Kavya', 'Rahul', 'Divya',
+               'Sanjay', 'Lakshmi', 'Karthik', 'Nisha', 'Suresh', 'Deepa', 'Ravi', 'Pooja', 'Amit', 'Sneha']
+LAST_NAMES = ['Sharma', 'Iyer', 'Patel', 'Reddy', 'Nair', 'Gupta', 'Menon', 'Rao', 'Kumar', 'Pillai',
+              'Singh', 'Das', 'Joshi', 'Krishnan', 'Bose', 'Verma', 'Mehta', 'Ganesan', 'Shetty', 'Kapoor']
+
+# Task weights per role; prescribing is doctor-only, as in the app
+ROLE_TASKS = {
+    'doctor': {'dashboard': 3, 'patient_detail': 4, 'search_medicines': 6, 'prescribe': 2, 'login': 1},
+    'assistant': {'dashboard': 3, 'patient_detail': 3, 'search_patients': 3, 'dispense': 2, 'login': 1},
+}
+# Patients with seeded active prescriptions, and how many each
+PRESCRIBED_EVERY = 3
+PRESCRIPTIONS_PER_PATIENT = 2
+BATCH_SIZE = 500
+SECRET_KEY = 'benchmark-load-secret'
+
+FIRESTORE_TIMING = re.compile(r'firestore;dur=([\d.]+)')
+
+
+# Dataset
+
+def doctor_ids(count):
+    return [f'doctor-{number:02d}' for number in range(count)]
+
+
+def assistant_ids(count):
+    return [f'assistant-{number:02d}' for number in range(count)]
+
+
+def patient_ids(count):
+    return [f'patient-{number:05d}' for number in range(count)]
+
+
+def seed(db, patients, medicines, doctors, assistants, rng_seed=0):
+    """Write the synthetic clinic into db; returns the number of documents written"""
+    rng = random.Random(rng_seed)
+    started = datetime(2024, 1, 1)
+    written = 0
+    batch = db.batch()
+    pending = 0
+
+    def write(ref, data):
+        nonlocal batch, pending, written
+        batch.set(ref, data)
+        pending += 1
+        written += 1
+        if pending == BATCH_SIZE:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+
+    for role, uids in (('doctor', doctor_ids(doctors)), ('assistant', assistant_ids(assistants))):
+        for uid in uids:
+            write(db.collection('users').document(uid), {
+                'uid': uid, 'email': f'{uid}@clinic.test', 'name': uid.replace('-', ' ').title(),
+                'role': role, 'created_at': started
+            })
+
+    medicine_list = synthetic_medicines(medicines, rng_seed)
+    for number, (medicine_id, fields) in enumerate(medicine_list):
+        write(db.collection('medicines').document(medicine_id),
+              bulk_io.medicine_record(fields, 'doctor-00', started + timedelta(seconds=number)))
+
+    staff = assistant_ids(assistants)
+    for number, patient_id in enumerate(patient_ids(patients)):
+        record = bulk_io.patient_record({
+            'name': f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}',
+            'age': rng.randint(1, 95),
+            'height': round(rng.uniform(50, 195), 1),
+            'weight': round(rng.uniform(3, 120), 1),
+            'bp': f'{rng.randint(100, 150)}/{rng.randint(60, 95)}',
+            'temp': round(rng.uniform(97, 102), 1)
+        }, staff[number % len(staff)], started + timedelta(minutes=number))
+        if number % PRESCRIBED_EVERY == 0:
+            record['active_prescription_count'] = PRESCRIPTIONS_PER_PATIENT
+            record['has_active_prescriptions'] = True
+            for index in range(PRESCRIPTIONS_PER_PATIENT):
+                medicine_id, medicine = rng.choice(medicine_list)
+                write(db.collection('patients').document(patient_id).collection('prescriptions')
+                      .document(f'rx-{index}'), {
+                    'medicine_id': medicine_id,
+                    'medicine_name': medicine['name'],
+                    'dosage': medicine['dosage'],
+                    'frequency': medicine['frequency'],
+                    'notes': '',
+                    'prescribed_by': 'doctor-00',
+                    'prescribed_at': record['created_at'] + timedelta(minutes=index),
+                    'status': 'active'
+                })
+        write(db.collection('patients').document(patient_id), record)
+
+    if pending:
+        batch.commit()
+    return written + stats.rebuild_summaries(db)
+
+
+def load_snapshot(path, args):
+    """Seed a fresh store and save it to path, unless a snapshot is already there"""
+    if os.path.exists(path) and not args.reseed:
+        print(f"Using snapshot {path}")
+        return
+    if os.path.exists(path):
+        os.remove(path)
+    started = time.perf_counter()
+    written = seed(fake_firestore.client(), args.patients, args.medicines, args.doctors, args.assistants)
+    fake_firestore.get_store('memory').save(path)
+    print(f"Seeded {written} documents in {time.perf_counter() - started:.1f}s into {path}")
+
+
+# Workload
+
+def emulator_id_token(uid):
+    """An unsigned Firebase ID token, as the Auth emulator issues"""
+    now = int(time.time())
+    claims = {
+        'iss': f'https://securetoken.google.com/{fake_firestore.PROJECT}', 'aud': fake_firestore.PROJECT,
+        'sub': uid, 'user_id': uid, 'email': f'{uid}@clinic.test', 'iat': now, 'auth_time': now, 'exp': now + 3600
+    }
+
+    def encode(data):
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).rstrip(b'=').decode()
+
+    return f"{encode({'alg': 'none', 'typ': 'JWT'})}.{encode(claims)}."
+
+
+class Workload:
+    """What the simulated staff pick from, shared by all of them"""
+
+    def __init__(self, args):
+        self.patient_ids = patient_ids(args.patients)
+        self.medicines = synthetic_medicines(args.medicines)
+        names = [{'name': fields['name']} for _, fields in self.medicines]
+        self.medicine_queries = [query for queries in query_sets(names, 200).values() for query in queries]
+        rng = random.Random(2)
+        self.patient_queries = [rng.choice(FIRST_NAMES).lower()[:rng.randint(2, 5)] for _ in range(200)]
+        self.patient_queries += [typo(name.lower(), rng, 1) for name in rng.sample(FIRST_NAMES, 10)]
+        # Each seeded prescription can be dispensed once
+        prescribed = [(patient_id, f'rx-{index}') for patient_id in self.patient_ids[::PRESCRIBED_EVERY]
+                      for index in range(PRESCRIPTIONS_PER_PATIENT)]
+        random.Random(3).shuffle(prescribed)
+        self.to_dispense = deque(prescribed)
+        self._lock = threading.Lock()
+
+    def next_dispense(self):
+        with self._lock:
+            return self.to_dispense.popleft() if self.to_dispense else None
+
+
+class VirtualUser:
+    """One member of staff with their own session, issuing requests back to back"""
+
+    def __init__(self, base_url, uid, role, workload, rng, think):
+        self.base_url = base_url
+        self.uid = uid
+        self.role = role
+        self.workload = workload
+        self.rng = rng
+        self.think = think
+        self.session = requests.Session()
+        tasks = ROLE_TASKS[role]
+        self.tasks = list(tasks)
+        self.weights = list(tasks.values())
+
+    def request(self, method, path, expected, **kwargs):
+        """Issue one request; returns (ok, seconds, firestore ms or None)"""
+        started = time.perf_counter()
+        try:
+            response = self.session.request(method, self.base_url + path, allow_redirects=False,
+                                            timeout=30, **kwargs)
+        except requests.exceptions.RequestException:
+            return False, time.perf_counter() - started, None
+        seconds = time.perf_counter() - started
+        timing = FIRESTORE_TIMING.search(response.headers.get('Server-Timing', ''))
+        ok = response.status_code == expected
+        if ok and response.status_code == 302:
+            # Bounced to the login page means the session was lost
+            ok = not response.headers.get('Location', '').endswith('/login')
+        return ok, seconds, float(timing.group(1)) if timing else None
+
+    def login(self):
+        self.session.cookies.clear()
+        return self.request('POST', '/login', 302, data={'id_token': emulator_id_token(self.uid)})
+
+    def dashboard(self):
+        return self.request('GET', '/dashboard', 200)
+
+    def patient_detail(self):
+        return self.request('GET', f'/patient/{self.rng.choice(self.workload.patient_ids)}', 200)
+
+    def search_medicines(self):
+        return self.request('GET', '/api/search_medicines', 200,
+                            params={'q': self.rng.choice(self.workload.medicine_queries)})
+
+    def search_patients(self):
+        # The dashboard's search box: a name prefix, rendered as patient cards
+        return self.request('GET', '/api/patients', 200,
+                            params={'name': self.rng.choice(self.workload.patient_queries), 'format': 'html'})
+
+    def prescribe(self):
+        medicine_id, _ = self.rng.choice(self.workload.medicines)
+        return self.request('POST', '/prescribe_medicine', 302, data={
+            'patient_id': self.rng.choice(self.workload.patient_ids), 'medicine_id': medicine_id,
+            'notes': 'load test'
+        })
+
+    def dispense(self):
+        target = self.workload.next_dispense()
+        if target is None:
+            return None
+        patient_id, prescription_id = target
+        # Keyed like the browser's requests, so the dedup check is part of the measured path
+        headers = {'Accept': 'application/json', 'Idempotency-Key': f'{self.rng.getrandbits(128):032x}'}
+        return self.request('POST', '/dispense_medicine', 202, headers=headers,
+                            data={'patient_id': patient_id, 'prescription_id': prescription_id, 'quantity': '1'})
+
+    def run(self, deadline, record):
+        record('login', *self.login())
+        while time.monotonic() < deadline:
+            task = self.rng.choices(self.tasks, self.weights)[0]
+            result = getattr(self, task)()
+            if result is None:
+                # Every seeded prescription has been dispensed
+                task, result = 'patient_detail', self.patient_detail()
+            record(task, *result)
+            if self.think:
+                time.sleep(self.rng.uniform(0, 2 * self.think))
+
+
+def drive(base_url, args, workload):
+    """Run the simulated staff; returns {task: [(ok, seconds, firestore ms), ...]} after warm-up"""
+    # The first search waits for the worker to load the medicine catalog
+    first = VirtualUser(base_url, doctor_ids(args.doctors)[0], 'doctor', workload, random.Random(0), 0)
+    first.login()
+    first.search_medicines()
+
+    results = {}
+    lock = threading.Lock()
+    measure_from = time.monotonic() + args.warmup
+    deadline = measure_from + args.duration
+
+    def record(task, ok, seconds, firestore_ms):
+        if time.monotonic() - seconds < measure_from:
+            return
+        with lock:
+            results.setdefault(task, []).append((ok, seconds, firestore_ms))
+
+    doctors, assistants = doctor_ids(args.doctors), assistant_ids(args.assistants)
+    users = []
+    for number in range(args.users):
+        # Alternate roles so both mixes run at any user count
+        role = 'doctor' if number % 2 == 0 else 'assistant'
+        staff = doctors if role == 'doctor' else assistants
+        users.append(VirtualUser(base_url, staff[number // 2 % len(staff)], role, workload,
+                                 random.Random(100 + number), args.think))
+
+    threads = [threading.Thread(target=user.run, args=(deadline, record)) for user in users]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+# Reporting
+
+def summarize(results, duration):
+    summary = {}
+    for task, samples in sorted(results.items()):
+        latencies = [seconds for ok, seconds, _ in samples if ok]
+        firestore_ms = [value for ok, _, value in samples if ok and value is not None]
+        summary[task] = {
+            'requests': len(samples),
+            'errors': sum(1 for ok, _, _ in samples if not ok),
+            'rps': round(len(latencies) / duration, 2),
+            'p50_ms': round(percentile(latencies, 0.5) * 1000, 2) if latencies else None,
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+            'firestore_p50_ms': round(statistics.median(firestore_ms), 2) if firestore_ms else None,
+        }
+    latencies = [seconds for samples in results.values() for ok, seconds, _ in samples if ok]
+    summary['total'] = {
+        'requests': sum(len(samples) for samples in results.values()),
+        'errors': sum(entry['errors'] for entry in summary.values()),
+        'rps': round(len(latencies) / duration, 2),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 2) if latencies else None,
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+        'firestore_p50_ms': None,
+    }
+    return summary
+
+
+def print_summary(summary):
+    def number(value):
+        return f'{value:.1f}' if value is not None else '-'
+
+    print(f"{'task':>16}  {'requests':>8}  {'req/s':>7}  {'p50 ms':>7}  {'p99 ms':>7}  {'fs p50':>7}  {'errors':>6}")
+    for task, entry in summary.items():
+        print(f"{task:>16}  {entry['requests']:>8}  {entry['rps']:>7.1f}  {number(entry['p50_ms']):>7}  "
+              f"{number(entry['p99_ms']):>7}  {number(entry['firestore_p50_ms']):>7}  {entry['errors']:>6}")
+
+
+def regressions(summary, baseline, tolerance):
+    """Tasks whose p99 grew, or total throughput that fell, by more than tolerance"""
+    found = []
+    for task, entry in summary.items():
+        before = baseline.get('tasks', {}).get(task)
+        if not before or before['p99_ms'] is None or entry['p99_ms'] is None:
+            continue
+        # Ignore sub-millisecond jitter on fast endpoints
+        if entry['p99_ms'] > before['p99_ms'] * (1 + tolerance) and entry['p99_ms'] - before['p99_ms'] > 1:
+            found.append(f"{task}: p99 {before['p99_ms']:.1f} -> {entry['p99_ms']:.1f} ms")
+    before = baseline.get('tasks', {}).get('total')
+    if before and summary['total']['rps'] < before['rps'] * (1 - tolerance):
+        found.append(f"throughput {before['rps']:.1f} -> {summary['total']['rps']:.1f} req/s")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the app against an in-memory Firestore and fake NodeMCU')
+    parser.add_argument('--patients', type=int, default=10000)
+    parser.add_argument('--medicines', type=int, default=20000)
+    parser.add_argument('--doctors', type=int, default=4)
+    parser.add_argument('--assistants', type=int, default=8)
+    parser.add_argument('--users', type=int, default=16, help='concurrent simulated staff')
+    parser.add_argument('--think', type=float, default=0, help='mean seconds between a user\'s requests')
+    parser.add_argument('--duration', type=float, default=60, help='measured seconds')
+    parser.add_argument('--warmup', type=float, default=10, help='seconds of load before measuring')
+    parser.add_argument('--threads', type=int, default=8, help='gunicorn threads')
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--device-port', type=int, default=8085)
+    parser.add_argument('--tablet-delay', type=float, default=fake_nodemcu.TABLET_DELAY)
+    parser.add_argument('--firestore-latency', type=float, default=0, help='simulated ms per Firestore call')
+    parser.add_argument('--snapshot', help='seeded store file (default: one per size in the temp directory)')
+    parser.add_argument('--reseed', action='store_true', help='rebuild the snapshot even if it exists')
+    parser.add_argument('--save', help='write the results as JSON')
+    parser.add_argument('--baseline', help='results JSON of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed regression, as a fraction')
+    args = parser.parse_args()
+
+    snapshot = args.snapshot or os.path.join(
+        tempfile.gettempdir(), f'clinic-{args.patients}p-{args.medicines}m-{args.doctors}d-{args.assistants}a.fs')
+    load_snapshot(snapshot, args)
+
+    env = dict(os.environ, FIRESTORE_FAKE=snapshot, FIRESTORE_FAKE_LATENCY_MS=str(args.firestore_latency),
+               FIREBASE_AUTH_EMULATOR_HOST='127.0.0.1:9099', SECRET_KEY=SECRET_KEY,
+               NODEMCU_IP='127.0.0.1', NODEMCU_PORT=str(args.device_port),
+               WEB_CONCURRENCY='1', GUNICORN_THREADS=str(args.threads), GUNICORN_MAX_REQUESTS='0',
+               GUNICORN_GRACEFUL_TIMEOUT='10', PORT=str(args.port))
+    env.pop('PROMETHEUS_MULTIPROC_DIR', None)
+    log = tempfile.NamedTemporaryFile('w', prefix='benchmark-load-', suffix='.log', delete=False)
+    device = subprocess.Popen([sys.executable, 'fake_nodemcu.py', '--port', str(args.device_port),
+                               '--tablet-delay', str(args.tablet_delay)],
+                              stdout=log, stderr=subprocess.STDOUT)
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', 'app:create_app()'],
+                              env=env, stdout=log, stderr=subprocess.STDOUT)
+    base_url = f'http://127.0.0.1:{args.port}'
+    try:
+        if not (wait_until_ready(f'http://127.0.0.1:{args.device_port}/status')
+                and wait_until_ready(base_url + '/healthz', timeout=60)):
+            print(f"Server or fake NodeMCU did not start; see {log.name}")
+            sys.exit(1)
+        print(f"{args.users} users, {args.warmup:g}s warm-up, {args.duration:g}s measured; server log {log.name}")
+        results = drive(base_url, args, Workload(args))
+    finally:
+        for process in (server, device):
+            process.send_signal(signal.SIGTERM)
+            process.wait()
+
+    summary = summarize(results, args.duration)
+    print_summary(summary)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'config': {key: value for key, value in vars(args).items()
+                                  if key not in ('save', 'baseline', 'snapshot', 'reseed')},
+                       'tasks': summary}, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(summary, json.load(f), args.tolerance)
+        for line in found:
+            print(f"REGRESSION {line}")
+        if found:
+            sys.exit(1)
+        print(f"No regressions beyond {args.tolerance:.0%} against {args.baseline}")
+
+
+if __name__ == '__main__':
+    main()
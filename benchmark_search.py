@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Latency benchmark for medicine search.
+
+Builds a synthetic formulary in memory (no Firestore needed), then times
+MedicineCatalog.search for each kind of query and prints p50/p99 latency:
+
+    python benchmark_search.py --size 50000 --runs 2000
+
+The catalog is a few thousand made-up ingredient names, each in several
+strengths and forms. Queries are drawn from it: exact names, prefixes,
+infixes, ingredient names with one or two typos, and description words.
+"""
+
+import argparse
+import random
+import string
+import time
+
+from medicine_catalog import MedicineCatalog, _medicine_entry
+
+STEMS = ['am', 'ox', 'ci', 'lin', 'met', 'for', 'min', 'pra', 'zol', 'ator', 'va', 'sta', 'lo', 'sar',
+         'cef', 'tri', 'ax', 'par', 'ace', 'ibu', 'pro', 'fen', 'dex', 'meth', 'so', 'ne', 'pan', 'to',
+         'ra', 'gli', 'pi', 'ven', 'ri', 'flu', 'cla', 'na', 'tel', 'de', 'qui', 'bu', 'hy', 'ro']
+SUFFIXES = ['cillin', 'mycin', 'pril', 'sartan', 'statin', 'olol', 'azole', 'tidine', 'prazole', 'vir',
+            'dipine', 'afil', 'oxacin', 'mide', 'pam', 'zide', 'formin', 'cycline', 'triptan', 'sone']
+STRENGTHS = ['5mg', '10mg', '20mg', '25mg', '50mg', '100mg', '250mg', '500mg']
+FORMS = ['tablet', 'capsule', 'syrup', 'injection', 'cream', 'drops', 'inhaler', 'suspension']
+USES = ['pain', 'fever', 'infection', 'blood pressure', 'diabetes', 'cholesterol', 'allergy',
+        'acid reflux', 'asthma', 'inflammation', 'anxiety', 'insomnia', 'nausea', 'cough']
+
+
+def synthetic_medicines(size, seed=0):
+    """A formulary shaped like a real one: a few thousand ingredients in several strengths and forms.
+
+    Returns (medicine ID, medicine fields) pairs.
+    """
+    rng = random.Random(seed)
+    ingredients = set()
+    while len(ingredients) < max(1, size // 12):
+        stem = ''.join(rng.choice(STEMS) for _ in range(rng.randint(1, 3)))
+        ingredients.add(stem + rng.choice(SUFFIXES))
+    ingredients = sorted(ingredients)
+
+    medicines = []
+    for number in range(size):
+        ingredient = rng.choice(ingredients)
+        form = rng.choice(FORMS)
+        name = f'{ingredient.capitalize()} {rng.choice(STRENGTHS)} {form}'
+        description = f'{form.capitalize()} for {rng.choice(USES)}'
+        medicines.append((f'med{number:06d}', {
+            'name': name, 'description': description, 'dosage': '1 tablet', 'frequency': 'Twice daily'
+        }))
+    return medicines
+
+
+def synthetic_catalog(size, seed=0):
+    """Catalog entries for synthetic_medicines()"""
+    return [_medicine_entry(medicine_id, medicine) for medicine_id, medicine in synthetic_medicines(size, seed)]
+
+
+def typo(word, rng, edits):
+    letters = list(word)
+    for _ in range(edits):
+        position = rng.randrange(len(letters))
+        operation = rng.choice(('replace', 'delete', 'insert'))
+        if operation == 'replace':
+            letters[position] = rng.choice(string.ascii_lowercase)
+        elif operation == 'delete' and len(letters) > 4:
+            del letters[position]
+        else:
+            letters.insert(position, rng.choice(string.ascii_lowercase))
+    return ''.join(letters)
+
+
+def query_sets(entries, runs, seed=1):
+    rng = random.Random(seed)
+    words = [entry['name'].split()[0].lower() for entry in entries]
+    long_words = [word for word in words if len(word) >= 6] or words
+    return {
+        'exact': [rng.choice(entries)['name'] for _ in range(runs)],
+        'prefix': [rng.choice(words)[:rng.randint(1, 4)] for _ in range(runs)],
+        'substring': [word[1:5] for word in rng.sample(long_words, min(runs, len(long_words)))],
+        'fuzzy-1': [typo(word, rng, 1) for word in rng.sample(long_words, min(runs, len(long_words)))],
+        'fuzzy-2': [typo(word, rng, 2) for word in rng.sample(long_words, min(runs, len(long_words)))],
+        'description': [rng.choice(USES) for _ in range(runs)],
+        'no-match': [''.join(rng.choice('qxjzvw') for _ in range(8)) for _ in range(runs)],
+    }
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark medicine search latency')
+    parser.add_argument('--size', type=int, default=50000, help='medicines in the synthetic catalog')
+    parser.add_argument('--runs', type=int, default=2000, help='queries per kind')
+    parser.add_argument('--limit', type=int, default=10)
+    args = parser.parse_args()
+
+    entries = synthetic_catalog(args.size)
+    catalog = MedicineCatalog()
+    started = time.perf_counter()
+    catalog._swap(entries)
+    print(f"Indexed {len(catalog)} medicines in {time.perf_counter() - started:.2f}s")
+
+    print(f"{'query':>12}  {'p50 ms':>7}  {'p99 ms':>7}  {'max ms':>7}  {'hits':>5}")
+    for kind, queries in query_sets(entries, args.runs).items():
+        latencies = []
+        hits = 0
+        for query in queries:
+            started = time.perf_counter()
+            results = catalog.search(query, limit=args.limit)
+            latencies.append(time.perf_counter() - started)
+            hits += bool(results)
+        print(f"{kind:>12}  {percentile(latencies, 0.5) * 1000:>7.3f}  {percentile(latencies, 0.99) * 1000:>7.3f}  "
+              f"{max(latencies) * 1000:>7.3f}  {hits / len(queries):>5.0%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark for the production server.
+
+Starts gunicorn (with gunicorn.conf.py) once per worker count, drives one
+endpoint with concurrent keep-alive clients for a fixed time, and prints
+requests/s and latency percentiles for each run:
+
+    python benchmark_wsgi.py --workers 1 2 4 --threads 8 --path /healthz
+
+/healthz does one Firestore read per request, so it shows how far blocking
+I/O scales with processes and threads; /login exercises template rendering
+only.
+"""
+
+import argparse
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+
+
+def wait_until_ready(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return True
+        except requests.exceptions.RequestException:
+            time.sleep(0.2)
+    return False
+
+
+def drive(url, concurrency, duration):
+    """Hit url from `concurrency` threads for `duration` seconds; return latencies and errors"""
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client():
+        session = requests.Session()
+        local = []
+        local_errors = 0
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            try:
+                session.get(url, timeout=30)
+            except requests.exceptions.RequestException:
+                local_errors += 1
+                continue
+            local.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(local)
+            errors[0] += local_errors
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors[0]
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def run(workers, threads, port, path, concurrency, duration):
+    # Worker recycling would show up as connection errors mid-run
+    env = dict(os.environ, WEB_CONCURRENCY=str(workers), GUNICORN_THREADS=str(threads),
+               GUNICORN_MAX_REQUESTS='0', PORT=str(port))
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', 'app:create_app()'],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    url = f'http://127.0.0.1:{port}{path}'
+    try:
+        if not wait_until_ready(url):
+            print(f"{workers:>7}  server did not start")
+            return
+        # Warm every worker up before measuring
+        drive(url, concurrency, 1)
+        latencies, errors = drive(url, concurrency, duration)
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+
+    if not latencies:
+        print(f"{workers:>7}  no successful requests ({errors} errors)")
+        return
+    print(f"{workers:>7}  {threads:>7}  {len(latencies) / duration:>8.1f}  "
+          f"{statistics.median(latencies) * 1000:>7.1f}  {percentile(latencies, 0.99) * 1000:>7.1f}  {errors:>6}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark requests/s against gunicorn worker counts')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--path', default='/healthz')
+    parser.add_argument('--concurrency', type=int, default=32, help='concurrent client connections')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per run')
+    parser.add_argument('--port', type=int, default=5055)
+    args = parser.parse_args()
+
+    print(f"GET {args.path}, {args.concurrency} clients, {args.duration:g}s per run")
+    print(f"{'workers':>7}  {'threads':>7}  {'req/s':>8}  {'p50 ms':>7}  {'p99 ms':>7}  {'errors':>6}")
+    for workers in args.workers:
+        run(workers, args.threads, args.port, args.path, args.concurrency, args.duration)
+
+
+if __name__ == '__main__':
+    main()
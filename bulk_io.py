@@ -0,0 +1,284 @@
+"""
+Bulk import and export of patients and medicines.
+
+Imports stream CSV or JSONL rows, validate each one with the same coercions
+as the add_patient/add_medicine forms, and write them in 500-operation
+WriteBatch chunks committed by a small thread pool. Progress is checkpointed
+in `imports/{import_id}`: documents get IDs derived from the import ID and
+row number, so re-running an interrupted import skips the rows already
+committed. Each chunk also writes a marker, `imports/{import_id}/chunks/
+{first row}-{last row}`, in the same transaction as its documents and the
+summary counters; a chunk that was in flight and did commit is found by its
+marker and not written, or counted, again.
+
+Exports page through a collection ordered by document ID and yield one
+encoded row at a time, so memory use does not grow with the collection.
+"""
+
+import csv
+import io
+import json
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+
+from firebase_admin import firestore
+
+import stats
+
+IMPORTS_COLLECTION = 'imports'
+FORMATS = ('csv', 'jsonl')
+KINDS = ('patients', 'medicines')
+
+# Firestore caps a write batch at 500 operations; chunks also carry their
+# marker and the summary updates (clinic, and assistant for patients)
+BATCH_OPERATIONS = 500
+MAX_REPORTED_ERRORS = 100
+
+EXPORT_FIELDS = {
+    'patients': ['id', 'name', 'age', 'height', 'weight', 'bp', 'temp', 'created_by', 'created_at',
+                 'active_prescription_count'],
+    'medicines': ['id', 'name', 'description', 'dosage', 'frequency', 'created_by', 'created_at']
+}
+
+
+def patient_record(row, created_by, created_at=None):
+    """Build a patient document from form or file fields.
+
+    Raises KeyError for a missing field and ValueError for a bad number.
+    """
+    name = row['name'].strip()
+    if not name:
+        raise ValueError('name is empty')
+    return {
+        'name': name,
+        'lowercase_name': name.lower(),
+        'age': int(row['age']),
+        'height': float(row['height']),
+        'weight': float(row['weight']),
+        'bp': row['bp'],
+        'temp': float(row['temp']),
+        'created_by': created_by,
+        'created_at': created_at or datetime.now(),
+        'active_prescription_count': 0,
+        'has_active_prescriptions': False
+    }
+
+
+def medicine_record(row, created_by, created_at=None):
+    """Build a medicine document from form or file fields"""
+    name = row['name'].strip()
+    if not name:
+        raise ValueError('name is empty')
+    return {
+        'name': name,
+        'description': row['description'],
+        'dosage': row['dosage'],
+        'frequency': row['frequency'],
+        'created_by': created_by,
+        'created_at': created_at or datetime.now()
+    }
+
+
+RECORD_BUILDERS = {'patients': patient_record, 'medicines': medicine_record}
+
+
+def detect_format(filename):
+    extension = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    if extension in ('jsonl', 'ndjson'):
+        return 'jsonl'
+    if extension == 'csv':
+        return 'csv'
+    raise ValueError(f'Unsupported file type: {filename} (use .csv or .jsonl)')
+
+
+def read_rows(text_stream, fmt):
+    """Yield one dict per CSV row, or the text of each JSONL line.
+
+    JSONL lines are decoded by Importer.run, so a malformed line is reported
+    as a row error (numbered by its line) instead of ending the import.
+    """
+    if fmt == 'csv':
+        yield from csv.DictReader(text_stream)
+    else:
+        for line in text_stream:
+            yield line.strip()
+
+
+class Importer:
+    """Writes validated rows of one kind in parallel batches with checkpoints"""
+
+    def __init__(self, db, kind, import_id, created_by, workers=4):
+        if kind not in KINDS:
+            raise ValueError(f'Unknown kind: {kind}')
+        self.db = db
+        self.kind = kind
+        self.import_id = import_id
+        self.created_by = created_by
+        self.workers = workers
+        self.checkpoint_ref = db.collection(IMPORTS_COLLECTION).document(import_id)
+        self.build = RECORD_BUILDERS[kind]
+        summary_writes = 2 if kind == 'patients' and created_by else 1
+        self.chunk_size = BATCH_OPERATIONS - summary_writes - 1
+
+        self._lock = threading.Lock()
+        # chunk number -> (last row covered, documents written)
+        self._done_chunks = {}
+        self._next_chunk = 0
+        self.committed_rows = 0
+        self.imported = 0
+        self.errors = []
+        self.error_count = 0
+
+    def run(self, rows, source=''):
+        """Import rows (dicts, or JSONL lines to decode); returns the checkpoint document"""
+        checkpoint = self.checkpoint_ref.get()
+        state = checkpoint.to_dict() if checkpoint.exists else {}
+        if state.get('kind', self.kind) != self.kind:
+            raise ValueError(f'Import {self.import_id} was started for {state["kind"]}')
+        # Everything before this row is already in Firestore
+        self.committed_rows = resume_from = state.get('committed_rows', 0)
+        self.imported = state.get('imported', 0)
+        # Rows after the checkpoint are validated again, so drop their errors
+        self.errors = [error for error in state.get('errors', []) if error['row'] <= resume_from]
+        self.error_count = max(0, state.get('error_count', 0) - (len(state.get('errors', [])) - len(self.errors)))
+        self._save('running', source=source, started_at=state.get('started_at', datetime.now()))
+
+        created_at = datetime.now()
+        chunk = []
+        last_row = resume_from
+        chunk_number = 0
+        row_number = 0
+        futures = []
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for row_number, row in enumerate(rows, 1):
+                if row_number <= resume_from or row == '':
+                    continue
+                try:
+                    if isinstance(row, str):
+                        row = json.loads(row)
+                    chunk.append((row_number, self.build(row, self.created_by, created_at)))
+                except (KeyError, ValueError, TypeError, AttributeError) as e:
+                    self._record_error(row_number, e)
+                if len(chunk) == self.chunk_size:
+                    futures.append(pool.submit(self._commit, chunk_number, chunk, row_number))
+                    chunk_number += 1
+                    chunk = []
+                    last_row = row_number
+                    # Bound the rows held in memory to what the workers can take
+                    while sum(not f.done() for f in futures) >= self.workers * 2:
+                        wait(futures, return_when=FIRST_COMPLETED)
+            futures.append(pool.submit(self._commit, chunk_number, chunk, max(row_number, last_row)))
+            for future in futures:
+                future.result()
+
+        return self._save('completed', finished_at=datetime.now())
+
+    def _commit(self, chunk_number, chunk, last_row):
+        if chunk:
+            self._write_chunk(chunk)
+
+        with self._lock:
+            self._done_chunks[chunk_number] = (last_row, len(chunk))
+            # Only advance the checkpoint over a gap-free prefix of chunks
+            advanced = False
+            while self._next_chunk in self._done_chunks:
+                self.committed_rows, written = self._done_chunks.pop(self._next_chunk)
+                self.imported += written
+                self._next_chunk += 1
+                advanced = True
+            if advanced:
+                self._save('running')
+
+    def _write_chunk(self, chunk):
+        """Write a chunk's documents and counts once, however often it is retried"""
+        marker_ref = self.checkpoint_ref.collection('chunks').document(f'{chunk[0][0]:07d}-{chunk[-1][0]:07d}')
+        collection = self.db.collection(self.kind)
+
+        @firestore.transactional
+        def write(transaction):
+            if marker_ref.get(transaction=transaction).exists:
+                # Committed by an earlier, interrupted run
+                return
+            for row_number, record in chunk:
+                transaction.set(collection.document(f'{self.import_id}-{row_number:07d}'), record)
+            if self.kind == 'patients':
+                for ref in stats.summary_refs(self.db, self.created_by):
+                    transaction.set(ref, {'patient_count': firestore.Increment(len(chunk))}, merge=True)
+            else:
+                transaction.set(stats.summary_ref(self.db), {'medicine_count': firestore.Increment(len(chunk))},
+                                merge=True)
+            transaction.set(marker_ref, {'rows': len(chunk), 'committed_at': datetime.now()})
+
+        write(self.db.transaction())
+
+    def _record_error(self, row_number, error):
+        with self._lock:
+            self.error_count += 1
+            if len(self.errors) < MAX_REPORTED_ERRORS:
+                self.errors.append({'row': row_number, 'error': f'{type(error).__name__}: {error}'})
+
+    def _save(self, status, **extra):
+        state = {
+            'kind': self.kind,
+            'status': status,
+            'created_by': self.created_by,
+            'committed_rows': self.committed_rows,
+            'imported': self.imported,
+            'error_count': self.error_count,
+            'errors': self.errors,
+            'updated_at': datetime.now(),
+            **extra
+        }
+        self.checkpoint_ref.set(state, merge=True)
+        return state
+
+
+def get_import(db, import_id):
+    doc = db.collection(IMPORTS_COLLECTION).document(import_id).get()
+    if not doc.exists:
+        return None
+    state = doc.to_dict()
+    state['id'] = doc.id
+    return state
+
+
+def _export_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def iter_documents(query, page_size=500):
+    """Yield (id, data) for every document of query, one page in memory at a time"""
+    query = query.order_by('__name__').limit(page_size)
+    last = None
+    while True:
+        page = query.start_after(last) if last is not None else query
+        docs = list(page.stream())
+        for doc in docs:
+            yield doc.id, doc.to_dict()
+        if len(docs) < page_size:
+            return
+        last = docs[-1]
+
+
+def iter_export(query, kind, fmt, page_size=500):
+    """Yield the export of query as CSV or JSONL text, one row per chunk"""
+    fields = EXPORT_FIELDS[kind]
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=fields, extrasaction='ignore')
+        writer.writeheader()
+        yield buffer.getvalue()
+
+    for doc_id, data in iter_documents(query, page_size):
+        row = {'id': doc_id}
+        row.update({field: _export_value(data.get(field)) for field in fields[1:]})
+        if fmt == 'csv':
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerow(row)
+            yield buffer.getvalue()
+        else:
+            yield json.dumps(row) + '\n'
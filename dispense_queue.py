@@ -0,0 +1,333 @@
+"""
+Queued dispensing pipeline.
+
+Talking to a dispenser takes seconds per tablet, so requests no longer wait
+on it. A dispense request is persisted as a `dispense_jobs` document and its
+ID handed to a pool of background worker threads, which claim the job, drive
+a device, and record the outcome on both the job and the prescription. The
+web UI polls the job document for progress.
+
+A claimed job holds a lease (`lease_expires_at`). If its worker dies before
+finishing, the lease runs out: the job is then failed and its prescription
+unlocked, by the next start() or by the next claim on that prescription.
+
+Once the device has dispensed, the job moves to `recording` and keeps the
+prescription locked until the prescription is marked dispensed. A Firestore
+error at that point is retried, and a job still `recording` is picked up
+again by the next start(); it is never failed, as that would let the
+prescription be dispensed a second time.
+
+A request may carry an idempotency key (see idempotency.py); the key is
+reserved in the same write as the job, so a retried request finds the job
+it created the first time instead of queueing another.
+"""
+
+import queue
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from firebase_admin import firestore
+from google.api_core.exceptions import AlreadyExists, FailedPrecondition
+
+import idempotency
+from prescriptions import mark_dispensed, prescriptions_ref, stamped
+
+JOBS_COLLECTION = 'dispense_jobs'
+
+# Job lifecycle: queued -> dispensing -> recording -> completed, or failed
+# before the device dispensed
+QUEUED = 'queued'
+DISPENSING = 'dispensing'
+RECORDING = 'recording'
+COMPLETED = 'completed'
+FAILED = 'failed'
+
+ABANDONED = 'Dispensing was interrupted. Check the dispenser before trying again.'
+
+# Marking a dispensed prescription: attempts per worker, and the first
+# pause between them (doubled each time)
+RECORD_ATTEMPTS = 4
+RECORD_RETRY_SECONDS = 1
+
+
+class DispenseError(Exception):
+    """Raised by a dispatch function when the device did not dispense"""
+
+
+class DispenseQueue:
+    """Persistent dispense job queue served by background worker threads"""
+
+    def __init__(self, dispatch, workers=1, on_dispensed=None, idempotency_keys=None, lease_seconds=300):
+        # dispatch(payload) drives a device, returns the ID of the device used
+        # and raises DispenseError on failure
+        self._dispatch = dispatch
+        # Longer than any dispatch can take, including waiting for a device
+        self.lease_seconds = lease_seconds
+        # on_dispensed(payload) runs after a prescription is marked dispensed
+        self._on_dispensed = on_dispensed
+        self.idempotency_keys = idempotency_keys or idempotency.IdempotencyKeys()
+        self._db = None
+        self._queue = queue.Queue()
+        self._workers = []
+        self.worker_count = max(1, workers)
+
+    def start(self, db, workers=None):
+        """Start the workers, pick up jobs left queued or unrecorded and fail abandoned ones"""
+        self._db = db
+        if workers is not None:
+            self.worker_count = max(1, workers)
+        for number in range(self.worker_count):
+            worker = threading.Thread(target=self._run, name=f'dispense-worker-{number}', daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+        for doc in db.collection(JOBS_COLLECTION).where('status', 'in', [QUEUED, RECORDING]).stream():
+            self._queue.put(doc.id)
+        # Few jobs are dispensing at any time, so the lease is checked here
+        # rather than with another index
+        for doc in db.collection(JOBS_COLLECTION).where('status', '==', DISPENSING).stream():
+            if self._expired(doc.to_dict()):
+                self._abandon(doc.id)
+
+    def stop(self, timeout=30):
+        """Let running jobs finish, then stop the workers.
+
+        Jobs still waiting stay `queued` in Firestore and are picked up by
+        the next start(). Returns False if a worker was still busy at timeout.
+        """
+        # Drop waiting jobs so each worker reaches its stop marker next
+        try:
+            while True:
+                self._queue.get_nowait()
+                self._queue.task_done()
+        except queue.Empty:
+            pass
+        for _ in self._workers:
+            self._queue.put(None)
+
+        deadline = time.monotonic() + timeout
+        for worker in self._workers:
+            worker.join(max(0, deadline - time.monotonic()))
+        stopped = not any(worker.is_alive() for worker in self._workers)
+        self._workers = []
+        return stopped
+
+    def submit(self, patient_id, prescription_id, payload, created_by, idempotency_key=None, key_snapshot=None):
+        """Persist a new job and queue it; returns the job ID.
+
+        With an idempotency_key (key_snapshot being its document as read
+        earlier, if it was), a request that already reserved the key wins and
+        its job ID is returned instead. Raises idempotency.KeyConflict if that
+        request was for another prescription.
+        """
+        job_ref = self._db.collection(JOBS_COLLECTION).document()
+        batch = self._db.batch()
+        batch.set(job_ref, {
+            'patient_id': patient_id,
+            'prescription_id': prescription_id,
+            'payload': payload,
+            'created_by': created_by,
+            'status': QUEUED,
+            'error': None,
+            'created_at': datetime.now()
+        })
+        if idempotency_key:
+            request = {'patient_id': patient_id, 'prescription_id': prescription_id}
+            record = self.idempotency_keys.reserve(batch, self._db, idempotency_key, request,
+                                                   {'job_id': job_ref.id}, key_snapshot)
+        try:
+            batch.commit()
+        except (AlreadyExists, FailedPrecondition):
+            if not idempotency_key:
+                raise
+            # A concurrent retry got there first
+            record = self.idempotency_keys.from_snapshot(idempotency.key_ref(self._db, idempotency_key).get())
+            if record is None:
+                raise
+            return idempotency.check(record, request)['job_id']
+        if idempotency_key:
+            self.idempotency_keys.remember(idempotency_key, record)
+        self._queue.put(job_ref.id)
+        return job_ref.id
+
+    def get(self, job_id):
+        """Return the job document as a dict with its `id`, or None"""
+        doc = self._db.collection(JOBS_COLLECTION).document(job_id).get()
+        if not doc.exists:
+            return None
+        job = doc.to_dict()
+        job['id'] = doc.id
+        return job
+
+    def _run(self):
+        while True:
+            job_id = self._queue.get()
+            if job_id is None:
+                self._queue.task_done()
+                return
+            try:
+                self._process(job_id)
+            except Exception as e:
+                print(f"Dispense job {job_id} crashed: {e}")
+                try:
+                    self._fail(job_id, f'Error dispensing medicine: {str(e)}')
+                except Exception as e:
+                    # The lease frees the prescription once it runs out
+                    print(f"Could not fail dispense job {job_id}: {e}")
+            finally:
+                self._queue.task_done()
+
+    def _process(self, job_id):
+        job = self._claim(job_id)
+        if job is not None and job['status'] == RECORDING:
+            self._record(job_id, job, job.get('device_id'))
+            return
+        if job is None:
+            # Another worker took it, or it could not be run
+            return
+
+        patient_id = job['patient_id']
+        prescription_id = job['prescription_id']
+        payload = job['payload']
+        try:
+            # The job ID lets the device recognize a repeated request
+            device_id = self._dispatch(dict(payload, idempotency_key=job_id))
+        except DispenseError as e:
+            self._fail(job_id, str(e))
+            return
+        self._record(job_id, job, device_id)
+
+    def _record(self, job_id, job, device_id):
+        """Mark the prescription of a job the device has dispensed; never raises.
+
+        The tablets are out, so on failure the job stays `recording` and the
+        prescription locked, for the next start() to try again.
+        """
+        job_ref = self._db.collection(JOBS_COLLECTION).document(job_id)
+        payload = job['payload']
+        dispensed_at = job.get('dispensed_at') or datetime.now()
+        for attempt in range(RECORD_ATTEMPTS):
+            if attempt:
+                time.sleep(RECORD_RETRY_SECONDS * 2 ** (attempt - 1))
+            try:
+                if job['status'] != RECORDING:
+                    job_ref.update({'status': RECORDING, 'device_id': device_id, 'dispensed_at': dispensed_at})
+                    job['status'] = RECORDING
+                dispensed = mark_dispensed(self._db, job['patient_id'], job['prescription_id'], {
+                    'dispensed_at': dispensed_at,
+                    'dispensed_by': payload.get('dispensed_by'),
+                    'quantity_dispensed': payload.get('quantity'),
+                    'device_id': device_id,
+                    'dispense_job_id': firestore.DELETE_FIELD
+                })
+                if dispensed and self._on_dispensed is not None:
+                    self._on_dispensed(payload)
+                self._finish(job_id, COMPLETED, device_id=device_id)
+                return
+            except Exception as e:
+                print(f"Error recording dispense job {job_id} (attempt {attempt + 1}): {e}")
+        print(f"Dispense job {job_id} dispensed but not recorded; retried on the next start")
+
+    def _claim(self, job_id):
+        """Move a job from queued to dispensing and lock its prescription.
+
+        A job left `recording` is returned as it is, to be recorded again.
+
+        Both happen in one transaction, so across all workers and processes
+        a job runs at most once and a prescription is dispensed by at most
+        one job at a time. A lock held by a job that finished or whose lease
+        ran out is taken over (the stale job is failed). Jobs whose
+        prescription is gone, dispensed, or locked by another job are failed
+        here.
+        """
+        jobs = self._db.collection(JOBS_COLLECTION)
+        job_ref = jobs.document(job_id)
+
+        @firestore.transactional
+        def claim(transaction):
+            snapshot = job_ref.get(transaction=transaction)
+            if not snapshot.exists or snapshot.get('status') not in (QUEUED, RECORDING):
+                return None
+            job = snapshot.to_dict()
+            if job['status'] == RECORDING:
+                return job
+
+            prescription_ref = prescriptions_ref(self._db, job['patient_id']).document(job['prescription_id'])
+            prescription = prescription_ref.get(transaction=transaction)
+            holder_id = prescription.to_dict().get('dispense_job_id') if prescription.exists else None
+            holder = jobs.document(holder_id).get(transaction=transaction) if holder_id else None
+            holder_status = holder.get('status') if holder is not None and holder.exists else None
+            abandoned = holder_status == DISPENSING and self._expired(holder.to_dict())
+            # A recording holder has dispensed; its lock is released by marking the prescription
+            locked = holder_status == RECORDING or (holder_status == DISPENSING and not abandoned)
+            if not prescription.exists or prescription.get('status') != 'active' or locked:
+                transaction.update(job_ref, {
+                    'status': FAILED,
+                    'error': 'Prescription not found, already dispensed, or being dispensed.',
+                    'finished_at': datetime.now()
+                })
+                return None
+
+            if abandoned:
+                transaction.update(holder.reference, self._failed(ABANDONED))
+            transaction.update(job_ref, {
+                'status': DISPENSING,
+                'started_at': datetime.now(),
+                'lease_expires_at': datetime.now(timezone.utc) + timedelta(seconds=self.lease_seconds)
+            })
+            transaction.update(prescription_ref, stamped({'dispense_job_id': job_id}))
+            return job
+
+        return claim(self._db.transaction())
+
+    def _fail(self, job_id, error):
+        """Fail a job and unlock its prescription if the job still holds it"""
+        job_ref = self._db.collection(JOBS_COLLECTION).document(job_id)
+
+        @firestore.transactional
+        def fail(transaction):
+            snapshot = job_ref.get(transaction=transaction)
+            if not snapshot.exists:
+                return
+            job = snapshot.to_dict()
+            prescription_ref = prescriptions_ref(self._db, job['patient_id']).document(job['prescription_id'])
+            prescription = prescription_ref.get(transaction=transaction)
+            if prescription.exists and prescription.to_dict().get('dispense_job_id') == job_id:
+                transaction.update(prescription_ref, stamped({'dispense_job_id': firestore.DELETE_FIELD}))
+            transaction.update(job_ref, self._failed(error))
+
+        fail(self._db.transaction())
+
+    def _abandon(self, job_id):
+        """Fail a dispensing job whose lease ran out, unless it finished meanwhile"""
+        job_ref = self._db.collection(JOBS_COLLECTION).document(job_id)
+        try:
+            snapshot = job_ref.get()
+            if snapshot.exists and snapshot.get('status') == DISPENSING and self._expired(snapshot.to_dict()):
+                self._fail(job_id, ABANDONED)
+                print(f"Dispense job {job_id} was abandoned mid-dispense; failed it")
+        except Exception as e:
+            print(f"Error failing abandoned dispense job {job_id}: {e}")
+
+    def _expired(self, job):
+        expires = job.get('lease_expires_at')
+        if expires is None:
+            # Claimed before leases existed
+            started = job.get('started_at')
+            if started is None:
+                return True
+            expires = started + timedelta(seconds=self.lease_seconds)
+        return expires < datetime.now(expires.tzinfo)
+
+    @staticmethod
+    def _failed(error):
+        return {'status': FAILED, 'error': error, 'finished_at': datetime.now()}
+
+    def _finish(self, job_id, status, error=None, device_id=None):
+        self._db.collection(JOBS_COLLECTION).document(job_id).update({
+            'status': status,
+            'error': error,
+            'device_id': device_id,
+            'finished_at': datetime.now()
+        })
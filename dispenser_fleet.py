@@ -0,0 +1,325 @@
+"""
+Registry and scheduler for a fleet of NodeMCU dispensers.
+
+Devices are registered as documents in the `dispensers` collection:
+
+    dispensers/{device_id}: {
+        'host': '192.168.1.101',
+        'port': 80,
+        'capacity': 1,                      # dispenses it can run at once
+        'slots': {'<medicine_id>': 1, ...}, # medicines it carries, by slot
+        'slot_stock': {'<medicine_id>': 40, ...}
+    }
+
+A device without `slots` carries every medicine. Slots listed in
+`slot_stock` have their tablet count tracked: devices whose slot cannot
+cover a dispense are skipped, and each dispense takes its tablets out with
+Increment. Counts are re-read from Firestore on every health poll, so all
+processes converge on the same figures. When no devices are
+registered the fleet falls back to the single NODEMCU_IP device.
+
+Each device's /status endpoint is polled in the background, and dispense
+jobs are sent to the least-loaded healthy device that carries the medicine,
+so throughput grows with the number of devices.
+
+Every web worker process runs dispense workers, so a device's capacity is
+enforced in Firestore rather than per process. A dispense first takes a
+lease on the device in a transaction:
+
+    dispenser_leases/{device_id}: {'holders': {'<job_id>': expires_at, ...}}
+
+A device is full while it has `capacity` unexpired holders. The lease is
+dropped when the dispense ends, or runs out by itself if the process died.
+"""
+
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from firebase_admin import firestore
+from google.cloud.firestore_v1.field_path import FieldPath
+
+from analytics import tablet_count
+from nodemcu_client import CircuitBreaker, DeviceUnavailable, NodeMCUClient, NodeMCUError
+
+
+LEASES_COLLECTION = 'dispenser_leases'
+
+# How often a worker waiting for a device re-checks the leases; releases in
+# other processes are not signalled
+LEASE_RETRY_SECONDS = 1
+
+
+class NoDispenserAvailable(NodeMCUError):
+    """No healthy device carrying the medicine became free in time"""
+
+
+def slot_field(medicine_id):
+    """Update path of a medicine's slot_stock entry; IDs may need quoting"""
+    return FieldPath('slot_stock', medicine_id).to_api_repr()
+
+
+class Dispenser:
+    """One dispensing device and its scheduling state"""
+
+    def __init__(self, device_id, client, capacity=1, slots=None, slot_stock=None):
+        self.device_id = device_id
+        self.client = client
+        self.capacity = max(1, capacity)
+        self.slots = slots
+        self.slot_stock = dict(slot_stock or {})
+        self.in_flight = 0
+        # Leases held on the device by all processes, as of the last look
+        self.leased = 0
+        # Optimistic until the first health check says otherwise
+        self.healthy = True
+        self.last_status = None
+        self.last_checked = None
+
+    def carries(self, medicine_id):
+        return self.slots is None or medicine_id in self.slots
+
+    def has_stock(self, medicine_id, quantity):
+        """False only when the medicine's slot is tracked and holds fewer than quantity"""
+        return self.slot_stock.get(medicine_id, quantity) >= quantity
+
+    def available(self):
+        return self.healthy and self.in_flight < self.capacity
+
+    def to_dict(self):
+        return {
+            'device_id': self.device_id,
+            'url': self.client.base_url,
+            'capacity': self.capacity,
+            'in_flight': self.in_flight,
+            'leased': self.leased,
+            'healthy': self.healthy,
+            'circuit': self.client.breaker.state,
+            'medicines': sorted(self.slots) if self.slots is not None else None,
+            'slot_stock': self.slot_stock,
+            'last_status': self.last_status,
+            'last_checked': self.last_checked
+        }
+
+
+class DispenserFleet:
+    """Load-balancing scheduler over all registered dispensers"""
+
+    def __init__(self, default_host, default_port=80, poll_interval=15, wait_timeout=60, lease_seconds=120,
+                 client_options=None):
+        self.default_host = default_host
+        self.default_port = default_port
+        self.poll_interval = poll_interval
+        self.wait_timeout = wait_timeout
+        # Longer than one dispense can take on a device, retries included
+        self.lease_seconds = lease_seconds
+        self.client_options = client_options or {}
+        self.devices = {}
+        self._db = None
+        self._changed = threading.Condition()
+        self._poller = None
+        self._stopping = threading.Event()
+
+    def start(self, db=None):
+        """Load the registry and start background health polling"""
+        self._db = db
+        if db is not None:
+            for doc in db.collection('dispensers').stream():
+                device = doc.to_dict()
+                self.add(doc.id, device['host'], device.get('port', 80), capacity=device.get('capacity', 1),
+                         slots=device.get('slots'), slot_stock=device.get('slot_stock'))
+        if not self.devices:
+            self.add('default', self.default_host, self.default_port)
+        print(f"Dispenser fleet: {len(self.devices)} device(s), capacity {self.capacity}")
+
+        self._poller = threading.Thread(target=self._poll, name='dispenser-health', daemon=True)
+        self._poller.start()
+
+    def stop(self):
+        """Stop health polling and close every device's connection pool"""
+        self._stopping.set()
+        for device in self.devices.values():
+            device.client.close()
+
+    def add(self, device_id, host, port=80, capacity=1, slots=None, slot_stock=None):
+        client = NodeMCUClient(host, port, **self.client_options)
+        if isinstance(slots, list):
+            # A plain list of medicine IDs fills slots 1..n in order
+            slots = {medicine_id: number for number, medicine_id in enumerate(slots, 1)}
+        self.devices[device_id] = Dispenser(device_id, client, capacity, slots, slot_stock)
+
+    @property
+    def capacity(self):
+        """Total number of dispenses the fleet can run at once"""
+        return sum(device.capacity for device in self.devices.values()) or 1
+
+    def dispense(self, payload):
+        """Dispense on the best device for payload['medicine_id'].
+
+        Blocks until a suitable device is free and the device has finished.
+        Returns (device_id, result).
+        """
+        medicine_id = payload.get('medicine_id')
+        quantity = tablet_count(payload.get('quantity'))
+        carrying = [device for device in self.devices.values() if device.carries(medicine_id)]
+        if carrying and not any(device.has_stock(medicine_id, quantity) for device in carrying):
+            raise NoDispenserAvailable('No dispensing device has enough of this medicine left.')
+        # The job ID, when there is one, keeps a retried job on its own lease
+        holder = payload.get('idempotency_key') or uuid.uuid4().hex
+        device = self._acquire(lambda d: d.carries(medicine_id) and d.has_stock(medicine_id, quantity), holder)
+        try:
+            body = dict(payload)
+            if device.slots is not None:
+                body['slot'] = device.slots[medicine_id]
+            result = device.client.dispense(body)
+            self._take_stock(device, medicine_id, quantity)
+            return device.device_id, result
+        except DeviceUnavailable:
+            device.healthy = False
+            raise
+        finally:
+            self._release(device, holder)
+
+    def send_prescriptions(self, payload):
+        """Send a prescription summary to a healthy device.
+
+        The device only displays it, so no dispense lease is taken: it goes
+        to a device with a closed circuit and the most recent good health
+        check, falling back to the next one if that device cannot be reached.
+        """
+        devices = sorted((device for device in self.devices.values() if device.healthy),
+                         key=lambda d: d.last_checked or datetime.min, reverse=True)
+        devices.sort(key=lambda d: d.client.breaker.state != CircuitBreaker.CLOSED)
+        if not devices:
+            raise NoDispenserAvailable('No dispensing device is reachable.')
+        for device in devices:
+            try:
+                return device.client.send_prescriptions(payload)
+            except DeviceUnavailable as e:
+                device.healthy = False
+                error = e
+        raise error
+
+    def refill(self, device_id, medicine_id, count):
+        """Set the tablet count of a device slot, starting to track it if it was not.
+
+        Raises KeyError for an unknown device.
+        """
+        device = self.devices[device_id]
+        if self._db is not None:
+            self._db.collection('dispensers').document(device_id).update({
+                slot_field(medicine_id): max(0, count)
+            })
+        with self._changed:
+            device.slot_stock[medicine_id] = max(0, count)
+            self._changed.notify_all()
+
+    def refresh_stock(self):
+        """Re-read every device's slot counts from Firestore"""
+        if self._db is None:
+            return
+        for doc in self._db.collection('dispensers').select(['slot_stock']).stream():
+            device = self.devices.get(doc.id)
+            if device is not None:
+                device.slot_stock = dict(doc.to_dict().get('slot_stock') or {})
+
+    def check_health(self):
+        """Poll /status on every device once"""
+        try:
+            self.refresh_stock()
+        except Exception as e:
+            print(f"Error refreshing dispenser slot stock: {e}")
+        for device in list(self.devices.values()):
+            try:
+                device.last_status = device.client.status()
+                device.healthy = True
+            except NodeMCUError:
+                device.healthy = False
+            device.last_checked = datetime.now()
+        with self._changed:
+            self._changed.notify_all()
+
+    def to_list(self):
+        return [device.to_dict() for device in self.devices.values()]
+
+    def _acquire(self, suitable, holder, timeout=None):
+        candidates = [device for device in self.devices.values() if suitable(device)]
+        if not candidates:
+            raise NoDispenserAvailable('No dispensing device carries this medicine.')
+
+        deadline = time.monotonic() + (self.wait_timeout if timeout is None else timeout)
+        while True:
+            for device in sorted(candidates, key=lambda d: (d.leased / d.capacity, d.in_flight / d.capacity)):
+                # This process's share first, then the fleet-wide lease
+                with self._changed:
+                    if not device.available():
+                        continue
+                    device.in_flight += 1
+                try:
+                    if self._lease(device, holder):
+                        return device
+                except Exception as e:
+                    # Contended or unreachable; try again on the next round
+                    print(f"Error leasing {device.device_id}: {e}")
+                with self._changed:
+                    device.in_flight -= 1
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise NoDispenserAvailable('No dispensing device became available in time.')
+            with self._changed:
+                self._changed.wait(min(remaining, LEASE_RETRY_SECONDS))
+
+    def _lease(self, device, holder):
+        """Take one of the device's capacity for holder, across all processes; False if it is full"""
+        if self._db is None:
+            return True
+        ref = self._db.collection(LEASES_COLLECTION).document(device.device_id)
+
+        @firestore.transactional
+        def take(transaction):
+            snapshot = ref.get(transaction=transaction)
+            now = datetime.now(timezone.utc)
+            holders = (snapshot.to_dict() or {}).get('holders') or {}
+            holders = {key: expires for key, expires in holders.items() if expires > now}
+            device.leased = len(holders)
+            if holder not in holders and len(holders) >= device.capacity:
+                return False
+            holders[holder] = now + timedelta(seconds=self.lease_seconds)
+            transaction.set(ref, {'holders': holders})
+            device.leased = len(holders)
+            return True
+
+        return take(self._db.transaction())
+
+    def _take_stock(self, device, medicine_id, quantity):
+        if medicine_id not in device.slot_stock:
+            return
+        device.slot_stock[medicine_id] = max(0, device.slot_stock[medicine_id] - quantity)
+        if self._db is None:
+            return
+        try:
+            self._db.collection('dispensers').document(device.device_id).update({
+                slot_field(medicine_id): firestore.Increment(-quantity)
+            })
+        except Exception as e:
+            # The tablets are out either way; the next refill sets the count
+            print(f"Error updating slot stock on {device.device_id}: {e}")
+
+    def _release(self, device, holder):
+        if self._db is not None:
+            try:
+                self._db.collection(LEASES_COLLECTION).document(device.device_id).update({
+                    FieldPath('holders', holder).to_api_repr(): firestore.DELETE_FIELD
+                })
+            except Exception as e:
+                # It runs out by itself
+                print(f"Error releasing lease on {device.device_id}: {e}")
+        with self._changed:
+            device.in_flight -= 1
+            self._changed.notify_all()
+
+    def _poll(self):
+        while not self._stopping.is_set():
+            self.check_health()
+            self._stopping.wait(self.poll_interval)
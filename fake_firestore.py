@@ -0,0 +1,832 @@
+"""
+In-memory Firestore for benchmarks and local runs without Google Cloud.
+
+With FIRESTORE_FAKE set, firebase_client hands out ordinary
+google-cloud-firestore clients whose RPC layer (the GAPIC `_firestore_api`)
+is this module, so document references, queries, batches, transactions,
+Increment and DELETE_FIELD all go through the real client library and the
+app runs unchanged. Supported: document reads, queries (filters, order_by,
+cursors, offset/limit, projections, collection groups), count/sum/avg
+aggregations, commits with preconditions and field transforms, and
+transactions, which abort on conflicting writes like Firestore's do.
+Snapshot listeners are not: on_snapshot raises, and callers that fall back
+to polling (the medicine catalog) do so.
+
+FIRESTORE_FAKE is either `memory` (start empty) or a snapshot file written
+by save(), which is loaded on first use. The store lives in one process, so
+serve it with a single gunicorn worker. FIRESTORE_FAKE_LATENCY_MS adds a
+fixed delay to every RPC to stand in for the network round trip.
+"""
+
+import asyncio
+import bisect
+import functools
+import math
+import os
+import pickle
+import threading
+import time
+import uuid
+
+from google.api_core.exceptions import Aborted, AlreadyExists, FailedPrecondition, InvalidArgument, NotFound
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import firestore
+from google.cloud.firestore_v1.types import document, firestore as firestore_types, query as query_types
+from google.protobuf.timestamp_pb2 import Timestamp
+
+# "demo-" projects are the Firebase convention for projects that only exist locally
+PROJECT = 'demo-clinic'
+DATABASE = f'projects/{PROJECT}/databases/(default)'
+DOCUMENTS_ROOT = DATABASE + '/documents'
+
+Document = document.Document.pb()
+Value = document.Value.pb()
+FieldFilter = query_types.StructuredQuery.FieldFilter.Operator
+UnaryFilter = query_types.StructuredQuery.UnaryFilter.Operator
+DESCENDING = query_types.StructuredQuery.Direction.DESCENDING
+
+NAME_FIELD = '__name__'
+INEQUALITY_OPERATORS = (FieldFilter.LESS_THAN, FieldFilter.LESS_THAN_OR_EQUAL, FieldFilter.GREATER_THAN,
+                        FieldFilter.GREATER_THAN_OR_EQUAL, FieldFilter.NOT_EQUAL, FieldFilter.NOT_IN)
+
+# Firestore's ordering of value types
+NULL, BOOLEAN, NUMBER, TIMESTAMP, STRING, BYTES, REFERENCE, GEO_POINT, ARRAY, MAP = range(10)
+NAN_KEY = (NUMBER, 0, 0)
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_field_path(path):
+    """Split a field path into its segments; segments may be `backtick` quoted"""
+    segments = []
+    current = []
+    quoted = False
+    escaped = False
+    for char in path:
+        if escaped:
+            current.append(char)
+            escaped = False
+        elif quoted and char == '\\':
+            escaped = True
+        elif char == '`':
+            quoted = not quoted
+        elif char == '.' and not quoted:
+            segments.append(''.join(current))
+            current = []
+        else:
+            current.append(char)
+    segments.append(''.join(current))
+    return tuple(segments)
+
+
+def value_key(value):
+    """Sort key of a Value: type rank first, then the value, as Firestore orders them"""
+    kind = value.WhichOneof('value_type')
+    if kind == 'integer_value':
+        return (NUMBER, 1, value.integer_value)
+    if kind == 'double_value':
+        return NAN_KEY if math.isnan(value.double_value) else (NUMBER, 1, value.double_value)
+    if kind == 'string_value':
+        return (STRING, value.string_value)
+    if kind == 'timestamp_value':
+        return (TIMESTAMP, value.timestamp_value.seconds, value.timestamp_value.nanos)
+    if kind == 'boolean_value':
+        return (BOOLEAN, value.boolean_value)
+    if kind == 'reference_value':
+        return (REFERENCE, tuple(value.reference_value.split('/')))
+    if kind == 'array_value':
+        return (ARRAY, tuple(value_key(item) for item in value.array_value.values))
+    if kind == 'map_value':
+        return (MAP, tuple(sorted((name, value_key(item)) for name, item in value.map_value.fields.items())))
+    if kind == 'bytes_value':
+        return (BYTES, value.bytes_value)
+    if kind == 'geo_point_value':
+        return (GEO_POINT, value.geo_point_value.latitude, value.geo_point_value.longitude)
+    return (NULL,)
+
+
+@functools.total_ordering
+class _Descending:
+    """Inverts the order of a sort key"""
+
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+
+def _lookup(fields, segments):
+    """Value at a field path in a Document's fields, or None"""
+    value = None
+    for segment in segments:
+        if value is not None:
+            if value.WhichOneof('value_type') != 'map_value':
+                return None
+            fields = value.map_value.fields
+        if segment not in fields:
+            return None
+        value = fields[segment]
+    return value
+
+
+def _set(fields, segments, value):
+    for segment in segments[:-1]:
+        parent = fields[segment]
+        if parent.WhichOneof('value_type') != 'map_value':
+            parent.Clear()
+            parent.map_value.SetInParent()
+        fields = parent.map_value.fields
+    fields[segments[-1]].CopyFrom(value)
+
+
+def _delete(fields, segments):
+    for segment in segments[:-1]:
+        if segment not in fields or fields[segment].WhichOneof('value_type') != 'map_value':
+            return
+        fields = fields[segment].map_value.fields
+    if segments[-1] in fields:
+        del fields[segments[-1]]
+
+
+class _Doc:
+    """A stored Document; replaced, never modified, on write"""
+
+    __slots__ = ('pb', 'keys')
+
+    def __init__(self, pb):
+        self.pb = pb
+        # field path -> sort key, filled in by queries
+        self.keys = {}
+
+    def key(self, path):
+        try:
+            return self.keys[path]
+        except KeyError:
+            pass
+        if path == NAME_FIELD:
+            key = (REFERENCE, tuple(self.pb.name.split('/')))
+        else:
+            value = _lookup(self.pb.fields, parse_field_path(path))
+            key = value_key(value) if value is not None else None
+        self.keys[path] = key
+        return key
+
+
+def _split_name(name):
+    """(collection path, document id) of a full document name"""
+    if not name.startswith(DOCUMENTS_ROOT + '/'):
+        raise InvalidArgument(f'Document name not in {DATABASE}: {name}')
+    collection, _, document_id = name[len(DOCUMENTS_ROOT) + 1:].rpartition('/')
+    return collection, document_id
+
+
+def _number(value):
+    kind = value.WhichOneof('value_type') if value is not None else None
+    if kind == 'integer_value':
+        return value.integer_value
+    if kind == 'double_value':
+        return value.double_value
+    return None
+
+
+def _number_value(number):
+    return Value(integer_value=number) if isinstance(number, int) else Value(double_value=number)
+
+
+class FakeStore:
+    """Documents by collection path, plus open transactions; thread-safe"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = threading.RLock()
+        # collection path -> {document id: _Doc}
+        self.collections = {}
+        # collection path -> {orders: _Index}, built by the first query in that order
+        self.indexes = {}
+        # transaction id -> {document name: update_time read, or None if missing}
+        self.transactions = {}
+        self._last_time = 0
+
+    def __len__(self):
+        return sum(len(documents) for documents in self.collections.values())
+
+    def timestamp(self):
+        """Strictly increasing commit/read time, at microsecond precision like Firestore's"""
+        with self.lock:
+            micros = max(time.time_ns() // 1000, self._last_time + 1)
+            self._last_time = micros
+        stamp = Timestamp()
+        stamp.FromMicroseconds(micros)
+        return stamp
+
+    def get(self, name):
+        collection, document_id = _split_name(name)
+        return self.collections.get(collection, {}).get(document_id)
+
+    # Persistence
+
+    def save(self, path):
+        with self.lock:
+            documents = [doc.pb.SerializeToString() for docs in self.collections.values() for doc in docs.values()]
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(documents, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+        return len(documents)
+
+    def load(self, path):
+        with open(path, 'rb') as f:
+            documents = pickle.load(f)
+        with self.lock:
+            self.indexes = {}
+            for data in documents:
+                pb = Document.FromString(data)
+                collection, document_id = _split_name(pb.name)
+                self.collections.setdefault(collection, {})[document_id] = _Doc(pb)
+        return len(documents)
+
+    # Transactions
+
+    def begin(self, options):
+        transaction = uuid.uuid4().bytes
+        with self.lock:
+            # Read-only transactions never commit, so there is nothing to check
+            self.transactions[transaction] = None if options.HasField('read_only') else {}
+        return transaction
+
+    def _track(self, transaction, name, doc):
+        reads = self.transactions.get(transaction) if transaction else None
+        if reads is not None and name not in reads:
+            reads[name] = doc.pb.update_time.ToMicroseconds() if doc is not None else None
+
+    def rollback(self, transaction):
+        with self.lock:
+            self.transactions.pop(transaction, None)
+
+    # Reads
+
+    def batch_get(self, request):
+        mask = [parse_field_path(path) for path in request.mask.field_paths] if request.HasField('mask') else None
+        transaction = self._read_transaction(request)
+        responses = []
+        with self.lock:
+            read_time = self.timestamp()
+            for name in request.documents:
+                doc = self.get(name)
+                self._track(transaction, name, doc)
+                response = firestore_types.BatchGetDocumentsResponse.pb()(read_time=read_time)
+                if doc is None:
+                    response.missing = name
+                else:
+                    response.found.CopyFrom(_project(doc.pb, mask))
+                responses.append(response)
+        if request.HasField('new_transaction') and responses:
+            responses[0].transaction = transaction
+        return [firestore_types.BatchGetDocumentsResponse.wrap(response) for response in responses]
+
+    def run_query(self, request):
+        transaction = self._read_transaction(request)
+        structured = request.structured_query
+        mask = None
+        if structured.HasField('select'):
+            mask = [parse_field_path(field.field_path) for field in structured.select.fields
+                    if field.field_path != NAME_FIELD]
+        with self.lock:
+            read_time = self.timestamp()
+            results = self._query(request.parent, structured)
+            for doc in results:
+                self._track(transaction, doc.pb.name, doc)
+        responses = []
+        for doc in results:
+            response = firestore_types.RunQueryResponse.pb()(read_time=read_time)
+            response.document.CopyFrom(_project(doc.pb, mask))
+            responses.append(response)
+        if not responses:
+            # Firestore always sends the read time, even for no results
+            responses.append(firestore_types.RunQueryResponse.pb()(read_time=read_time))
+        if request.HasField('new_transaction'):
+            responses[0].transaction = transaction
+        return [firestore_types.RunQueryResponse.wrap(response) for response in responses]
+
+    def run_aggregation_query(self, request):
+        transaction = self._read_transaction(request)
+        aggregation_query = request.structured_aggregation_query
+        with self.lock:
+            read_time = self.timestamp()
+            results = self._query(request.parent, aggregation_query.structured_query)
+            for doc in results:
+                self._track(transaction, doc.pb.name, doc)
+        response = firestore_types.RunAggregationQueryResponse.pb()(read_time=read_time)
+        for aggregation in aggregation_query.aggregations:
+            response.result.aggregate_fields[aggregation.alias].CopyFrom(_aggregate(aggregation, results))
+        if request.HasField('new_transaction'):
+            response.transaction = transaction
+        return [firestore_types.RunAggregationQueryResponse.wrap(response)]
+
+    def _read_transaction(self, request):
+        if request.HasField('new_transaction'):
+            return self.begin(request.new_transaction)
+        return request.transaction or None
+
+    def _query(self, parent, structured):
+        if len(structured.from_) != 1:
+            raise InvalidArgument('Queries must select exactly one collection')
+        selector = structured.from_[0]
+        if parent == DOCUMENTS_ROOT:
+            prefix = ''
+        else:
+            prefix = parent[len(DOCUMENTS_ROOT) + 1:] + '/'
+        orders = _orders(structured)
+
+        if selector.all_descendants:
+            documents = [doc for collection, docs in self.collections.items()
+                         if collection.startswith(prefix) and collection.rpartition('/')[2] == selector.collection_id
+                         for doc in docs.values()]
+            index = _Index(orders, documents)
+        else:
+            # Indexes are kept per collection and order, like Firestore's
+            collection = prefix + selector.collection_id
+            indexes = self.indexes.setdefault(collection, {})
+            index = indexes.get(tuple(orders))
+            if index is None:
+                index = indexes[tuple(orders)] = _Index(orders, self.collections.get(collection, {}).values())
+
+        matches = _compile_filter(structured.where) if structured.HasField('where') else None
+        wanted = structured.offset + structured.limit.value if structured.HasField('limit') else None
+        results = []
+        for doc in index.scan(structured):
+            if matches is None or matches(doc):
+                results.append(doc)
+                if len(results) == wanted:
+                    break
+        return results[structured.offset:]
+
+    # Writes
+
+    def commit(self, request):
+        with self.lock:
+            transaction = request.transaction or None
+            if transaction is not None:
+                if transaction not in self.transactions:
+                    raise InvalidArgument('Transaction is not open (already committed or rolled back)')
+                reads = self.transactions.pop(transaction) or {}
+                for name, read_at in reads.items():
+                    doc = self.get(name)
+                    if (doc.pb.update_time.ToMicroseconds() if doc is not None else None) != read_at:
+                        raise Aborted(f'Transaction lost a race: {name} was written after it was read')
+
+            commit_time = self.timestamp()
+            response = firestore_types.CommitResponse.pb()(commit_time=commit_time)
+            # All writes are checked and built before any is stored
+            staged = {}
+            for write in request.writes:
+                name, doc, transform_results = self._apply(write, staged, commit_time)
+                staged[name] = doc
+                result = response.write_results.add(update_time=commit_time)
+                result.transform_results.extend(transform_results)
+
+            for name, doc in staged.items():
+                collection, document_id = _split_name(name)
+                documents = self.collections.setdefault(collection, {})
+                old = documents.pop(document_id, None)
+                if doc is not None:
+                    doc = documents[document_id] = _Doc(doc)
+                for index in self.indexes.get(collection, {}).values():
+                    if old is not None:
+                        index.remove(old)
+                    if doc is not None:
+                        index.add(doc)
+        return firestore_types.CommitResponse.wrap(response)
+
+    def _apply(self, write, staged, commit_time):
+        """Check one write's precondition and build the document it leaves behind"""
+        operation = write.WhichOneof('operation')
+        if operation == 'delete':
+            name = write.delete
+        elif operation == 'update':
+            name = write.update.name
+        else:
+            name = write.transform.document
+
+        if name in staged:
+            current = staged[name]
+        else:
+            doc = self.get(name)
+            current = doc.pb if doc is not None else None
+
+        if write.HasField('current_document'):
+            precondition = write.current_document
+            if precondition.WhichOneof('condition_type') == 'exists':
+                if precondition.exists and current is None:
+                    raise NotFound(f'No document to update: {name}')
+                if not precondition.exists and current is not None:
+                    raise AlreadyExists(f'Document already exists: {name}')
+            elif current is None or current.update_time != precondition.update_time:
+                raise FailedPrecondition(f'Document was modified: {name}')
+
+        if operation == 'delete':
+            return name, None, []
+
+        new = Document(name=name)
+        if operation == 'update':
+            if write.HasField('update_mask'):
+                if current is not None:
+                    new.fields.MergeFrom(current.fields)
+                for path in write.update_mask.field_paths:
+                    segments = parse_field_path(path)
+                    value = _lookup(write.update.fields, segments)
+                    if value is not None:
+                        _set(new.fields, segments, value)
+                    else:
+                        _delete(new.fields, segments)
+            else:
+                new.fields.MergeFrom(write.update.fields)
+        elif current is not None:
+            new.fields.MergeFrom(current.fields)
+
+        transforms = list(write.update_transforms)
+        if operation == 'transform':
+            transforms.extend(write.transform.field_transforms)
+        transform_results = [_transform(new.fields, transform, commit_time) for transform in transforms]
+
+        new.create_time.CopyFrom(current.create_time if current is not None else commit_time)
+        new.update_time.CopyFrom(commit_time)
+        return name, new, transform_results
+
+
+def _project(pb, mask):
+    """The document, or only the masked fields of it"""
+    if mask is None:
+        return pb
+    projected = Document(name=pb.name, create_time=pb.create_time, update_time=pb.update_time)
+    for segments in mask:
+        value = _lookup(pb.fields, segments)
+        if value is not None:
+            _set(projected.fields, segments, value)
+    return projected
+
+
+def _transform(fields, transform, commit_time):
+    """Apply one FieldTransform in place; returns the transform result Value"""
+    segments = parse_field_path(transform.field_path)
+    current = _lookup(fields, segments)
+    kind = transform.WhichOneof('transform_type')
+    if kind == 'set_to_server_value':
+        result = Value(timestamp_value=commit_time)
+    elif kind in ('increment', 'maximum', 'minimum'):
+        operand = getattr(transform, kind)
+        existing, amount = _number(current), _number(operand)
+        if existing is None:
+            result = operand
+        elif kind == 'increment':
+            result = _number_value(existing + amount)
+        elif (amount > existing) == (kind == 'maximum') and amount != existing:
+            result = operand
+        else:
+            result = current
+    else:
+        existing = list(current.array_value.values) if current is not None and current.HasField('array_value') else []
+        elements = getattr(transform, kind).values
+        keys = {value_key(element) for element in elements}
+        if kind == 'append_missing_elements':
+            present = {value_key(item) for item in existing}
+            for element in elements:
+                if value_key(element) not in present:
+                    existing.append(element)
+                    present.add(value_key(element))
+        else:
+            existing = [item for item in existing if value_key(item) not in keys]
+        result = Value()
+        result.array_value.SetInParent()
+        result.array_value.values.extend(existing)
+    # result may be a field of the document itself; keep a copy to return
+    copied = Value()
+    copied.CopyFrom(result)
+    _set(fields, segments, copied)
+    return copied
+
+
+def _orders(structured):
+    """Explicit orderings plus the implicit ones Firestore adds, as (field, descending)"""
+    orders = [(order.field.field_path, order.direction == DESCENDING) for order in structured.order_by]
+    if not orders and structured.HasField('where'):
+        inequalities = sorted(_inequality_fields(structured.where))
+        orders = [(field, False) for field in inequalities]
+    if not orders or orders[-1][0] != NAME_FIELD:
+        orders.append((NAME_FIELD, orders[-1][1] if orders else False))
+    return orders
+
+
+def _inequality_fields(where):
+    kind = where.WhichOneof('filter_type')
+    if kind == 'composite_filter':
+        return {field for child in where.composite_filter.filters for field in _inequality_fields(child)}
+    if kind == 'field_filter' and where.field_filter.op in INEQUALITY_OPERATORS:
+        return {where.field_filter.field.field_path}
+    return set()
+
+
+def _compile_filter(where):
+    """Predicate on a _Doc for a StructuredQuery.Filter"""
+    kind = where.WhichOneof('filter_type')
+    if kind == 'composite_filter':
+        children = [_compile_filter(child) for child in where.composite_filter.filters]
+        if where.composite_filter.op == query_types.StructuredQuery.CompositeFilter.Operator.OR:
+            return lambda doc: any(child(doc) for child in children)
+        return lambda doc: all(child(doc) for child in children)
+
+    if kind == 'unary_filter':
+        path = where.unary_filter.field.field_path
+        op = where.unary_filter.op
+        if op == UnaryFilter.IS_NULL:
+            return lambda doc: doc.key(path) == (NULL,)
+        if op == UnaryFilter.IS_NAN:
+            return lambda doc: doc.key(path) == NAN_KEY
+        if op == UnaryFilter.IS_NOT_NULL:
+            return lambda doc: doc.key(path) not in (None, (NULL,))
+        return lambda doc: doc.key(path) is not None and doc.key(path)[0] == NUMBER and doc.key(path) != NAN_KEY
+
+    field_filter = where.field_filter
+    path = field_filter.field.field_path
+    op = field_filter.op
+    target = value_key(field_filter.value)
+
+    if op == FieldFilter.EQUAL:
+        return lambda doc: doc.key(path) == target
+    if op == FieldFilter.NOT_EQUAL:
+        return lambda doc: doc.key(path) not in (None, (NULL,), target)
+    if op in (FieldFilter.IN, FieldFilter.NOT_IN, FieldFilter.ARRAY_CONTAINS_ANY):
+        targets = set(target[1])
+        if op == FieldFilter.IN:
+            return lambda doc: doc.key(path) in targets
+        if op == FieldFilter.NOT_IN:
+            return lambda doc: doc.key(path) not in (None, (NULL,)) and doc.key(path) not in targets
+        return lambda doc: (doc.key(path) or (None,))[0] == ARRAY and not targets.isdisjoint(doc.key(path)[1])
+    if op == FieldFilter.ARRAY_CONTAINS:
+        return lambda doc: (doc.key(path) or (None,))[0] == ARRAY and target in doc.key(path)[1]
+
+    compare = {
+        FieldFilter.LESS_THAN: lambda key: key < target,
+        FieldFilter.LESS_THAN_OR_EQUAL: lambda key: key <= target,
+        FieldFilter.GREATER_THAN: lambda key: key > target,
+        FieldFilter.GREATER_THAN_OR_EQUAL: lambda key: key >= target,
+    }[op]
+    # Range filters only match values of the same type
+    return lambda doc: doc.key(path) is not None and doc.key(path)[0] == target[0] and compare(doc.key(path))
+
+
+class _Top:
+    """Sorts after every key, so bound + (_TOP,) ends the keys that start with bound"""
+
+    def __lt__(self, other):
+        return False
+
+    def __gt__(self, other):
+        return True
+
+
+_TOP = _Top()
+
+
+class _Index:
+    """Documents of one collection in one query order, kept sorted as they change.
+
+    Documents missing an ordered field are left out, as Firestore does.
+    When every order is descending the keys are stored ascending and scanned
+    backwards, which saves wrapping each of them in _Descending.
+    """
+
+    def __init__(self, orders, documents):
+        self.orders = tuple(orders)
+        self.reverse = all(descending for _, descending in orders)
+        self.mixed = not self.reverse and any(descending for _, descending in orders)
+        self.fields = [field for field, _ in orders if field != NAME_FIELD]
+        entries = sorted(((self.key(doc), doc) for doc in documents if self.covers(doc)), key=lambda entry: entry[0])
+        self.keys = [key for key, _ in entries]
+        self.docs = [doc for _, doc in entries]
+
+    def covers(self, doc):
+        return all(doc.key(field) is not None for field in self.fields)
+
+    def key(self, doc):
+        key = doc.keys.get(self.orders)
+        if key is None:
+            key = self.bound([doc.key(field) for field, _ in self.orders])
+            doc.keys[self.orders] = key
+        return key
+
+    def bound(self, keys):
+        """Index key for the given per-field sort keys (a prefix of them for cursors)"""
+        if not self.mixed:
+            return tuple(keys)
+        return tuple(_Descending(key) if descending else key for key, (_, descending) in zip(keys, self.orders))
+
+    def add(self, doc):
+        if self.covers(doc):
+            key = self.key(doc)
+            position = bisect.bisect_left(self.keys, key)
+            self.keys.insert(position, key)
+            self.docs.insert(position, doc)
+
+    def remove(self, doc):
+        if self.covers(doc):
+            position = bisect.bisect_left(self.keys, self.key(doc))
+            if position < len(self.keys) and self.docs[position] is doc:
+                del self.keys[position]
+                del self.docs[position]
+
+    def scan(self, structured):
+        """Documents in query order, limited to the cursors and any range on the first ordered field"""
+        low, high = 0, len(self.keys)
+
+        def first_at(prefix):
+            return bisect.bisect_left(self.keys, prefix)
+
+        def first_after(prefix):
+            return bisect.bisect_left(self.keys, prefix + (_TOP,))
+
+        for name, is_start in (('start_at', True), ('end_at', False)):
+            if not structured.HasField(name):
+                continue
+            cursor = getattr(structured, name)
+            prefix = self.bound([value_key(value) for value in cursor.values])
+            # start_at and end_at include the cursor position; start_after and end_before do not
+            inclusive = cursor.before == is_start
+            if is_start != self.reverse:
+                low = max(low, first_at(prefix) if inclusive else first_after(prefix))
+            else:
+                high = min(high, first_after(prefix) if inclusive else first_at(prefix))
+
+        if not self.mixed and structured.HasField('where') and self.fields:
+            for op, key in _ranges(structured.where, self.orders[0][0]):
+                if op in (FieldFilter.GREATER_THAN_OR_EQUAL, FieldFilter.EQUAL):
+                    low = max(low, first_at((key,)))
+                elif op == FieldFilter.GREATER_THAN:
+                    low = max(low, first_after((key,)))
+                if op in (FieldFilter.LESS_THAN_OR_EQUAL, FieldFilter.EQUAL):
+                    high = min(high, first_after((key,)))
+                elif op == FieldFilter.LESS_THAN:
+                    high = min(high, first_at((key,)))
+
+        if self.reverse:
+            return (self.docs[position] for position in range(high - 1, low - 1, -1))
+        return (self.docs[position] for position in range(low, high))
+
+
+def _ranges(where, field):
+    """(operator, key) of the comparisons on field that every result must satisfy"""
+    kind = where.WhichOneof('filter_type')
+    if kind == 'composite_filter':
+        if where.composite_filter.op == query_types.StructuredQuery.CompositeFilter.Operator.OR:
+            return []
+        return [entry for child in where.composite_filter.filters for entry in _ranges(child, field)]
+    if kind == 'field_filter' and where.field_filter.field.field_path == field:
+        return [(where.field_filter.op, value_key(where.field_filter.value))]
+    return []
+
+
+def _aggregate(aggregation, results):
+    kind = aggregation.WhichOneof('operator')
+    if kind == 'count':
+        count = len(results)
+        if aggregation.count.HasField('up_to'):
+            count = min(count, aggregation.count.up_to.value)
+        return Value(integer_value=count)
+    path = getattr(aggregation, kind).field.field_path
+    numbers = [_number(_lookup(doc.pb.fields, parse_field_path(path))) for doc in results]
+    numbers = [number for number in numbers if number is not None]
+    if kind == 'sum':
+        return _number_value(sum(numbers))
+    if not numbers:
+        return Value(null_value=0)
+    return Value(double_value=sum(numbers) / len(numbers))
+
+
+class _Transport:
+    """What the client library reaches for beyond the RPC methods"""
+
+    @property
+    def listen(self):
+        raise NotImplementedError('Snapshot listeners are not supported by the in-memory Firestore')
+
+
+class FakeFirestoreApi:
+    """Stands in for the GAPIC FirestoreClient of a Client"""
+
+    def __init__(self, store):
+        self._store = store
+        self._transport = _Transport()
+
+    def _wait(self):
+        if self._store.latency:
+            time.sleep(self._store.latency)
+
+    def batch_get_documents(self, request, metadata=None, **kwargs):
+        self._wait()
+        return iter(self._store.batch_get(firestore_types.BatchGetDocumentsRequest.pb(
+            firestore_types.BatchGetDocumentsRequest(request))))
+
+    def run_query(self, request, metadata=None, **kwargs):
+        self._wait()
+        return iter(self._store.run_query(firestore_types.RunQueryRequest.pb(
+            firestore_types.RunQueryRequest(request))))
+
+    def run_aggregation_query(self, request, metadata=None, **kwargs):
+        self._wait()
+        return iter(self._store.run_aggregation_query(firestore_types.RunAggregationQueryRequest.pb(
+            firestore_types.RunAggregationQueryRequest(request))))
+
+    def begin_transaction(self, request, metadata=None, **kwargs):
+        self._wait()
+        request = firestore_types.BeginTransactionRequest.pb(firestore_types.BeginTransactionRequest(request))
+        return firestore_types.BeginTransactionResponse(transaction=self._store.begin(request.options))
+
+    def commit(self, request, metadata=None, **kwargs):
+        self._wait()
+        return self._store.commit(firestore_types.CommitRequest.pb(firestore_types.CommitRequest(request)))
+
+    def rollback(self, request, metadata=None, **kwargs):
+        self._wait()
+        self._store.rollback(firestore_types.RollbackRequest(request).transaction)
+
+
+async def _stream(responses):
+    for response in responses:
+        yield response
+
+
+class FakeFirestoreAsyncApi(FakeFirestoreApi):
+    """Stands in for the GAPIC FirestoreAsyncClient of an AsyncClient"""
+
+    async def _wait(self):
+        if self._store.latency:
+            await asyncio.sleep(self._store.latency)
+
+    async def batch_get_documents(self, request, metadata=None, **kwargs):
+        await self._wait()
+        return _stream(self._store.batch_get(firestore_types.BatchGetDocumentsRequest.pb(
+            firestore_types.BatchGetDocumentsRequest(request))))
+
+    async def run_query(self, request, metadata=None, **kwargs):
+        await self._wait()
+        return _stream(self._store.run_query(firestore_types.RunQueryRequest.pb(
+            firestore_types.RunQueryRequest(request))))
+
+    async def run_aggregation_query(self, request, metadata=None, **kwargs):
+        await self._wait()
+        return _stream(self._store.run_aggregation_query(firestore_types.RunAggregationQueryRequest.pb(
+            firestore_types.RunAggregationQueryRequest(request))))
+
+    async def begin_transaction(self, request, metadata=None, **kwargs):
+        await self._wait()
+        request = firestore_types.BeginTransactionRequest.pb(firestore_types.BeginTransactionRequest(request))
+        return firestore_types.BeginTransactionResponse(transaction=self._store.begin(request.options))
+
+    async def commit(self, request, metadata=None, **kwargs):
+        await self._wait()
+        return self._store.commit(firestore_types.CommitRequest.pb(firestore_types.CommitRequest(request)))
+
+    async def rollback(self, request, metadata=None, **kwargs):
+        await self._wait()
+        self._store.rollback(firestore_types.RollbackRequest(request).transaction)
+
+
+_lock = threading.Lock()
+_stores = {}
+_async_clients = {}
+
+
+def get_store(source):
+    """The process-wide store for a FIRESTORE_FAKE value, loading its snapshot on first use"""
+    with _lock:
+        store = _stores.get(source)
+        if store is None:
+            store = FakeStore(latency=float(os.environ.get('FIRESTORE_FAKE_LATENCY_MS', 0)) / 1000)
+            if source != 'memory' and os.path.exists(source):
+                print(f"In-memory Firestore loaded {store.load(source)} documents from {source}")
+            _stores[source] = store
+    return store
+
+
+def client(source='memory'):
+    """A google.cloud.firestore.Client backed by the in-memory store"""
+    fake = firestore.Client(project=PROJECT, credentials=AnonymousCredentials())
+    fake._firestore_api_internal = FakeFirestoreApi(get_store(source))
+    return fake
+
+
+def async_client(source='memory'):
+    """A google.cloud.firestore.AsyncClient backed by the same store as client()"""
+    # There is no gRPC channel to tie it to a loop, so one per store will do
+    with _lock:
+        fake = _async_clients.get(source)
+    if fake is None:
+        fake = firestore.AsyncClient(project=PROJECT, credentials=AnonymousCredentials())
+        fake._firestore_api_internal = FakeFirestoreAsyncApi(get_store(source))
+        with _lock:
+            fake = _async_clients.setdefault(source, fake)
+    return fake
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""
+Fake NodeMCU dispenser for local testing.
+
+Serves the same HTTP API as nodmcu_servo_control.ino (/, /status, /dispense,
+/prescriptions) and reproduces its timing: /dispense queues the job and
+replies 202 with a job ID, each tablet then takes about 1.7 s, and /status
+reports progress while dispensing. A repeated idempotency_key returns the
+original job, as the sketch's ring buffer of recent keys does. Point the app (or test_nodmcu.py) at it
+with NODEMCU_IP/NODEMCU_PORT.
+
+    python fake_nodemcu.py --port 8080
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import msgpack
+
+# Matches the sketch: 1000 ms hold + 500 ms return + 200 ms LED blink
+TABLET_DELAY = 1.7
+# The sketch acknowledges /prescriptions immediately and blinks afterwards
+PRESCRIPTIONS_DELAY = 0
+MAX_TABLETS = 10
+JOB_QUEUE_SIZE = 4
+RECENT_KEYS_SIZE = 16
+MAX_KEY_LENGTH = 40
+MAX_BODY_SIZE = 4096
+MAX_PRESCRIPTIONS = 10
+
+
+class FakeDevice:
+    """Dispenser state shared by all request handler threads"""
+
+    def __init__(self, tablet_delay=TABLET_DELAY, prescriptions_delay=PRESCRIPTIONS_DELAY):
+        self.tablet_delay = tablet_delay
+        self.prescriptions_delay = prescriptions_delay
+        self.started_at = time.monotonic()
+        self.boot_id = random.getrandbits(32)
+        self.servo_position = 0
+        self.dispensed_total = 0
+        self.queue = deque()
+        self.current_job = None
+        self.tablets_done = 0
+        self.next_job_id = 1
+        self.last_completed_job = 0
+        # idempotency_key -> job ID, oldest first
+        self.recent_keys = deque(maxlen=RECENT_KEYS_SIZE)
+        self.lock = threading.Condition()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    @property
+    def dispensing(self):
+        return self.current_job is not None
+
+    def enqueue(self, quantity, medicine, key=''):
+        """Queue a job; returns (job_id, position) or None when the queue is full.
+
+        A key seen recently returns its original job with position None.
+        """
+        with self.lock:
+            for recent, job_id in self.recent_keys:
+                if key and recent == key:
+                    return job_id, None
+            if len(self.queue) >= JOB_QUEUE_SIZE:
+                return None
+            job = {'id': self.next_job_id, 'quantity': quantity, 'medicine': medicine}
+            self.next_job_id += 1
+            self.queue.append(job)
+            if key:
+                self.recent_keys.append((key, job['id']))
+            position = len(self.queue) - 1 + (1 if self.dispensing else 0)
+            self.lock.notify()
+            return job['id'], position
+
+    def status(self, ip):
+        with self.lock:
+            status = {
+                'status': 'online',
+                'ip': ip,
+                'uptime': int(time.monotonic() - self.started_at),
+                'dispensing': self.dispensing,
+                'servo_position': self.servo_position,
+                'boot_id': self.boot_id,
+                'queued': len(self.queue),
+                'last_completed_job': self.last_completed_job,
+                'idempotent_dispense': True
+            }
+            if self.current_job is not None:
+                status['job'] = {
+                    'id': self.current_job['id'],
+                    'medicine': self.current_job['medicine'],
+                    'tablets_done': self.tablets_done,
+                    'tablets_remaining': self.current_job['quantity'] - self.tablets_done
+                }
+            return status
+
+    def _run(self):
+        # Plays the role of the firmware's loop()-driven state machine
+        while True:
+            with self.lock:
+                while not self.queue:
+                    self.lock.wait()
+                self.current_job = self.queue.popleft()
+                self.tablets_done = 0
+
+            for _ in range(self.current_job['quantity']):
+                self.servo_position = 90
+                time.sleep(self.tablet_delay)
+                self.servo_position = 0
+                with self.lock:
+                    self.tablets_done += 1
+
+            with self.lock:
+                self.dispensed_total += self.current_job['quantity']
+                self.last_completed_job = self.current_job['id']
+                self.current_job = None
+
+
+def make_handler(device):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            if self.path == '/':
+                self._send(200, '<html><body><h1>Medical Dispensing System (fake)</h1></body></html>', 'text/html')
+            elif self.path == '/status':
+                self._send_json(200, device.status(self.server.server_address[0]))
+            else:
+                self._send_json(404, {'error': 'Endpoint not found'})
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            if length > MAX_BODY_SIZE:
+                # The unread body would be parsed as the next request
+                self.close_connection = True
+                self._send_json(413, {'error': 'Request body too large'})
+                return
+            body = self._read_body(length)
+            if body is None:
+                self._send_json(400, {'error': 'Invalid request body'})
+                return
+            if self.path == '/dispense':
+                self._dispense(body)
+            elif self.path == '/prescriptions':
+                time.sleep(device.prescriptions_delay)
+                self._send_json(200, {
+                    'status': 'received',
+                    'message': 'Prescriptions received successfully',
+                    'patient': body.get('patient_name', ''),
+                    'count': len(body.get('prescriptions', [])[:MAX_PRESCRIPTIONS])
+                })
+            else:
+                self._send_json(404, {'error': 'Endpoint not found'})
+
+        def _dispense(self, body):
+            try:
+                quantity = int(body.get('quantity', 1))
+            except (TypeError, ValueError):
+                quantity = 1
+            quantity = max(1, min(quantity, MAX_TABLETS))
+            key = str(body.get('idempotency_key') or '')
+            if len(key) > MAX_KEY_LENGTH:
+                self._send_json(400, {'error': 'idempotency_key too long'})
+                return
+
+            accepted = device.enqueue(quantity, body.get('medicine_name', 'manual'), key)
+            if accepted is None:
+                self._send_json(503, {'error': 'Dispense queue full'})
+                return
+
+            job_id, position = accepted
+            if position is None:
+                self._send_json(202, {
+                    'status': 'completed' if job_id <= device.last_completed_job else 'queued',
+                    'job_id': job_id,
+                    'boot_id': device.boot_id,
+                    'repeated': True
+                })
+                return
+            self._send_json(202, {
+                'status': 'queued',
+                'job_id': job_id,
+                'boot_id': device.boot_id,
+                'quantity': quantity,
+                'position': position
+            })
+
+        def _read_body(self, length):
+            """Decode a JSON or MessagePack body; None if it is malformed"""
+            if not length:
+                return {}
+            raw = self.rfile.read(length)
+            try:
+                if self.headers.get('Content-Type', '').startswith('application/msgpack'):
+                    body = msgpack.unpackb(raw, raw=False)
+                else:
+                    body = json.loads(raw)
+            except ValueError:
+                return None
+            return body if isinstance(body, dict) else None
+
+        def _send_json(self, status, data):
+            self._send(status, json.dumps(data), 'application/json')
+
+        def _send(self, status, text, content_type):
+            payload = text.encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            print(f"[fake-nodemcu] {self.address_string()} {format % args}")
+
+    return Handler
+
+
+def serve(host='127.0.0.1', port=8080, tablet_delay=TABLET_DELAY, prescriptions_delay=PRESCRIPTIONS_DELAY):
+    """Create a fake device server; call serve_forever() or run it in a thread"""
+    device = FakeDevice(tablet_delay, prescriptions_delay)
+    server = ThreadingHTTPServer((host, port), make_handler(device))
+    server.daemon_threads = True
+    server.device = device
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake NodeMCU dispenser')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--tablet-delay', type=float, default=TABLET_DELAY,
+                        help='seconds per dispensed tablet')
+    parser.add_argument('--prescriptions-delay', type=float, default=PRESCRIPTIONS_DELAY,
+                        help='seconds spent acknowledging /prescriptions')
+    args = parser.parse_args()
+
+    server = serve(args.host, args.port, args.tablet_delay, args.prescriptions_delay)
+    print(f"Fake NodeMCU listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+"""
+Lazily initialized Firebase Admin app and Firestore client.
+
+Nothing here talks to Firebase at import time. The Admin app and the
+Firestore client are created on first use, once per process, so importing
+the app is fast, a Firestore outage cannot stop it from booting, and the
+gRPC channel is only opened in the process (or forked worker) that uses it.
+
+Async views use an AsyncClient instead. Its gRPC channel is tied to the
+event loop it was created on, while Flask runs each async view on a fresh
+loop, so the AsyncClient lives on one long-lived loop thread per process and
+views hand their Firestore coroutines to it with run_async().
+
+With FIRESTORE_FAKE set, both clients use the in-memory store in
+fake_firestore.py instead of Google Cloud; benchmark_load.py runs the app
+that way.
+"""
+
+import asyncio
+import os
+import threading
+
+import firebase_admin
+from firebase_admin import credentials, firestore, firestore_async
+
+from instrumentation import instrument_firestore
+
+SERVICE_ACCOUNT_FILE = 'firebase-service-account.json'
+REQUIRED_ENV_VARS = ['FIREBASE_PROJECT_ID', 'FIREBASE_PRIVATE_KEY_ID', 'FIREBASE_PRIVATE_KEY',
+                     'FIREBASE_CLIENT_EMAIL', 'FIREBASE_CLIENT_ID']
+
+_lock = threading.Lock()
+_client = None
+_async_loop = None
+
+
+class FirebaseConfigError(Exception):
+    """Firebase credentials are missing or incomplete"""
+
+
+def load_credentials():
+    """Build service account credentials from the environment or the local key file"""
+    # Check if we're in production (Render) or development
+    if os.environ.get('FIREBASE_PROJECT_ID'):
+        # Production: Use environment variables
+        missing_vars = [var for var in REQUIRED_ENV_VARS if not os.environ.get(var)]
+        if missing_vars:
+            raise FirebaseConfigError(f'Missing environment variables: {missing_vars}')
+
+        firebase_config = {
+            "type": "service_account",
+            "project_id": os.environ.get('FIREBASE_PROJECT_ID'),
+            "private_key_id": os.environ.get('FIREBASE_PRIVATE_KEY_ID'),
+            "private_key": os.environ.get('FIREBASE_PRIVATE_KEY').replace('\\n', '\n'),
+            "client_email": os.environ.get('FIREBASE_CLIENT_EMAIL'),
+            "client_id": os.environ.get('FIREBASE_CLIENT_ID'),
+            "auth_uri": os.environ.get('FIREBASE_AUTH_URI', 'https://accounts.google.com/o/oauth2/auth'),
+            "token_uri": os.environ.get('FIREBASE_TOKEN_URI', 'https://oauth2.googleapis.com/token')
+        }
+        print(f"Firebase credentials from environment for project {firebase_config['project_id']}")
+        return credentials.Certificate(firebase_config)
+
+    # Development: Use local file
+    if not os.path.exists(SERVICE_ACCOUNT_FILE):
+        raise FirebaseConfigError(f'{SERVICE_ACCOUNT_FILE} not found and FIREBASE_PROJECT_ID is not set')
+    print(f"Firebase credentials loaded from {SERVICE_ACCOUNT_FILE}")
+    return credentials.Certificate(SERVICE_ACCOUNT_FILE)
+
+
+def fake_firestore_source():
+    """FIRESTORE_FAKE: `memory` or a snapshot file for the in-memory store, or None"""
+    return os.environ.get('FIRESTORE_FAKE') or None
+
+
+def get_firebase_app():
+    """Return the default Firebase Admin app, initializing it on first use"""
+    try:
+        return firebase_admin.get_app()
+    except ValueError:
+        pass
+    with _lock:
+        try:
+            return firebase_admin.get_app()
+        except ValueError:
+            if fake_firestore_source():
+                # No credentials needed; ID tokens only verify against the Auth
+                # emulator (FIREBASE_AUTH_EMULATOR_HOST)
+                import fake_firestore
+                app = firebase_admin.initialize_app(options={'projectId': fake_firestore.PROJECT})
+            else:
+                app = firebase_admin.initialize_app(load_credentials())
+            print("Firebase Admin SDK initialized")
+            return app
+
+
+def get_db():
+    """Return the process-wide Firestore client, creating it on first use"""
+    global _client
+    if _client is None:
+        source = fake_firestore_source()
+        firebase_app = get_firebase_app() if source is None else None
+        with _lock:
+            if _client is None:
+                if source is not None:
+                    import fake_firestore
+                    _client = instrument_firestore(fake_firestore.client(source))
+                    print(f"Using the in-memory Firestore ({source})")
+                else:
+                    _client = instrument_firestore(firestore.client(firebase_app))
+                    print("Firestore client created")
+    return _client
+
+
+def _get_async_loop():
+    global _async_loop
+    if _async_loop is None:
+        with _lock:
+            if _async_loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name='firestore-async', daemon=True).start()
+                _async_loop = loop
+    return _async_loop
+
+
+async def _call_with_async_db(coroutine_function, args):
+    # Runs on the loop thread, so the AsyncClient is created on (and bound to) that loop
+    source = fake_firestore_source()
+    if source is not None:
+        import fake_firestore
+        async_db = instrument_firestore(fake_firestore.async_client(source))
+    else:
+        async_db = instrument_firestore(firestore_async.client(get_firebase_app()))
+    return await coroutine_function(async_db, *args)
+
+
+async def run_async(coroutine_function, *args):
+    """Await coroutine_function(async_db, *args) on the shared Firestore loop.
+
+    Use asyncio.gather inside coroutine_function to run independent reads
+    concurrently.
+    """
+    future = asyncio.run_coroutine_threadsafe(_call_with_async_db(coroutine_function, args), _get_async_loop())
+    return await asyncio.wrap_future(future)
+
+
+def reset_after_fork():
+    """Forget any client inherited from a parent process.
+
+    gRPC channels cannot be used across fork(); a worker that inherited a
+    client (e.g. the master touched Firestore before forking) builds its
+    own on first use instead.
+    """
+    global _client, _async_loop
+    _client = None
+    # The loop's thread did not survive the fork either
+    _async_loop = None
+    try:
+        firebase_admin.delete_app(firebase_admin.get_app())
+    except ValueError:
+        pass
+
+
+def check_firestore(timeout=5):
+    """Read-only connectivity probe: one document read, no retries.
+
+    Returns None when Firestore answered, otherwise the error message.
+    """
+    try:
+        get_db().collection('healthz').document('probe').get(retry=None, timeout=timeout)
+        return None
+    except Exception as e:
+        return f'{type(e).__name__}: {e}'
+
+
+class LazyFirestore:
+    """Stand-in for the Firestore client that creates it on first attribute access"""
+
+    def __getattr__(self, name):
+        return getattr(get_db(), name)
+
+
+db = LazyFirestore()
@@ -0,0 +1,74 @@
+"""
+Gunicorn configuration for production serving.
+
+    gunicorn "app:create_app()"
+
+Gunicorn picks this file up automatically from the working directory.
+Requests spend most of their time waiting on Firestore or a dispenser, so
+each worker process runs a pool of threads (gthread) rather than one request
+at a time. gevent is not used: the Firestore client is gRPC-based and does
+not cooperate with gevent's monkey patching.
+
+Tune with WEB_CONCURRENCY (worker processes) and GUNICORN_THREADS (threads
+per worker); see benchmark_wsgi.py for measuring the effect.
+"""
+
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_CONCURRENCY', min(multiprocessing.cpu_count() * 2 + 1, 8)))
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+# Importing the app does not touch Firebase, so it is safe to load it once in
+# the master and fork workers from it
+preload_app = True
+
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+# Time a worker gets after SIGTERM to finish requests and in-flight dispenses
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+
+# Recycle workers now and then to bound memory growth
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = 100
+
+accesslog = '-'
+errorlog = '-'
+
+
+def on_starting(server):
+    # Metrics files left by a previous run would be added to this one's
+    directory = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if name.endswith('.db'):
+                os.remove(os.path.join(directory, name))
+
+
+def post_fork(server, worker):
+    # A gRPC channel created before fork() is unusable in the child
+    import firebase_client
+    firebase_client.reset_after_fork()
+
+
+def post_worker_init(worker):
+    # Start listeners and dispense workers now rather than on the first
+    # request, off the main thread so a slow Firestore cannot delay serving
+    import threading
+    from app import start_services
+    threading.Thread(target=start_services, name='start-services', daemon=True).start()
+
+
+def worker_exit(server, worker):
+    from app import stop_services
+    stop_services(timeout=graceful_timeout)
+
+
+def child_exit(server, worker):
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
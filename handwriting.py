@@ -0,0 +1,329 @@
+"""
+Server-side handwriting recognition for the prescribe form.
+
+The browser sends the strokes drawn on the handwriting canvas (or a PNG of
+it) and gets back medicine candidates in one round-trip. Recognition is
+CPU-bound, so it runs in a small process pool rather than on the web
+worker's threads. Requests that arrive while the pool is busy, or within a
+few milliseconds of each other, are stacked into one page and read by a
+single Tesseract run, which pays the model load once per batch instead of
+once per request. Each line read is then matched against the medicine
+catalog, so results are limited to names that exist in `medicines`.
+
+Tesseract must be installed on the host (`apt-get install tesseract-ocr`);
+without it the recognizer reports itself unavailable.
+"""
+
+import base64
+import io
+import multiprocessing
+import queue
+import shutil
+import string
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import pytesseract
+from PIL import Image, ImageDraw, ImageOps
+
+# Every input is normalized to this text height, then padded, before stacking
+LINE_HEIGHT = 64
+PADDING = 16
+BAND_HEIGHT = LINE_HEIGHT + 2 * PADDING
+
+MAX_IMAGE_BYTES = 2 * 1024 * 1024
+# A small compressed PNG can still decode to a huge bitmap
+MAX_IMAGE_PIXELS = 4096 * 4096
+MAX_POINTS = 20000
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# Longer lines are squeezed to this width so one input cannot blow up a page
+MAX_LINE_WIDTH = 4096
+
+# Medicine names are letters, digits and hyphens; words are split on spaces
+TESSERACT_CONFIG = '--psm 6 -c tessedit_char_whitelist=' + string.ascii_letters + string.digits + '-'
+
+# How much a catalog match of each kind is worth; description hits are not
+# readings of a name and are left out
+MATCH_WEIGHTS = {'exact': 1.0, 'prefix': 0.9, 'substring': 0.75, 'fuzzy': 0.6}
+
+
+class RecognizerUnavailable(Exception):
+    """Tesseract is not installed or the recognizer has been stopped"""
+
+
+class UnreadableInput(Exception):
+    """One job of a batch could not be prepared; the rest of the batch is read"""
+
+
+def parse_strokes(strokes):
+    """Validate canvas strokes: a list of strokes, each a list of {x, y} or [x, y] points"""
+    if not isinstance(strokes, list) or not strokes:
+        raise ValueError('strokes must be a non-empty list')
+    parsed = []
+    points = 0
+    for stroke in strokes:
+        if not isinstance(stroke, list) or not stroke:
+            raise ValueError('each stroke must be a non-empty list of points')
+        points += len(stroke)
+        if points > MAX_POINTS:
+            raise ValueError(f'too many points (max {MAX_POINTS})')
+        try:
+            parsed.append([(float(point['x']), float(point['y'])) if isinstance(point, dict)
+                           else (float(point[0]), float(point[1])) for point in stroke])
+        except (KeyError, IndexError, TypeError, ValueError):
+            raise ValueError('points must be {x, y} objects or [x, y] pairs')
+    return ('strokes', parsed)
+
+
+def parse_png(data):
+    """Validate PNG bytes, or a base64 data URL of them"""
+    if isinstance(data, str):
+        if data.startswith('data:'):
+            data = data.split(',', 1)[-1]
+        try:
+            data = base64.b64decode(data, validate=True)
+        except ValueError:
+            raise ValueError('image is not valid base64')
+    if len(data) > MAX_IMAGE_BYTES:
+        raise ValueError(f'image is larger than {MAX_IMAGE_BYTES // 1024} KB')
+    if not data.startswith(PNG_SIGNATURE):
+        raise ValueError('image must be a PNG')
+    # Decode it here, so a corrupt image is rejected before it joins a batch
+    try:
+        image = Image.open(io.BytesIO(data))
+        if image.width * image.height > MAX_IMAGE_PIXELS:
+            raise ValueError(f'image is larger than {MAX_IMAGE_PIXELS} pixels')
+        # verify() checks the chunk checksums but leaves the image unusable
+        image.verify()
+        Image.open(io.BytesIO(data)).load()
+    except (OSError, SyntaxError, Image.DecompressionBombError):
+        raise ValueError('image is not a valid PNG')
+    return ('png', data)
+
+
+def _scale_to_line(image):
+    """Crop to the ink and scale it to LINE_HEIGHT, on a white background"""
+    # Ink is dark on light; getbbox looks for non-zero pixels, so invert first
+    box = ImageOps.invert(image).getbbox()
+    if box is None:
+        return Image.new('L', (LINE_HEIGHT, LINE_HEIGHT), 255)
+    image = image.crop(box)
+    width = min(MAX_LINE_WIDTH, max(1, round(image.width * LINE_HEIGHT / image.height)))
+    return image.resize((width, LINE_HEIGHT), Image.LANCZOS)
+
+
+def _render_strokes(strokes):
+    xs = [x for stroke in strokes for x, _ in stroke]
+    ys = [y for stroke in strokes for _, y in stroke]
+    left, top = min(xs), min(ys)
+    # Draw at the target height directly so the pen width is consistent
+    scale = LINE_HEIGHT / max(max(ys) - top, 1)
+    pen = max(2, LINE_HEIGHT // 16)
+    # Very long lines are squeezed horizontally instead
+    scale_x = min(scale, MAX_LINE_WIDTH / max(max(xs) - left, 1))
+    width = round((max(xs) - left) * scale_x) + 2 * pen + 1
+    image = Image.new('L', (width, LINE_HEIGHT + 2 * pen + 1), 255)
+    draw = ImageDraw.Draw(image)
+    for stroke in strokes:
+        points = [((x - left) * scale_x + pen, (y - top) * scale + pen) for x, y in stroke]
+        if len(points) == 1:
+            x, y = points[0]
+            draw.ellipse((x - pen / 2, y - pen / 2, x + pen / 2, y + pen / 2), fill=0)
+        else:
+            draw.line(points, fill=0, width=pen, joint='curve')
+    return _scale_to_line(image)
+
+
+def _load_png(data):
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    if image.mode in ('RGBA', 'LA', 'P'):
+        # Canvas exports are transparent where nothing was drawn
+        image = image.convert('RGBA')
+        background = Image.new('RGBA', image.size, (255, 255, 255, 255))
+        image = Image.alpha_composite(background, image)
+    image = ImageOps.autocontrast(image.convert('L'))
+    return _scale_to_line(image.point(lambda value: 0 if value < 128 else 255))
+
+
+def _prepare(kind, payload):
+    try:
+        return _render_strokes(payload) if kind == 'strokes' else _load_png(payload)
+    except Exception as e:
+        print(f"Could not prepare a {kind} input: {e}")
+        return UnreadableInput('Could not read this handwriting input.')
+
+
+def recognize_batch(jobs):
+    """Read each job (from parse_strokes/parse_png); runs in a pool process.
+
+    Returns one (text, confidence) pair per job, confidence in 0..1, or an
+    UnreadableInput for a job that could not be prepared, so one bad input
+    does not fail the others.
+    """
+    prepared = [_prepare(kind, payload) for kind, payload in jobs]
+    lines = [line for line in prepared if not isinstance(line, UnreadableInput)]
+    if not lines:
+        return prepared
+
+    # One input per horizontal band of a single page
+    page = Image.new('L', (max(line.width for line in lines) + 2 * PADDING, BAND_HEIGHT * len(lines)), 255)
+    for band, line in enumerate(lines):
+        page.paste(line, (PADDING, band * BAND_HEIGHT + PADDING))
+
+    data = pytesseract.image_to_data(page, config=TESSERACT_CONFIG, output_type=pytesseract.Output.DICT)
+    words = [[] for _ in lines]
+    for text, conf, left, top, height in zip(data['text'], data['conf'], data['left'], data['top'], data['height']):
+        text = text.strip()
+        if not text or float(conf) < 0:
+            continue
+        band = min(len(lines) - 1, int((top + height / 2) // BAND_HEIGHT))
+        words[band].append((left, text, float(conf) / 100))
+
+    read = []
+    for band_words in words:
+        band_words.sort()
+        text = ' '.join(word for _, word, _ in band_words)
+        confidence = sum(conf for _, _, conf in band_words) / len(band_words) if band_words else 0.0
+        read.append((text, round(confidence, 3)))
+    read = iter(read)
+    return [line if isinstance(line, UnreadableInput) else next(read) for line in prepared]
+
+
+def rank_medicines(catalog, text, confidence, limit=5):
+    """Match recognized text against the catalog; best candidates first.
+
+    The whole line and each word of it are searched, so a stray mark read
+    as an extra word does not hide the medicine name. Each candidate's
+    score combines the kind of catalog match with the OCR confidence.
+    """
+    queries = [text] + [word for word in text.split() if len(word) >= 3 and word != text]
+    scored = {}
+    for query in queries:
+        for position, medicine in enumerate(catalog.search(query, limit=limit)):
+            weight = MATCH_WEIGHTS.get(medicine['match'])
+            if weight is None:
+                continue
+            score = round(weight * (0.5 + confidence / 2), 3)
+            # Keep the catalog's order within equal scores
+            key = (score, -position)
+            if medicine['id'] not in scored or key > scored[medicine['id']][0]:
+                scored[medicine['id']] = (key, dict(medicine, score=score))
+    ranked = sorted(scored.values(), key=lambda item: item[0], reverse=True)
+    return [medicine for _, medicine in ranked[:limit]]
+
+
+class HandwritingRecognizer:
+    """Micro-batches recognition requests onto a process pool.
+
+    A batcher thread takes the first waiting request, waits for a free pool
+    process, then sweeps up whatever else arrived (up to max_batch, waiting
+    at most max_wait seconds) and sends them as one batch. Under load the
+    batches grow on their own; an idle server answers a lone request after
+    max_wait.
+    """
+
+    def __init__(self, workers=1, max_batch=8, max_wait=0.02):
+        self.workers = max(1, workers)
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._slots = threading.Semaphore(self.workers)
+        self._lock = threading.Lock()
+        self._pool = None
+        self._thread = None
+        self._stopped = False
+
+    @property
+    def available(self):
+        return shutil.which(pytesseract.pytesseract.tesseract_cmd) is not None
+
+    def recognize(self, job, timeout=15):
+        """Return (text, confidence) for one parsed job; blocks until its batch is read"""
+        self._ensure_started()
+        future = Future()
+        self._queue.put((job, future))
+        return future.result(timeout)
+
+    def stop(self):
+        """Stop the batcher and the pool; waiting requests fail with RecognizerUnavailable"""
+        with self._lock:
+            self._stopped = True
+            if self._thread is None:
+                return
+            self._queue.put(None)
+            self._thread.join(5)
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._thread = None
+            self._pool = None
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._stopped:
+                raise RecognizerUnavailable('Handwriting recognizer is stopped')
+            if self._thread is not None:
+                return
+            if not self.available:
+                raise RecognizerUnavailable('Tesseract is not installed on this server')
+            # Spawned, not forked: a fork of this process would inherit gRPC threads
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+            self._thread = threading.Thread(target=self._run, name='handwriting-batcher', daemon=True)
+            self._thread.start()
+            print(f"Handwriting recognizer started with {self.workers} process(es)")
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            # Requests keep queuing up while every pool process is busy
+            self._slots.acquire()
+            batch = [item]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    # Send what we have, then stop
+                    self._queue.put(None)
+                    break
+                batch.append(item)
+            self._dispatch(batch)
+
+        # Fail anything that arrived after the stop marker
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is not None:
+                item[1].set_exception(RecognizerUnavailable('Handwriting recognizer is stopped'))
+
+    def _dispatch(self, batch):
+        try:
+            pool_future = self._pool.submit(recognize_batch, [job for job, _ in batch])
+        except Exception as e:
+            self._slots.release()
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        pool_future.add_done_callback(lambda done: self._resolve(batch, done))
+
+    def _resolve(self, batch, pool_future):
+        self._slots.release()
+        try:
+            results = pool_future.result()
+        except BaseException as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if isinstance(result, UnreadableInput):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
@@ -0,0 +1,107 @@
+"""
+Idempotency keys for requests that must not take effect twice.
+
+A client sends a random key with a request (the `Idempotency-Key` header)
+and reuses it when retrying. The first request to commit records what it
+did under that key, in the same write as its effect:
+
+    idempotency_keys/{key}: {
+        'request': {...},      # what was asked; a reused key must match
+        'result': {...},       # what the retry is answered with
+        'expires_at': datetime
+    }
+
+Firestore's TTL policy on `expires_at` removes old keys. A per-process
+cache answers repeats that reach the same worker without a read.
+"""
+
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+KEYS_COLLECTION = 'idempotency_keys'
+
+# Also a valid Firestore document ID
+KEY_PATTERN = re.compile(r'^[A-Za-z0-9_-]{16,64}$')
+
+
+class KeyConflict(Exception):
+    """The key was already used for a different request"""
+
+
+def valid_key(key):
+    return bool(key) and KEY_PATTERN.match(key) is not None
+
+
+def key_ref(db, key):
+    return db.collection(KEYS_COLLECTION).document(key)
+
+
+class IdempotencyKeys:
+    """Recently used keys: a TTL cache in front of the Firestore table"""
+
+    def __init__(self, ttl=86400, max_size=4096):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def cached(self, key):
+        """The record of key if this process has seen it recently, else None"""
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return None
+            expires, record = entry
+            if expires < time.monotonic():
+                del self._cache[key]
+                return None
+            self._cache.move_to_end(key)
+            return record
+
+    def remember(self, key, record):
+        with self._lock:
+            self._cache[key] = (time.monotonic() + self.ttl, record)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+    def from_snapshot(self, snapshot):
+        """The record in a key document, or None if it is missing or expired"""
+        if not snapshot.exists:
+            return None
+        record = snapshot.to_dict()
+        # TTL deletion can lag expiry by a day
+        if record['expires_at'] < datetime.now(timezone.utc):
+            return None
+        record = {'request': record['request'], 'result': record['result']}
+        self.remember(snapshot.id, record)
+        return record
+
+    def reserve(self, writer, db, key, request, result, snapshot=None):
+        """Add the creation of key to a batch or transaction.
+
+        snapshot is the key document as read before, if any; an expired one
+        is replaced. Committing fails (AlreadyExists or FailedPrecondition
+        from google.api_core.exceptions) when another request reserved the
+        key first. Returns the record, to pass to remember() once committed.
+        """
+        data = {
+            'request': request,
+            'result': result,
+            'expires_at': datetime.now(timezone.utc) + timedelta(seconds=self.ttl)
+        }
+        if snapshot is not None and snapshot.exists:
+            writer.update(key_ref(db, key), data, option=db.write_option(last_update_time=snapshot.update_time))
+        else:
+            writer.create(key_ref(db, key), data)
+        return {'request': request, 'result': result}
+
+
+def check(record, request):
+    """The stored result for a repeated request; raises KeyConflict if it differs"""
+    if record['request'] != request:
+        raise KeyConflict('Idempotency key was already used for a different request.')
+    return record['result']
@@ -0,0 +1,320 @@
+"""
+Request instrumentation: Prometheus metrics, Server-Timing and an opt-in profiler.
+
+Every Firestore RPC (sync and async clients) and every NodeMCU HTTP call is
+timed and counted, along with the documents and bytes it returned. Totals go
+to the Prometheus metrics served at /metrics; the part spent on behalf of
+the current request is also added to its response as a Server-Timing
+header, next to Jinja rendering and the total:
+
+    Server-Timing: firestore;dur=41.2;desc="3 calls, 27 docs", render;dur=6.0, total;dur=52.9
+
+Durations of calls that overlap (asyncio.gather) are summed.
+
+Firestore is instrumented at the GAPIC layer (the client's `_firestore_api`),
+which every document reference, query, batch and transaction goes through,
+so the code issuing reads and writes needs no changes.
+
+A request carrying `X-Profile: <PROFILE_TOKEN>` gets a profile of itself
+back instead of its normal response: pyinstrument's HTML report when
+pyinstrument is installed, cProfile statistics otherwise. Only the request
+thread is profiled; the bodies of async views run on a helper thread and
+show up as time waiting on it. Profiling is off while PROFILE_TOKEN is unset.
+
+With several gunicorn workers, point PROMETHEUS_MULTIPROC_DIR at an empty
+directory so /metrics reports all of them rather than whichever answered.
+"""
+
+import contextvars
+import cProfile
+import functools
+import hmac
+import inspect
+import io
+import os
+import pstats
+import threading
+import time
+
+from flask import Response, before_render_template, g, request, template_rendered
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram,
+                               generate_latest, multiprocess)
+
+try:
+    from pyinstrument import Profiler
+except ImportError:
+    Profiler = None
+
+REQUEST_LATENCY = Histogram('http_request_duration_seconds', 'Time to produce a response',
+                            ['route', 'method', 'status'])
+RENDER_LATENCY = Histogram('template_render_duration_seconds', 'Jinja rendering time', ['template'])
+
+FIRESTORE_LATENCY = Histogram('firestore_call_duration_seconds', 'Firestore RPC time, including streaming',
+                              ['method'])
+FIRESTORE_ERRORS = Counter('firestore_call_errors_total', 'Firestore RPCs that raised', ['method'])
+FIRESTORE_DOCUMENTS = Counter('firestore_documents_read_total', 'Documents returned by Firestore', ['method'])
+FIRESTORE_BYTES = Counter('firestore_response_bytes_total', 'Serialized size of Firestore responses', ['method'])
+
+DEVICE_LATENCY = Histogram('nodemcu_request_duration_seconds', 'NodeMCU HTTP call time, per attempt',
+                           ['device', 'path', 'status'])
+DEVICE_BYTES = Counter('nodemcu_bytes_total', 'NodeMCU HTTP body bytes', ['device', 'path', 'direction'])
+
+# GAPIC methods to instrument, and whether they stream their responses
+FIRESTORE_METHODS = {
+    'get_document': False,
+    'batch_get_documents': True,
+    'run_query': True,
+    'run_aggregation_query': True,
+    'list_documents': False,
+    'list_collection_ids': False,
+    'create_document': False,
+    'update_document': False,
+    'delete_document': False,
+    'begin_transaction': False,
+    'commit': False,
+    'rollback': False,
+    'batch_write': False,
+}
+
+# Response fields that carry a document
+DOCUMENT_FIELDS = ('found', 'document')
+
+
+class RequestTimings:
+    """Per-request totals of instrumented calls, by kind"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # kind -> [calls, seconds, documents]
+        self.totals = {}
+
+    def add(self, kind, seconds, documents=0):
+        with self._lock:
+            totals = self.totals.setdefault(kind, [0, 0.0, 0])
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] += documents
+
+    def server_timing(self, total):
+        entries = []
+        for kind, (calls, seconds, documents) in sorted(self.totals.items()):
+            description = f"{calls} call{'s' if calls != 1 else ''}"
+            if documents:
+                description += f', {documents} docs'
+            entries.append(f'{kind};dur={seconds * 1000:.1f};desc="{description}"')
+        entries.append(f'total;dur={total * 1000:.1f}')
+        return ', '.join(entries)
+
+
+# Timings of the request being served; copied into async views and into
+# coroutines handed to the Firestore loop, so their calls count too
+_current = contextvars.ContextVar('request_timings', default=None)
+
+
+def _record(kind, seconds, documents=0):
+    timings = _current.get()
+    if timings is not None:
+        timings.add(kind, seconds, documents)
+
+
+# Firestore
+
+def _measure(response):
+    """Documents and serialized bytes in one GAPIC response"""
+    try:
+        message = type(response).pb(response)
+    except (AttributeError, TypeError):
+        # Pagers and other wrappers
+        return 0, 0
+    fields = message.DESCRIPTOR.fields_by_name
+    if message.DESCRIPTOR.name == 'Document':
+        documents = 1
+    else:
+        documents = sum(1 for field in DOCUMENT_FIELDS if field in fields and message.HasField(field))
+    return documents, message.ByteSize()
+
+
+def _observe_firestore(method, started, documents=0, size=0, failed=False):
+    seconds = time.perf_counter() - started
+    FIRESTORE_LATENCY.labels(method).observe(seconds)
+    if failed:
+        FIRESTORE_ERRORS.labels(method).inc()
+    if documents:
+        FIRESTORE_DOCUMENTS.labels(method).inc(documents)
+    if size:
+        FIRESTORE_BYTES.labels(method).inc(size)
+    _record('firestore', seconds, documents)
+
+
+def _counted_stream(method, started, responses):
+    documents = size = 0
+    failed = False
+    try:
+        for response in responses:
+            found, length = _measure(response)
+            documents += found
+            size += length
+            yield response
+    except Exception:
+        failed = True
+        raise
+    finally:
+        _observe_firestore(method, started, documents, size, failed)
+
+
+async def _counted_async_stream(method, started, responses):
+    documents = size = 0
+    failed = False
+    try:
+        async for response in responses:
+            found, length = _measure(response)
+            documents += found
+            size += length
+            yield response
+    except Exception:
+        failed = True
+        raise
+    finally:
+        _observe_firestore(method, started, documents, size, failed)
+
+
+async def _finish_async_call(method, started, awaitable, streaming):
+    try:
+        result = await awaitable
+    except Exception:
+        _observe_firestore(method, started, failed=True)
+        raise
+    if streaming:
+        return _counted_async_stream(method, started, result)
+    _observe_firestore(method, started, *_measure(result))
+    return result
+
+
+def _instrumented_call(method, call, streaming):
+    @functools.wraps(call)
+    def instrumented(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            result = call(*args, **kwargs)
+        except Exception:
+            _observe_firestore(method, started, failed=True)
+            raise
+        # Async GAPIC methods return an awaitable (streaming ones without being coroutines)
+        if inspect.isawaitable(result):
+            return _finish_async_call(method, started, result, streaming)
+        if streaming:
+            return _counted_stream(method, started, result)
+        _observe_firestore(method, started, *_measure(result))
+        return result
+    return instrumented
+
+
+def instrument_firestore(client):
+    """Time and count every RPC made through a Client or AsyncClient; idempotent"""
+    api = client._firestore_api
+    if getattr(api, '_instrumented', False):
+        return client
+    for method, streaming in FIRESTORE_METHODS.items():
+        call = getattr(api, method, None)
+        if call is not None:
+            setattr(api, method, _instrumented_call(method, call, streaming))
+    api._instrumented = True
+    return client
+
+
+# NodeMCU
+
+def observe_device_call(device, path, seconds, response=None, sent=0):
+    """Record one HTTP attempt to a dispenser; response is None when it failed"""
+    status = str(response.status_code) if response is not None else 'error'
+    DEVICE_LATENCY.labels(device, path, status).observe(seconds)
+    if sent:
+        DEVICE_BYTES.labels(device, path, 'sent').inc(sent)
+    if response is not None:
+        DEVICE_BYTES.labels(device, path, 'received').inc(len(response.content))
+    _record('nodemcu', seconds)
+
+
+# Flask
+
+def _template_started(sender, template, context, **extra):
+    g.setdefault('render_started', []).append(time.perf_counter())
+
+
+def _template_finished(sender, template, context, **extra):
+    started = g.get('render_started')
+    if not started:
+        return
+    seconds = time.perf_counter() - started.pop()
+    RENDER_LATENCY.labels(template.name or 'string').observe(seconds)
+    _record('render', seconds)
+
+
+def init_app(app, profile_token=None):
+    """Attach request timing, Server-Timing and the X-Profile profiler to app.
+
+    Call before registering other before_request hooks so they are timed too.
+    """
+
+    @app.before_request
+    def start_request_timing():
+        g.request_started = time.perf_counter()
+        g.request_timings = RequestTimings()
+        g.request_timings_token = _current.set(g.request_timings)
+        if profile_token and hmac.compare_digest(request.headers.get('X-Profile', ''), profile_token):
+            g.profiler = Profiler() if Profiler is not None else cProfile.Profile()
+            if Profiler is not None:
+                g.profiler.start()
+            else:
+                g.profiler.enable()
+
+    @app.after_request
+    def finish_request_timing(response):
+        if 'request_started' not in g:
+            return response
+        total = time.perf_counter() - g.request_started
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_LATENCY.labels(route, request.method, response.status_code).observe(total)
+        server_timing = g.request_timings.server_timing(total)
+
+        profiler = g.pop('profiler', None)
+        if profiler is not None:
+            response = _profile_response(profiler, response.status_code)
+        response.headers['Server-Timing'] = server_timing
+        return response
+
+    @app.teardown_request
+    def reset_request_timing(error=None):
+        token = g.pop('request_timings_token', None)
+        if token is not None:
+            try:
+                _current.reset(token)
+            except ValueError:
+                # Torn down in a different context (e.g. a streamed response)
+                _current.set(None)
+
+    before_render_template.connect(_template_started, app)
+    template_rendered.connect(_template_finished, app)
+
+
+def _profile_response(profiler, status):
+    if Profiler is not None:
+        profiler.stop()
+        response = Response(profiler.output_html(), mimetype='text/html')
+    else:
+        profiler.disable()
+        report = io.StringIO()
+        pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(60)
+        response = Response(report.getvalue(), mimetype='text/plain')
+    response.headers['X-Profiled-Status'] = str(status)
+    return response
+
+
+def metrics_response():
+    """Prometheus exposition of this process's metrics, or of all workers in multiprocess mode"""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
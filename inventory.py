@@ -0,0 +1,189 @@
+"""
+Medicine stock levels.
+
+Stock is tracked for medicines that have an `inventory` document:
+
+    inventory/{medicine_id}: {
+        'stock': 120,             # sum of the shards as of the last sync
+        'reorder_level': 50,
+        'low_stock': False,       # stock <= reorder_level, for the reorder query
+        'shards': 4,
+        'synced_at': datetime
+    }
+    inventory/{medicine_id}/shards/{n}: {'count': 30}
+
+The shards are the source of truth. A dispense decrements one shard picked
+at random with Increment, inside the same transaction that marks the
+prescription dispensed, so busy medicines spread their writes over several
+documents instead of contending for one. The totals on the inventory
+document are refreshed from the shards in the background (one aggregation
+read per medicine), which keeps the indexed low-stock query cheap without
+putting the inventory document itself on the dispense path.
+
+Stock in each dispenser slot is kept by the fleet (see dispenser_fleet.py).
+"""
+
+import random
+import threading
+from datetime import datetime
+
+from firebase_admin import firestore
+from google.api_core.exceptions import NotFound
+
+INVENTORY_COLLECTION = 'inventory'
+
+# Firestore sustains about one write per second to a document; this many
+# shards covers far more dispenses than a device fleet can run
+MAX_SHARDS = 32
+
+
+def inventory_ref(db, medicine_id):
+    return db.collection(INVENTORY_COLLECTION).document(medicine_id)
+
+
+def shards_ref(db, medicine_id):
+    return inventory_ref(db, medicine_id).collection('shards')
+
+
+def record_dispensed(writer, db, inventory_snapshot, quantity):
+    """Add the stock decrement for a dispense to a batch or transaction.
+
+    inventory_snapshot is the medicine's inventory document, read earlier in
+    the same transaction; untracked medicines are left alone.
+    """
+    if not inventory_snapshot.exists or quantity <= 0:
+        return
+    shard = random.randrange(max(1, inventory_snapshot.get('shards') or 1))
+    writer.set(shards_ref(db, inventory_snapshot.id).document(str(shard)),
+               {'count': firestore.Increment(-quantity)}, merge=True)
+
+
+def get_stock(db, medicine_id):
+    """The inventory document of a medicine as a dict, or None if untracked"""
+    doc = inventory_ref(db, medicine_id).get()
+    return doc.to_dict() if doc.exists else None
+
+
+async def get_stock_async(async_db, medicine_id):
+    """get_stock for a Firestore AsyncClient"""
+    doc = await inventory_ref(async_db, medicine_id).get()
+    return doc.to_dict() if doc.exists else None
+
+
+def count_stock(db, medicine_id):
+    """Current stock: the sum of all the medicine's shards"""
+    result = shards_ref(db, medicine_id).sum('count').get()
+    return int(result[0][0].value or 0)
+
+
+def sync_stock(db, medicine_id):
+    """Copy the shard total onto the inventory document; returns it, or None if untracked"""
+    ref = inventory_ref(db, medicine_id)
+    stock = count_stock(db, medicine_id)
+
+    @firestore.transactional
+    def apply(transaction):
+        snapshot = ref.get(transaction=transaction)
+        if not snapshot.exists:
+            return None
+        transaction.update(ref, {
+            'stock': stock,
+            'low_stock': stock <= (snapshot.get('reorder_level') or 0),
+            'synced_at': datetime.now()
+        })
+        return stock
+
+    return apply(db.transaction())
+
+
+def restock(db, medicine_id, add=None, count=None, reorder_level=None, shards=None):
+    """Record a delivery (add) or a physical count (count), and/or change settings.
+
+    The first call for a medicine starts tracking it. Returns the stock.
+    """
+    ref = inventory_ref(db, medicine_id)
+    snapshot = ref.get()
+    current = snapshot.to_dict() if snapshot.exists else {}
+    settings = {'medicine_id': medicine_id, 'shards': max(1, shards or current.get('shards') or 1)}
+    if reorder_level is not None:
+        settings['reorder_level'] = max(0, reorder_level)
+    elif 'reorder_level' not in current:
+        settings['reorder_level'] = 0
+
+    batch = db.batch()
+    batch.set(ref, settings, merge=True)
+    if count is not None:
+        # A count replaces whatever the shards add up to
+        for doc in shards_ref(db, medicine_id).select([]).stream():
+            batch.delete(doc.reference)
+        batch.set(shards_ref(db, medicine_id).document('0'), {'count': count})
+    if add:
+        batch.set(shards_ref(db, medicine_id).document('0'), {'count': firestore.Increment(add)}, merge=True)
+    batch.commit()
+    return sync_stock(db, medicine_id)
+
+
+def low_stock(db, limit=50):
+    """Tracked medicines at or below their reorder level, lowest stock first.
+
+    One indexed query on (low_stock, stock); nothing else is scanned.
+    """
+    query = (db.collection(INVENTORY_COLLECTION)
+             .where('low_stock', '==', True)
+             .order_by('stock')
+             .limit(limit))
+    items = []
+    for doc in query.stream():
+        item = doc.to_dict()
+        item['medicine_id'] = doc.id
+        items.append(item)
+    return items
+
+
+class StockSync:
+    """Background refresh of inventory totals for medicines that were dispensed"""
+
+    def __init__(self, interval=10):
+        self.interval = interval
+        self._db = None
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self, db):
+        self._db = db
+        self._thread = threading.Thread(target=self._run, name='stock-sync', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Sync what is pending, then stop"""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(self.interval)
+            self._thread = None
+
+    def mark_dirty(self, medicine_id):
+        if medicine_id:
+            with self._lock:
+                self._dirty.add(medicine_id)
+
+    def flush(self):
+        """Sync every medicine marked since the last flush"""
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        for medicine_id in dirty:
+            try:
+                sync_stock(self._db, medicine_id)
+            except NotFound:
+                pass
+            except Exception as e:
+                print(f"Stock sync for {medicine_id} failed: {e}")
+                self.mark_dirty(medicine_id)
+
+    def _run(self):
+        # Batching the syncs caps writes to each inventory document at one
+        # per interval per process, however often the medicine is dispensed
+        while not self._stopped.wait(self.interval):
+            self.flush()
+        self.flush()
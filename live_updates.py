@@ -0,0 +1,305 @@
+"""
+Live prescription updates for Server-Sent Events.
+
+Every prescription write stamps `updated_at` with the server time. Each
+process watches the `prescriptions` collection group (documents updated
+since shortly before it started) through one snapshot listener and fans the
+changes out to the event streams it serves: a patient page gets every change
+to that patient's prescriptions, a dashboard the changes for patients its
+user can see. Where snapshot listeners are unavailable the same query is
+polled instead.
+
+The listener's result set, and the copy of it the client library keeps,
+would otherwise grow with every prescription touched while the process
+runs, so every few minutes a listener with a fresh lower bound replaces it.
+The old one is only detached once the new one has delivered its first
+snapshot, so no change falls between them.
+
+Event IDs are `<update time in microseconds>-<prescription id>`, the same in
+every process, so a browser that reconnects to another worker resumes from
+its Last-Event-ID. Recent events are kept in a ring buffer for that replay;
+a stream that cannot be resumed gets a `reset` event and reloads.
+"""
+
+import json
+import queue
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+
+# What a change did, derived from the prescription document
+PRESCRIBED = 'prescribed'
+DISPENSING = 'dispensing'
+DISPENSE_FAILED = 'dispense_failed'
+DISPENSED = 'dispensed'
+
+# Returned by Subscription.get() for a stream that can no longer be
+# resumed, and for one that should just end (the browser reconnects)
+RESET = object()
+CLOSED = object()
+
+
+def event_key(event_id):
+    """Sort key of an event ID, or None if it is malformed"""
+    micros, dash, prescription_id = (event_id or '').partition('-')
+    if not micros.isdigit():
+        return None
+    if not dash:
+        # A bare timestamp_id() sorts after every event at that time
+        prescription_id = '\uffff'
+    return int(micros), prescription_id
+
+
+def _micros(timestamp):
+    # Collection group query results carry protobuf Timestamps, listeners
+    # and document reads DatetimeWithNanoseconds
+    pb = timestamp if hasattr(timestamp, 'seconds') else timestamp.timestamp_pb()
+    return pb.seconds * 1_000_000 + pb.nanos // 1000
+
+
+def timestamp_id(timestamp):
+    """Position in the feed just after everything written at timestamp.
+
+    Pages pass the update time of the data they rendered, so their stream
+    starts with the changes made since.
+    """
+    return str(_micros(timestamp))
+
+
+def prescription_event(doc):
+    """Build the event for a changed prescription snapshot"""
+    prescription = doc.to_dict()
+    prescription['id'] = doc.id
+    if prescription.get('status') == 'dispensed':
+        kind = DISPENSED
+    elif prescription.get('dispense_job_id'):
+        kind = DISPENSING
+    elif doc.create_time == doc.update_time:
+        kind = PRESCRIBED
+    else:
+        # Claimed by a dispense job that then failed
+        kind = DISPENSE_FAILED
+    key = (_micros(doc.update_time), doc.id)
+    return {
+        'id': f'{key[0]}-{key[1]}',
+        'key': key,
+        'event': kind,
+        'patient_id': doc.reference.parent.parent.id,
+        'assistant_id': prescription.get('assistant_id'),
+        'prescription': prescription
+    }
+
+
+class Subscription:
+    """One event stream's view of the feed"""
+
+    def __init__(self, matches, queue_size, after=None):
+        self.matches = matches
+        # The browser already has everything up to this key
+        self.after = after
+        self._queue = queue.Queue(queue_size)
+        self._end = None
+
+    def put(self, event):
+        """Queue an event; a stream too far behind to keep up is reset instead"""
+        if self.after is not None and event['key'] <= self.after:
+            return True
+        try:
+            self._queue.put_nowait(event)
+            return True
+        except queue.Full:
+            self.end(RESET)
+            return False
+
+    def end(self, reason):
+        """End the stream with RESET or CLOSED after what it already has"""
+        if self._end is None:
+            self._end = reason
+        # Wake a reader blocked on an empty queue
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def get(self, timeout):
+        """Next event, RESET or CLOSED, or None when nothing arrived within timeout"""
+        if self._end is RESET:
+            return RESET
+        try:
+            event = self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if event is None:
+            return self._end
+        return event
+
+
+class LiveUpdates:
+    """Per-process prescription change feed fanned out to SSE subscribers"""
+
+    def __init__(self, history_seconds=300, history_size=1024, max_streams=4,
+                 poll_interval=2, queue_size=256, reanchor_seconds=600):
+        self.history_seconds = history_seconds
+        self.max_streams = max_streams
+        self.poll_interval = poll_interval
+        self.queue_size = queue_size
+        self.reanchor_seconds = reanchor_seconds
+        self._db = None
+        self._listener = None
+        self._poller = None
+        self._reanchor = None
+        self._stopped = threading.Event()
+        self._events = deque(maxlen=history_size)
+        # Events newer than this key are all in self._events
+        self._covered_since = None
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+
+    def start(self, db):
+        """Watch prescriptions changed since history_seconds before now"""
+        self._db = db
+        since = datetime.now(timezone.utc) - timedelta(seconds=self.history_seconds)
+        self._covered_since = (int(since.timestamp() * 1_000_000), '')
+        try:
+            self._listener, _ = self._listen(since)
+            print("Live updates listening for prescription changes")
+            self._reanchor = threading.Thread(target=self._reanchor_loop, name='live-updates-reanchor', daemon=True)
+            self._reanchor.start()
+        except Exception as e:
+            print(f"Live updates listener unavailable, polling every {self.poll_interval}s: {e}")
+            self._listener = None
+            self._poller = threading.Thread(target=self._poll, args=(since,), name='live-updates-poll', daemon=True)
+            self._poller.start()
+
+    def stop(self):
+        """Detach from Firestore and end every open stream"""
+        self._stopped.set()
+        with self._lock:
+            listener, self._listener = self._listener, None
+        if listener is not None:
+            listener.unsubscribe()
+        with self._lock:
+            for subscription in self._subscriptions:
+                subscription.end(CLOSED)
+            self._subscriptions.clear()
+
+    def subscribe(self, matches, last_event_id=None):
+        """Register a stream receiving the events for which matches(event) is true.
+
+        Events after last_event_id are replayed first; if some of them may
+        have been missed, the stream starts with RESET instead. Returns None
+        when this process already serves max_streams streams.
+        """
+        last_key = event_key(last_event_id)
+        subscription = Subscription(matches, self.queue_size, last_key)
+        with self._lock:
+            if len(self._subscriptions) >= self.max_streams:
+                return None
+            if last_key is not None:
+                if self._covered_since is None or last_key < self._covered_since:
+                    subscription.end(RESET)
+                else:
+                    for event in self._events:
+                        if matches(event) and not subscription.put(event):
+                            break
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def stream(self, subscription, render, max_seconds=60, keepalive=15, retry_ms=3000):
+        """Yield the SSE text for a subscription, ending after max_seconds.
+
+        render(event) returns the JSON-serializable data sent for an event.
+        Streams are closed regularly so a thread is never held for long; the
+        browser reconnects after retry_ms and resumes from its last event.
+        """
+        try:
+            yield f'retry: {retry_ms}\n\n'
+            deadline = time.monotonic() + max_seconds
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                event = subscription.get(min(keepalive, remaining))
+                if event is None:
+                    yield ': keep-alive\n\n'
+                elif event is RESET:
+                    yield 'event: reset\ndata: {}\n\n'
+                    return
+                elif event is CLOSED:
+                    return
+                else:
+                    data = json.dumps(render(event), default=str)
+                    yield f"id: {event['id']}\nevent: prescription\ndata: {data}\n\n"
+        finally:
+            self.unsubscribe(subscription)
+
+    def _publish(self, docs):
+        events = sorted((prescription_event(doc) for doc in docs), key=lambda event: event['key'])
+        with self._lock:
+            for event in events:
+                if self._events and event['key'] <= self._events[-1]['key']:
+                    continue
+                if len(self._events) == self._events.maxlen:
+                    self._covered_since = self._events[0]['key']
+                self._events.append(event)
+                for subscription in list(self._subscriptions):
+                    if subscription.matches(event) and not subscription.put(event):
+                        # Too far behind to catch up; it starts over
+                        self._subscriptions.discard(subscription)
+
+    def _on_snapshot(self, docs, changes, read_time):
+        self._publish(change.document for change in changes if change.type.name != 'REMOVED')
+
+    def _listen(self, since):
+        """Start a listener on changes after since; returns it and an Event set on its first snapshot"""
+        ready = threading.Event()
+
+        def on_snapshot(docs, changes, read_time):
+            # Changes both listeners deliver are published once: _publish
+            # skips keys it has already seen
+            self._on_snapshot(docs, changes, read_time)
+            ready.set()
+
+        query = self._db.collection_group('prescriptions').where('updated_at', '>', since)
+        return query.on_snapshot(on_snapshot), ready
+
+    def _reanchor_loop(self):
+        while not self._stopped.wait(self.reanchor_seconds):
+            try:
+                since = datetime.now(timezone.utc) - timedelta(seconds=self.history_seconds)
+                listener, ready = self._listen(since)
+            except Exception as e:
+                print(f"Live updates could not re-anchor the listener: {e}")
+                continue
+            # Keep the old listener until the new one has caught up
+            if not ready.wait(60):
+                print("Live updates listener did not start; keeping the old one")
+                listener.unsubscribe()
+                continue
+            with self._lock:
+                if self._stopped.is_set():
+                    old = listener
+                else:
+                    old, self._listener = self._listener, listener
+            if old is not None:
+                old.unsubscribe()
+
+    def _poll(self, since):
+        cursor = since
+        while not self._stopped.wait(self.poll_interval):
+            try:
+                query = (self._db.collection_group('prescriptions')
+                         .where('updated_at', '>', cursor)
+                         .order_by('updated_at')
+                         .limit(500))
+                docs = list(query.stream())
+                if docs:
+                    cursor = docs[-1].get('updated_at')
+                    self._publish(docs)
+            except Exception as e:
+                print(f"Live updates poll failed: {e}")
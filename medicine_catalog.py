@@ -0,0 +1,301 @@
+"""
+In-process medicine catalog used by the medicine search API.
+
+The whole `medicines` collection is mirrored in memory behind three indexes:
+a sorted list of lowercase names for prefix and typo-tolerant lookups, an
+n-gram index for substring lookups, and a word index over descriptions.
+The mirror is kept current by a Firestore snapshot listener, or reloaded
+after a TTL when no listener could be started.
+
+Search results are ranked in tiers: exact name, name prefix, name substring,
+fuzzy name match (within a small Levenshtein distance, so misspelled or
+misrecognized handwriting still finds the medicine), then description words.
+"""
+
+import bisect
+import heapq
+import re
+import threading
+import time
+
+# Names are indexed by every substring of up to this many characters
+NGRAM_SIZE = 3
+
+# Result tiers, best first
+EXACT, PREFIX, SUBSTRING, FUZZY, DESCRIPTION = range(5)
+MATCH_TYPES = ('exact', 'prefix', 'substring', 'fuzzy', 'description')
+
+# Queries shorter than this are not matched fuzzily; too much would match
+FUZZY_MIN_LENGTH = 4
+
+WORD_PATTERN = re.compile(r'[a-z0-9]+')
+
+
+def max_typos(query):
+    """Edits tolerated for a query: one for short queries, two for longer ones"""
+    return 1 if len(query) <= 5 else 2
+
+
+def _medicine_entry(doc_id, data):
+    """Project a medicine document onto the fields the search API returns.
+
+    Imports and older documents may hold None in any of them.
+    """
+    return {
+        'id': doc_id,
+        'name': data.get('name') or '',
+        'dosage': data.get('dosage') or '',
+        'frequency': data.get('frequency') or '',
+        'description': data.get('description') or ''
+    }
+
+
+class _CatalogIndex:
+    """Immutable search index over one snapshot of the catalog"""
+
+    def __init__(self, entries):
+        ranked = sorted(entries, key=lambda entry: ((entry.get('name') or '').lower(), entry['id']))
+        self.entries = ranked
+        self.names = [(entry.get('name') or '').lower() for entry in ranked]
+        self.by_id = {entry['id']: entry for entry in ranked}
+
+        # Sorted description words and, per word, the ranks that use it
+        self.description_words = {}
+        for rank, entry in enumerate(ranked):
+            for word in set(WORD_PATTERN.findall((entry.get('description') or '').lower())):
+                self.description_words.setdefault(word, []).append(rank)
+        self.sorted_words = sorted(self.description_words)
+
+        # gram -> ranks (positions in self.names) of every name containing it.
+        # Names are visited in rank order, so each posting list stays sorted.
+        self.grams = {}
+        for rank, name in enumerate(self.names):
+            seen = set()
+            for size in range(1, NGRAM_SIZE + 1):
+                for start in range(len(name) - size + 1):
+                    gram = name[start:start + size]
+                    if gram not in seen:
+                        seen.add(gram)
+                        self.grams.setdefault(gram, []).append(rank)
+
+    def prefix_ranks(self, query):
+        """Yield ranks of names starting with query, alphabetically"""
+        rank = bisect.bisect_left(self.names, query)
+        while rank < len(self.names) and self.names[rank].startswith(query):
+            yield rank
+            rank += 1
+
+    def substring_ranks(self, query):
+        """Yield ranks of names containing query, alphabetically"""
+        if len(query) <= NGRAM_SIZE:
+            # The query is itself an indexed gram, so its postings are exact
+            yield from self.grams.get(query, [])
+            return
+
+        # Walk the rarest gram of the query and verify each candidate
+        postings = None
+        for start in range(len(query) - NGRAM_SIZE + 1):
+            candidate = self.grams.get(query[start:start + NGRAM_SIZE])
+            if candidate is None:
+                return
+            if postings is None or len(candidate) < len(postings):
+                postings = candidate
+
+        for rank in postings:
+            if query in self.names[rank]:
+                yield rank
+
+    def fuzzy_ranks(self, query, exclude, limit):
+        """Return up to limit (distance, rank) pairs for names within a few typos.
+
+        A name matches when some prefix of it is within max_typos(query)
+        Levenshtein edits of the query, so a misspelled partial name still
+        finds the medicine. As in most spelling correctors the first letter
+        is taken as typed, which keeps the search away from the dense top of
+        the name space. The sorted name list is walked as a trie (each child
+        range found with bisect), carrying one edit-distance row per node and
+        abandoning a branch once every entry in its row is over the limit.
+        Closest names come first, then shorter ones.
+        """
+        typos = max_typos(query)
+        names = self.names
+        # (distance, lo, hi): every name in names[lo:hi] is within distance
+        ranges = []
+
+        def next_row(row, depth, char):
+            """Edit-distance row one character deeper, and its smallest entry"""
+            # Cells more than `typos` off the diagonal always exceed the limit
+            child = [typos + 1] * (len(query) + 1)
+            if depth < typos:
+                child[0] = depth + 1
+            lowest = child[0]
+            for column in range(max(1, depth + 1 - typos), min(len(query), depth + 1 + typos) + 1):
+                cost = row[column - 1] + (query[column - 1] != char)
+                if row[column] < cost:
+                    cost = row[column] + 1
+                if child[column - 1] < cost:
+                    cost = child[column - 1] + 1
+                child[column] = cost
+                if cost < lowest:
+                    lowest = cost
+            return child, lowest
+
+        def visit(prefix, lo, hi, row, lowest):
+            distance = row[-1]
+            if distance <= typos:
+                ranges.append((distance, lo, hi))
+            # Going deeper can only help while some entry beats the best so far
+            if lowest >= min(distance, typos + 1):
+                return
+            depth = len(prefix)
+            position = lo
+            # A name equal to the prefix sorts first and has no children
+            while position < hi and len(names[position]) == depth:
+                position += 1
+            while position < hi:
+                char = names[position][depth]
+                end = bisect.bisect_left(names, prefix + chr(ord(char) + 1), position, hi)
+                visit(prefix + char, position, end, *next_row(row, depth, char))
+                position = end
+
+        first = query[0]
+        lo = bisect.bisect_left(names, first)
+        hi = bisect.bisect_left(names, chr(ord(first) + 1), lo)
+        visit(first, lo, hi, *next_row(list(range(len(query) + 1)), 0, first))
+
+        best = {}
+        for distance, lo, hi in sorted(ranges):
+            for rank in range(lo, hi):
+                if rank not in best and rank not in exclude:
+                    best[rank] = distance
+        return heapq.nsmallest(limit, ((distance, rank) for rank, distance in best.items()),
+                               key=lambda match: (match[0], len(names[match[1]]), match[1]))
+
+    def description_ranks(self, query):
+        """Yield ranks whose description has a word starting with each query word"""
+        matched = None
+        for term in WORD_PATTERN.findall(query):
+            ranks = set()
+            position = bisect.bisect_left(self.sorted_words, term)
+            while position < len(self.sorted_words) and self.sorted_words[position].startswith(term):
+                ranks.update(self.description_words[self.sorted_words[position]])
+                position += 1
+            matched = ranks if matched is None else matched & ranks
+            if not matched:
+                return
+        yield from sorted(matched or ())
+
+
+class MedicineCatalog:
+    """Process-wide, self-refreshing mirror of the medicines collection"""
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._db = None
+        self._index = _CatalogIndex([])
+        self._loaded_at = 0
+        self._listener = None
+        self._lock = threading.Lock()
+
+    def start(self, db):
+        """Attach to Firestore and keep the catalog in sync with it"""
+        self._db = db
+        try:
+            self._listener = db.collection('medicines').on_snapshot(self._on_snapshot)
+            print("Medicine catalog listening for changes")
+        except Exception as e:
+            print(f"Medicine catalog listener unavailable, using {self.ttl}s TTL: {e}")
+            self._listener = None
+            self.reload()
+
+    def stop(self):
+        """Detach the snapshot listener, if any"""
+        if self._listener is not None:
+            self._listener.unsubscribe()
+            self._listener = None
+
+    def reload(self):
+        """Rebuild the index from a full read of the collection"""
+        entries = [_medicine_entry(doc.id, doc.to_dict())
+                   for doc in self._db.collection('medicines').stream()]
+        self._swap(entries)
+
+    def invalidate(self):
+        """Force a reload on the next search when running in TTL mode"""
+        self._loaded_at = 0
+
+    def get(self, medicine_id):
+        """Return the cached search entry for a medicine, or None"""
+        self._ensure_fresh()
+        return self._index.by_id.get(medicine_id)
+
+    def search(self, query, limit=10):
+        """Return up to `limit` medicines matching query, best first.
+
+        Tiers: exact name, name prefix, name substring (alphabetical within
+        each), fuzzy name match (fewest typos first), description words.
+        Each result carries a `match` key naming its tier. Lower tiers are
+        only searched when the higher ones leave room.
+        """
+        query = ' '.join(query.lower().split())
+        if not query:
+            return []
+
+        self._ensure_fresh()
+        index = self._index
+
+        results = []
+        seen = set()
+
+        def add(rank, tier):
+            if rank in seen:
+                return False
+            seen.add(rank)
+            results.append(dict(index.entries[rank], match=MATCH_TYPES[tier]))
+            return len(results) >= limit
+
+        # An exact match sorts first in the prefix run
+        for rank in index.prefix_ranks(query):
+            tier = EXACT if index.names[rank] == query else PREFIX
+            if add(rank, tier):
+                return self._order(results)
+        for rank in index.substring_ranks(query):
+            if add(rank, SUBSTRING):
+                return self._order(results)
+
+        if len(query) >= FUZZY_MIN_LENGTH:
+            for distance, rank in index.fuzzy_ranks(query, seen, limit - len(results)):
+                if add(rank, FUZZY):
+                    return self._order(results)
+
+        for rank in index.description_ranks(query):
+            if add(rank, DESCRIPTION):
+                break
+        return self._order(results)
+
+    @staticmethod
+    def _order(results):
+        # Only exact matches need moving: every other tier is appended in order
+        return sorted(results, key=lambda result: result['match'] != 'exact')
+
+    def __len__(self):
+        return len(self._index.entries)
+
+    def _on_snapshot(self, col_snapshot, changes, read_time):
+        self._swap([_medicine_entry(doc.id, doc.to_dict()) for doc in col_snapshot])
+
+    def _swap(self, entries):
+        index = _CatalogIndex(entries)
+        # Readers grab self._index without locking; replacing the reference
+        # is atomic, so a search always sees one complete snapshot.
+        self._index = index
+        self._loaded_at = time.monotonic()
+
+    def _ensure_fresh(self):
+        if self._listener is not None or self._db is None:
+            return
+        if time.monotonic() - self._loaded_at < self.ttl:
+            return
+        with self._lock:
+            if time.monotonic() - self._loaded_at >= self.ttl:
+                self.reload()
@@ -0,0 +1,187 @@
+"""
+HTTP client for the NodeMCU dispenser.
+
+One client is shared by the whole process. It keeps connections to the
+device alive in a small pool, uses a short connect timeout separate from the
+read timeout, retries only operations that are safe to repeat, and stops
+calling the device for a while after repeated failures (circuit breaker) so
+requests fail fast instead of each waiting out a timeout.
+
+A dispense is only retried when it carries an idempotency_key and the
+device's /status says it deduplicates keyed requests (firmware that keeps
+recent keys); older firmware gets a single attempt.
+
+Prescription summaries are sent as MessagePack, which the firmware decodes
+with ArduinoJson in less time and RAM than the equivalent JSON. Set
+wire_format='json' for devices still running older firmware.
+"""
+
+import random
+import threading
+import time
+
+import msgpack
+import requests
+from requests.adapters import HTTPAdapter
+
+from instrumentation import observe_device_call
+
+WIRE_FORMATS = ('msgpack', 'json')
+# The device answered but cannot take the job now; not a failure of the device
+BUSY_STATUSES = (409, 503)
+
+
+class NodeMCUError(Exception):
+    """Base class for dispenser communication errors"""
+
+
+class DeviceUnavailable(NodeMCUError):
+    """The device could not be reached, or the circuit breaker is open"""
+
+
+class DeviceBusy(NodeMCUError):
+    """The device refused the job because it is busy or its queue is full"""
+
+
+class CircuitBreaker:
+    """Closed -> open after repeated failures -> half-open trial -> closed"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=3, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Whether a call may go through right now"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                # Let exactly one trial call through
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+class NodeMCUClient:
+    """Connection-pooled client for the dispenser's HTTP API"""
+
+    def __init__(self, host, port=80, connect_timeout=2, read_timeout=30,
+                 retries=2, backoff=0.25, pool_size=4, breaker=None,
+                 poll_interval=0.5, job_timeout=120, wire_format='msgpack'):
+        if wire_format not in WIRE_FORMATS:
+            raise ValueError(f'Unknown wire format: {wire_format}')
+        self.host = host
+        self.base_url = f'http://{host}:{port}'
+        self.timeout = (connect_timeout, read_timeout)
+        self.poll_interval = poll_interval
+        self.job_timeout = job_timeout
+        self.wire_format = wire_format
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = breaker or CircuitBreaker()
+        # Learned from /status; False until the device says otherwise
+        self.idempotent_dispense = False
+
+        self.session = requests.Session()
+        # Retries are handled here so non-idempotent calls are never repeated
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+
+    def status(self):
+        """GET /status as a dict"""
+        status = self._request('GET', '/status', idempotent=True).json()
+        self.idempotent_dispense = bool(status.get('idempotent_dispense'))
+        return status
+
+    def dispense(self, payload):
+        """Dispense and wait until the device has finished; returns the device's reply.
+
+        A lost reply may mean the servo already moved, so the POST is only
+        retried when payload has an idempotency_key the device deduplicates;
+        a repeat then gets the original job back. Current firmware accepts the job with 202 and a job ID, and
+        its progress is then followed through /status; older firmware
+        replies 200 only once it is done.
+        """
+        idempotent = bool(payload.get('idempotency_key')) and self.idempotent_dispense
+        response = self._request('POST', '/dispense', idempotent=idempotent, json=payload)
+        if response.status_code == 200:
+            return response.json()
+        if response.status_code in BUSY_STATUSES:
+            raise DeviceBusy('Dispensing device is busy.')
+        if response.status_code != 202:
+            raise NodeMCUError(f'Dispensing device returned HTTP {response.status_code}')
+
+        job = response.json()
+        return self._wait_for_job(job['job_id'], job.get('boot_id'))
+
+    def send_prescriptions(self, payload):
+        """POST /prescriptions. Safe to repeat, the device only displays them."""
+        if self.wire_format == 'json':
+            return self._request('POST', '/prescriptions', idempotent=True, json=payload)
+        return self._request('POST', '/prescriptions', idempotent=True,
+                             data=msgpack.packb(payload, use_bin_type=True),
+                             headers={'Content-Type': 'application/msgpack'})
+
+    def close(self):
+        self.session.close()
+
+    def _wait_for_job(self, job_id, boot_id):
+        """Poll /status until the device reports job_id as completed"""
+        deadline = time.monotonic() + self.job_timeout
+        while time.monotonic() < deadline:
+            time.sleep(self.poll_interval)
+            status = self.status()
+            if boot_id is not None and status.get('boot_id') != boot_id:
+                raise NodeMCUError('Dispensing device restarted before finishing the job.')
+            if status.get('last_completed_job', 0) >= job_id:
+                return status
+        raise NodeMCUError(f'Dispensing device did not finish job {job_id} in time.')
+
+    def _request(self, method, path, idempotent, **kwargs):
+        if not self.breaker.allow():
+            raise DeviceUnavailable(f'Dispensing device at {self.base_url} is unreachable; not retrying yet')
+
+        attempts = 1 + (self.retries if idempotent else 0)
+        for attempt in range(attempts):
+            started = time.perf_counter()
+            try:
+                response = self.session.request(method, self.base_url + path, timeout=self.timeout, **kwargs)
+            except requests.exceptions.RequestException as e:
+                observe_device_call(self.host, path, time.perf_counter() - started)
+                error = e
+            else:
+                observe_device_call(self.host, path, time.perf_counter() - started, response,
+                                    sent=len(response.request.body or b''))
+                if response.status_code < 500 or response.status_code in BUSY_STATUSES:
+                    self.breaker.record_success()
+                    return response
+                error = NodeMCUError(f'Dispensing device returned HTTP {response.status_code}')
+
+            if attempt + 1 < attempts:
+                # Exponential backoff with full jitter
+                time.sleep(random.uniform(0, self.backoff * (2 ** attempt)))
+
+        self.breaker.record_failure()
+        if isinstance(error, NodeMCUError):
+            raise error
+        raise DeviceUnavailable(f'Failed to reach dispensing device at {self.base_url}: {error}') from error
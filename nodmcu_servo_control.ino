@@ -1,398 +1,617 @@
-/*
- * NodeMCU 1.0 12-E Servo Control for Medical Dispensing System
- * 
- * This code controls a servo motor to dispense medicine when triggered
- * by the web application. The servo rotates to dispense medicine and
- * returns to original position.
- * 
- * Hardware Setup:
- * - Servo motor connected to D4 (GPIO2)
- * - LED indicator on D2 (GPIO4) for status
- * - Button on D3 (GPIO0) for manual testing
- * 
- * Network Setup:
- * - Connect to WiFi network
- * - Create web server on port 80
- * - Accept POST requests to /dispense endpoint
- */
-
-#include <ESP8266WiFi.h>
-#include <ESP8266WebServer.h>
-#include <Servo.h>
-#include <ArduinoJson.h>
-
-// WiFi credentials - Change these to your network
-const char* ssid = "YOUR_WIFI_SSID";
-const char* password = "YOUR_WIFI_PASSWORD";
-
-// Pin definitions
-const int SERVO_PIN = 2;    // D4 - Servo motor
-const int LED_PIN = 4;      // D2 - Status LED
-const int BUTTON_PIN = 0;   // D3 - Manual test button
-
-// Servo settings
-const int SERVO_REST_POSITION = 0;    // Rest position (0 degrees)
-const int SERVO_DISPENSE_POSITION = 90; // Dispense position (90 degrees)
-const int DISPENSE_DELAY = 2000;      // Time to hold dispense position (2 seconds)
-
-// Create objects
-Servo medicineServo;
-ESP8266WebServer server(80);
-
-// Variables
-bool isDispensing = false;
-unsigned long lastDispenseTime = 0;
-int buttonState = HIGH;
-int lastButtonState = HIGH;
-unsigned long lastDebounceTime = 0;
-unsigned long debounceDelay = 50;
-
-void setup() {
-  // Initialize serial communication
-  Serial.begin(115200);
-  Serial.println("\n=== Medical Dispensing System ===");
-  
-  // Initialize pins
-  pinMode(LED_PIN, OUTPUT);
-  pinMode(BUTTON_PIN, INPUT_PULLUP);
-  
-  // Initialize servo
-  medicineServo.attach(SERVO_PIN);
-  medicineServo.write(SERVO_REST_POSITION);
-  
-  // Turn on LED to indicate startup
-  digitalWrite(LED_PIN, HIGH);
-  
-  // Connect to WiFi
-  connectToWiFi();
-  
-  // Setup web server routes
-  setupWebServer();
-  
-  // Start web server
-  server.begin();
-  Serial.println("Web server started");
-  
-  // Turn off LED after successful startup
-  digitalWrite(LED_PIN, LOW);
-  
-  Serial.println("System ready!");
-  Serial.print("Server IP: ");
-  Serial.println(WiFi.localIP());
-}
-
-void loop() {
-  // Handle web server requests
-  server.handleClient();
-  
-  // Handle manual button press
-  handleButtonPress();
-  
-  // Handle dispensing sequence
-  handleDispensing();
-  
-  // Small delay to prevent overwhelming the system
-  delay(10);
-}
-
-void connectToWiFi() {
-  Serial.print("Connecting to WiFi: ");
-  Serial.println(ssid);
-  
-  WiFi.begin(ssid, password);
-  
-  // Wait for connection
-  while (WiFi.status() != WL_CONNECTED) {
-    delay(500);
-    Serial.print(".");
-    // Blink LED while connecting
-    digitalWrite(LED_PIN, !digitalRead(LED_PIN));
-  }
-  
-  Serial.println("");
-  Serial.println("WiFi connected!");
-  Serial.print("IP address: ");
-  Serial.println(WiFi.localIP());
-}
-
-// Function to extract JSON values (simple parser)
-String extractJsonValue(String json, String key) {
-  String searchKey = "\"" + key + "\":";
-  int startIndex = json.indexOf(searchKey);
-  if (startIndex == -1) return "";
-  
-  startIndex += searchKey.length();
-  
-  // Skip whitespace
-  while (startIndex < json.length() && (json.charAt(startIndex) == ' ' || json.charAt(startIndex) == '\t')) {
-    startIndex++;
-  }
-  
-  // Check if value is quoted
-  bool isQuoted = (startIndex < json.length() && json.charAt(startIndex) == '"');
-  if (isQuoted) startIndex++;
-  
-  int endIndex = startIndex;
-  if (isQuoted) {
-    // Find closing quote
-    while (endIndex < json.length() && json.charAt(endIndex) != '"') {
-      endIndex++;
-    }
-  } else {
-    // Find comma or closing brace
-    while (endIndex < json.length() && json.charAt(endIndex) != ',' && json.charAt(endIndex) != '}') {
-      endIndex++;
-    }
-  }
-  
-  return json.substring(startIndex, endIndex);
-}
-
-void setupWebServer() {
-  // Root endpoint - system status
-  server.on("/", HTTP_GET, []() {
-    String html = "<!DOCTYPE html><html><head><title>Medical Dispensing System</title>";
-    html += "<meta name='viewport' content='width=device-width, initial-scale=1.0'>";
-    html += "<style>body{font-family:Arial,sans-serif;text-align:center;padding:20px;}";
-    html += ".status{background:#f0f0f0;padding:20px;border-radius:10px;margin:20px;}";
-    html += ".success{background:#d4edda;color:#155724;}";
-    html += ".error{background:#f8d7da;color:#721c24;}</style></head><body>";
-    html += "<h1>Medical Dispensing System</h1>";
-    html += "<div class='status success'>";
-    html += "<h2>System Online</h2>";
-    html += "<p>NodeMCU is connected and ready</p>";
-    html += "<p>IP: " + WiFi.localIP().toString() + "</p>";
-    html += "<p>Uptime: " + String(millis() / 1000) + " seconds</p>";
-    html += "</div>";
-    html += "<div class='status'>";
-    html += "<h3>Endpoints</h3>";
-    html += "<p><strong>GET /</strong> - System status</p>";
-    html += "<p><strong>POST /dispense</strong> - Dispense medicine</p>";
-    html += "<p><strong>GET /status</strong> - JSON status</p>";
-    html += "</div></body></html>";
-    
-    server.send(200, "text/html", html);
-  });
-  
-  // Status endpoint - JSON response
-  server.on("/status", HTTP_GET, []() {
-    StaticJsonDocument<200> doc;
-    doc["status"] = "online";
-    doc["ip"] = WiFi.localIP().toString();
-    doc["uptime"] = millis() / 1000;
-    doc["dispensing"] = isDispensing;
-    doc["servo_position"] = medicineServo.read();
-    
-    String response;
-    serializeJson(doc, response);
-    server.send(200, "application/json", response);
-  });
-  
-  // Dispense endpoint - main functionality
-  server.on("/dispense", HTTP_POST, []() {
-    Serial.println("Dispense request received");
-    
-    if (isDispensing) {
-      server.send(409, "application/json", "{\"error\":\"Already dispensing\"}");
-      return;
-    }
-    
-    // Parse JSON data from request
-    if (server.hasArg("plain")) {
-      String body = server.arg("plain");
-      Serial.println("Received data: " + body);
-      
-      // Parse JSON (basic parsing for key fields)
-      String patientName = extractJsonValue(body, "patient_name");
-      String medicineName = extractJsonValue(body, "medicine_name");
-      String dosage = extractJsonValue(body, "dosage");
-      String frequency = extractJsonValue(body, "frequency");
-      String quantity = extractJsonValue(body, "quantity");
-      String notes = extractJsonValue(body, "notes");
-      String dispensedBy = extractJsonValue(body, "dispensed_by");
-      String timestamp = extractJsonValue(body, "timestamp");
-      
-      // Print prescription details
-      Serial.println("=== PRESCRIPTION DISPENSING ===");
-      Serial.println("Patient: " + patientName);
-      Serial.println("Medicine: " + medicineName);
-      Serial.println("Dosage: " + dosage);
-      Serial.println("Frequency: " + frequency);
-      Serial.println("Quantity: " + quantity);
-      Serial.println("Notes: " + notes);
-      Serial.println("Dispensed by: " + dispensedBy);
-      Serial.println("Time: " + timestamp);
-      Serial.println("================================");
-      
-      // Calculate dispensing time based on quantity
-      int quantityInt = quantity.toInt();
-      if (quantityInt <= 0) quantityInt = 1;
-      if (quantityInt > 10) quantityInt = 10; // Safety limit
-      
-      // Start dispensing sequence
-      isDispensing = true;
-      lastDispenseTime = millis();
-      
-      // Turn on LED to indicate dispensing
-      digitalWrite(LED_PIN, HIGH);
-      
-      // Dispense based on quantity
-      for (int i = 0; i < quantityInt; i++) {
-        Serial.println("Dispensing tablet " + String(i + 1) + " of " + String(quantityInt));
-        
-        // Move servo to dispense position
-        medicineServo.write(SERVO_DISPENSE_POSITION);
-        delay(1000); // Hold position for 1 second
-        
-        // Return to rest position
-        medicineServo.write(SERVO_REST_POSITION);
-        delay(500); // Wait between tablets
-        
-        // Blink LED for each tablet
-        digitalWrite(LED_PIN, LOW);
-        delay(200);
-        digitalWrite(LED_PIN, HIGH);
-      }
-      
-      Serial.println("All tablets dispensed successfully");
-      
-      // Send success response with prescription details
-      String response = "{\"status\":\"dispensed\",\"message\":\"Medicine dispensed successfully\",";
-      response += "\"patient\":\"" + patientName + "\",";
-      response += "\"medicine\":\"" + medicineName + "\",";
-      response += "\"quantity\":" + quantity + "}";
-      server.send(200, "application/json", response);
-    } else {
-      // Fallback for simple requests without JSON
-      isDispensing = true;
-      lastDispenseTime = millis();
-      digitalWrite(LED_PIN, HIGH);
-      medicineServo.write(SERVO_DISPENSE_POSITION);
-      Serial.println("Servo moved to dispense position (simple mode)");
-      server.send(200, "application/json", "{\"status\":\"dispensing\",\"message\":\"Medicine dispensed successfully\"}");
-    }
-  });
-  
-  // Prescriptions endpoint - receive all patient prescriptions
-  server.on("/prescriptions", HTTP_POST, []() {
-    Serial.println("Prescriptions data received");
-    
-    if (server.hasArg("plain")) {
-      String body = server.arg("plain");
-      Serial.println("Received prescriptions data: " + body);
-      
-      // Parse JSON data
-      String patientName = extractJsonValue(body, "patient_name");
-      String patientId = extractJsonValue(body, "patient_id");
-      String totalPrescriptions = extractJsonValue(body, "total_prescriptions");
-      String sentBy = extractJsonValue(body, "sent_by");
-      String timestamp = extractJsonValue(body, "timestamp");
-      
-      // Print prescription summary
-      Serial.println("=== PRESCRIPTIONS RECEIVED ===");
-      Serial.println("Patient: " + patientName);
-      Serial.println("Patient ID: " + patientId);
-      Serial.println("Total Prescriptions: " + totalPrescriptions);
-      Serial.println("Sent by: " + sentBy);
-      Serial.println("Time: " + timestamp);
-      Serial.println("==============================");
-      
-      // Parse individual prescriptions (simplified parsing)
-      int prescriptionCount = totalPrescriptions.toInt();
-      for (int i = 0; i < prescriptionCount && i < 10; i++) { // Limit to 10 prescriptions
-        String medicineName = extractJsonValue(body, "medicine_name");
-        String dosage = extractJsonValue(body, "dosage");
-        String frequency = extractJsonValue(body, "frequency");
-        
-        if (medicineName.length() > 0) {
-          Serial.println("Prescription " + String(i + 1) + ":");
-          Serial.println("  Medicine: " + medicineName);
-          Serial.println("  Dosage: " + dosage);
-          Serial.println("  Frequency: " + frequency);
-        }
-      }
-      
-      // Blink LED to indicate data received
-      for (int i = 0; i < 3; i++) {
-        digitalWrite(LED_PIN, HIGH);
-        delay(200);
-        digitalWrite(LED_PIN, LOW);
-        delay(200);
-      }
-      
-      // Send success response
-      String response = "{\"status\":\"received\",\"message\":\"Prescriptions received successfully\",";
-      response += "\"patient\":\"" + patientName + "\",";
-      response += "\"count\":" + totalPrescriptions + "}";
-      server.send(200, "application/json", response);
-    } else {
-      server.send(400, "application/json", "{\"error\":\"No data received\"}");
-    }
-  });
-  
-  // Handle 404 errors
-  server.onNotFound([]() {
-    server.send(404, "application/json", "{\"error\":\"Endpoint not found\"}");
-  });
-}
-
-void handleButtonPress() {
-  // Read button state
-  int reading = digitalRead(BUTTON_PIN);
-  
-  // Check for button state change (debouncing)
-  if (reading != lastButtonState) {
-    lastDebounceTime = millis();
-  }
-  
-  if ((millis() - lastDebounceTime) > debounceDelay) {
-    if (reading != buttonState) {
-      buttonState = reading;
-      
-      // Button pressed (LOW because of INPUT_PULLUP)
-      if (buttonState == LOW) {
-        Serial.println("Manual dispense button pressed");
-        
-        if (!isDispensing) {
-          isDispensing = true;
-          lastDispenseTime = millis();
-          digitalWrite(LED_PIN, HIGH);
-          medicineServo.write(SERVO_DISPENSE_POSITION);
-          Serial.println("Manual dispense initiated");
-        }
-      }
-    }
-  }
-  
-  lastButtonState = reading;
-}
-
-void handleDispensing() {
-  if (isDispensing && (millis() - lastDispenseTime) >= DISPENSE_DELAY) {
-    // Dispensing sequence complete
-    medicineServo.write(SERVO_REST_POSITION);
-    digitalWrite(LED_PIN, LOW);
-    isDispensing = false;
-    
-    Serial.println("Dispensing sequence completed - servo returned to rest position");
-  }
-}
-
-// Additional utility functions
-void blinkLED(int times, int delayMs) {
-  for (int i = 0; i < times; i++) {
-    digitalWrite(LED_PIN, HIGH);
-    delay(delayMs);
-    digitalWrite(LED_PIN, LOW);
-    delay(delayMs);
-  }
-}
-
-void resetSystem() {
-  Serial.println("Resetting system...");
-  medicineServo.write(SERVO_REST_POSITION);
-  digitalWrite(LED_PIN, LOW);
-  isDispensing = false;
-  delay(1000);
-  ESP.restart();
-}
+/*
+ * NodeMCU 1.0 12-E Servo Control for Medical Dispensing System
+ * 
+ * This code controls a servo motor to dispense medicine when triggered
+ * by the web application. The servo rotates to dispense medicine and
+ * returns to original position.
+ * 
+ * Hardware Setup:
+ * - Servo motor connected to D4 (GPIO2)
+ * - LED indicator on D2 (GPIO4) for status
+ * - Button on D3 (GPIO0) for manual testing
+ * 
+ * Network Setup:
+ * - Connect to WiFi network
+ * - Create web server on port 80
+ * - Accept POST requests to /dispense endpoint
+ *
+ * Dispensing never blocks the web server: /dispense queues a job and replies
+ * 202 with its ID, and loop() advances a millis()-driven state machine that
+ * moves the servo one step at a time. /status reports progress meanwhile.
+ *
+ * A /dispense body may carry an idempotency_key. The most recent keys are
+ * remembered with their job IDs, so a request repeated after a lost reply
+ * gets the original job back instead of moving the servo again.
+ *
+ * Request bodies are parsed with ArduinoJson into one fixed-size document,
+ * keeping only the fields this sketch uses. Bodies may be JSON or the more
+ * compact MessagePack (Content-Type: application/msgpack).
+ */
+
+#include <ESP8266WiFi.h>
+#include <ESP8266WebServer.h>
+#include <Servo.h>
+#include <ArduinoJson.h>
+
+// WiFi credentials - Change these to your network
+const char* ssid = "YOUR_WIFI_SSID";
+const char* password = "YOUR_WIFI_PASSWORD";
+
+// Pin definitions
+const int SERVO_PIN = 2;    // D4 - Servo motor
+const int LED_PIN = 4;      // D2 - Status LED
+const int BUTTON_PIN = 0;   // D3 - Manual test button
+
+// Servo settings
+const int SERVO_REST_POSITION = 0;    // Rest position (0 degrees)
+const int SERVO_DISPENSE_POSITION = 90; // Dispense position (90 degrees)
+
+// Dispensing timing, per tablet
+const unsigned long TABLET_HOLD_MS = 1000;   // Hold dispense position
+const unsigned long TABLET_RETURN_MS = 500;  // Wait after returning to rest
+const unsigned long TABLET_BLINK_MS = 200;   // LED off between tablets
+const int MAX_TABLETS = 10;                  // Safety limit per job
+
+// LED blink used to acknowledge received prescriptions
+const unsigned long LED_BLINK_MS = 200;
+
+// Pending dispense jobs (ring buffer)
+const int JOB_QUEUE_SIZE = 4;
+
+// Idempotency keys of recent dispense requests (ring buffer)
+const int RECENT_KEYS_SIZE = 16;
+const size_t MAX_KEY_LENGTH = 40;
+
+// Request parsing limits
+const size_t MAX_BODY_SIZE = 4096;     // Larger bodies are rejected with 413
+const int MAX_PRESCRIPTIONS = 10;      // Prescriptions printed per request
+
+// Create objects
+Servo medicineServo;
+ESP8266WebServer server(80);
+
+// Parsed request bodies live in one statically allocated document instead
+// of heap Strings, so repeated requests cannot fragment the heap
+StaticJsonDocument<2048> requestDoc;
+
+// Fields kept from each request; everything else is skipped while parsing
+StaticJsonDocument<256> dispenseFilter;
+StaticJsonDocument<256> prescriptionsFilter;
+
+// Dispense jobs
+struct DispenseJob {
+  unsigned long id;
+  int quantity;
+  char medicine[32];
+};
+
+// A dispense request's idempotency key and the job it queued
+struct RecentKey {
+  char key[MAX_KEY_LENGTH + 1];
+  unsigned long jobId;
+};
+
+enum DispenseState {
+  STATE_IDLE,
+  STATE_TABLET_HOLD,    // Servo in dispense position
+  STATE_TABLET_RETURN,  // Servo back at rest
+  STATE_TABLET_BLINK    // LED off between tablets
+};
+
+DispenseJob jobQueue[JOB_QUEUE_SIZE];
+int queueHead = 0;
+int queueCount = 0;
+unsigned long nextJobId = 1;
+unsigned long lastCompletedJobId = 0;
+RecentKey recentKeys[RECENT_KEYS_SIZE];
+int recentKeysNext = 0;
+uint32_t bootId = 0;  // Lets clients notice a restart that lost queued jobs
+
+DispenseState dispenseState = STATE_IDLE;
+DispenseJob currentJob;
+int tabletsDone = 0;
+unsigned long stateStartedAt = 0;
+
+// Non-blocking LED blink
+int ledTogglesRemaining = 0;
+unsigned long ledToggledAt = 0;
+
+// Variables
+int buttonState = HIGH;
+int lastButtonState = HIGH;
+unsigned long lastDebounceTime = 0;
+unsigned long debounceDelay = 50;
+
+void setup() {
+  // Initialize serial communication
+  Serial.begin(115200);
+  Serial.println("\n=== Medical Dispensing System ===");
+  bootId = ESP.random();
+  
+  // Initialize pins
+  pinMode(LED_PIN, OUTPUT);
+  pinMode(BUTTON_PIN, INPUT_PULLUP);
+  
+  // Initialize servo
+  medicineServo.attach(SERVO_PIN);
+  medicineServo.write(SERVO_REST_POSITION);
+  
+  // Turn on LED to indicate startup
+  digitalWrite(LED_PIN, HIGH);
+  
+  // Connect to WiFi
+  connectToWiFi();
+  
+  // Setup web server routes
+  setupWebServer();
+  
+  // Start web server
+  server.begin();
+  Serial.println("Web server started");
+  
+  // Turn off LED after successful startup
+  digitalWrite(LED_PIN, LOW);
+  
+  Serial.println("System ready!");
+  Serial.print("Server IP: ");
+  Serial.println(WiFi.localIP());
+}
+
+void loop() {
+  // Handle web server requests
+  server.handleClient();
+  
+  // Handle manual button press
+  handleButtonPress();
+  
+  // Advance the dispensing state machine
+  handleDispensing();
+  
+  // Advance any acknowledgement blink
+  handleLedBlink();
+  
+  // Small delay to prevent overwhelming the system
+  delay(10);
+}
+
+void connectToWiFi() {
+  Serial.print("Connecting to WiFi: ");
+  Serial.println(ssid);
+  
+  WiFi.begin(ssid, password);
+  
+  // Wait for connection
+  while (WiFi.status() != WL_CONNECTED) {
+    delay(500);
+    Serial.print(".");
+    // Blink LED while connecting
+    digitalWrite(LED_PIN, !digitalRead(LED_PIN));
+  }
+  
+  Serial.println("");
+  Serial.println("WiFi connected!");
+  Serial.print("IP address: ");
+  Serial.println(WiFi.localIP());
+}
+
+void setupRequestFilters() {
+  const char* dispenseFields[] = {
+    "patient_name", "medicine_name", "dosage", "frequency",
+    "quantity", "notes", "dispensed_by", "timestamp", "slot", "idempotency_key"
+  };
+  for (const char* field : dispenseFields) {
+    dispenseFilter[field] = true;
+  }
+  
+  const char* prescriptionsFields[] = {
+    "patient_name", "patient_id", "total_prescriptions", "sent_by", "timestamp"
+  };
+  for (const char* field : prescriptionsFields) {
+    prescriptionsFilter[field] = true;
+  }
+  // A filter on element 0 applies to every element of the array
+  JsonObject item = prescriptionsFilter["prescriptions"].createNestedObject();
+  item["medicine_name"] = true;
+  item["dosage"] = true;
+  item["frequency"] = true;
+}
+
+// Read an integer that may have been sent as a number or a string
+int readInt(JsonVariantConst value, int fallback) {
+  if (value.is<const char*>()) {
+    return atoi(value.as<const char*>());
+  }
+  return value | fallback;
+}
+
+void sendJson(int code, const JsonDocument& doc) {
+  String response;
+  serializeJson(doc, response);
+  server.send(code, "application/json", response);
+}
+
+// Parse the request body into requestDoc, keeping only the filtered fields.
+// Sends an error response and returns false if the body is missing or bad.
+bool parseRequestBody(JsonDocument& filter) {
+  if (!server.hasArg("plain")) {
+    server.send(400, "application/json", "{\"error\":\"No data received\"}");
+    return false;
+  }
+  
+  const String& body = server.arg("plain");
+  if (body.length() > MAX_BODY_SIZE) {
+    server.send(413, "application/json", "{\"error\":\"Request body too large\"}");
+    return false;
+  }
+  
+  DeserializationError error;
+  if (server.header("Content-Type").startsWith("application/msgpack")) {
+    error = deserializeMsgPack(requestDoc, body.c_str(), body.length(), DeserializationOption::Filter(filter));
+  } else {
+    error = deserializeJson(requestDoc, body.c_str(), body.length(), DeserializationOption::Filter(filter));
+  }
+  
+  if (error) {
+    Serial.printf("Request parse error: %s\n", error.c_str());
+    StaticJsonDocument<96> reply;
+    reply["error"] = "Invalid request body";
+    reply["detail"] = error.c_str();
+    sendJson(400, reply);
+    return false;
+  }
+  return true;
+}
+
+void setupWebServer() {
+  // Needed to tell JSON and MessagePack bodies apart
+  const char* headerKeys[] = {"Content-Type"};
+  server.collectHeaders(headerKeys, 1);
+  setupRequestFilters();
+  
+  // Root endpoint - system status
+  server.on("/", HTTP_GET, []() {
+    String html = "<!DOCTYPE html><html><head><title>Medical Dispensing System</title>";
+    html += "<meta name='viewport' content='width=device-width, initial-scale=1.0'>";
+    html += "<style>body{font-family:Arial,sans-serif;text-align:center;padding:20px;}";
+    html += ".status{background:#f0f0f0;padding:20px;border-radius:10px;margin:20px;}";
+    html += ".success{background:#d4edda;color:#155724;}";
+    html += ".error{background:#f8d7da;color:#721c24;}</style></head><body>";
+    html += "<h1>Medical Dispensing System</h1>";
+    html += "<div class='status success'>";
+    html += "<h2>System Online</h2>";
+    html += "<p>NodeMCU is connected and ready</p>";
+    html += "<p>IP: " + WiFi.localIP().toString() + "</p>";
+    html += "<p>Uptime: " + String(millis() / 1000) + " seconds</p>";
+    html += "</div>";
+    html += "<div class='status'>";
+    html += "<h3>Endpoints</h3>";
+    html += "<p><strong>GET /</strong> - System status</p>";
+    html += "<p><strong>POST /dispense</strong> - Queue a dispense (202 with job ID)</p>";
+    html += "<p><strong>GET /status</strong> - JSON status</p>";
+    html += "</div></body></html>";
+    
+    server.send(200, "text/html", html);
+  });
+  
+  // Status endpoint - JSON response
+  server.on("/status", HTTP_GET, []() {
+    StaticJsonDocument<384> doc;
+    doc["status"] = "online";
+    doc["ip"] = WiFi.localIP().toString();
+    doc["uptime"] = millis() / 1000;
+    doc["dispensing"] = isDispensing();
+    doc["servo_position"] = medicineServo.read();
+    doc["boot_id"] = bootId;
+    doc["queued"] = queueCount;
+    doc["last_completed_job"] = lastCompletedJobId;
+    // Tells the app that repeating a /dispense with the same key is safe
+    doc["idempotent_dispense"] = true;
+    
+    // Live progress of the job being dispensed
+    if (isDispensing()) {
+      JsonObject job = doc.createNestedObject("job");
+      job["id"] = currentJob.id;
+      job["medicine"] = currentJob.medicine;
+      job["tablets_done"] = tabletsDone;
+      job["tablets_remaining"] = currentJob.quantity - tabletsDone;
+    }
+    
+    sendJson(200, doc);
+  });
+  
+  // Dispense endpoint - main functionality
+  server.on("/dispense", HTTP_POST, []() {
+    Serial.println("Dispense request received");
+    
+    // Parse JSON or MessagePack data from request
+    if (server.hasArg("plain")) {
+      if (!parseRequestBody(dispenseFilter)) {
+        return;
+      }
+      
+      const char* medicineName = requestDoc["medicine_name"] | "";
+      int quantityInt = readInt(requestDoc["quantity"], 1);
+      const char* idempotencyKey = requestDoc["idempotency_key"] | "";
+      if (strlen(idempotencyKey) > MAX_KEY_LENGTH) {
+        server.send(400, "application/json", "{\"error\":\"idempotency_key too long\"}");
+        return;
+      }
+      
+      // A repeat of a request already queued: answer with the original job
+      unsigned long repeatedJobId = findRecentJob(idempotencyKey);
+      if (repeatedJobId != 0) {
+        Serial.println("Repeated request for job " + String(repeatedJobId) + "; not queued again");
+        sendJobRepeated(repeatedJobId);
+        return;
+      }
+      
+      // Print prescription details
+      Serial.println("=== PRESCRIPTION DISPENSING ===");
+      Serial.printf("Patient: %s\n", requestDoc["patient_name"] | "");
+      Serial.printf("Medicine: %s\n", medicineName);
+      Serial.printf("Dosage: %s\n", requestDoc["dosage"] | "");
+      Serial.printf("Frequency: %s\n", requestDoc["frequency"] | "");
+      Serial.printf("Quantity: %d\n", quantityInt);
+      Serial.printf("Notes: %s\n", requestDoc["notes"] | "");
+      Serial.printf("Dispensed by: %s\n", requestDoc["dispensed_by"] | "");
+      Serial.printf("Time: %s\n", requestDoc["timestamp"] | "");
+      Serial.println("================================");
+      
+      if (quantityInt <= 0) quantityInt = 1;
+      if (quantityInt > MAX_TABLETS) quantityInt = MAX_TABLETS; // Safety limit
+      
+      unsigned long jobId = enqueueJob(quantityInt, medicineName);
+      rememberKey(idempotencyKey, jobId);
+      sendJobAccepted(jobId, quantityInt);
+    } else {
+      // Fallback for simple requests without JSON: one tablet
+      sendJobAccepted(enqueueJob(1, "manual"), 1);
+    }
+  });
+  
+  // Prescriptions endpoint - receive all patient prescriptions
+  server.on("/prescriptions", HTTP_POST, []() {
+    Serial.println("Prescriptions data received");
+    
+    if (!parseRequestBody(prescriptionsFilter)) {
+      return;
+    }
+    
+    const char* patientName = requestDoc["patient_name"] | "";
+    
+    // Print prescription summary
+    Serial.println("=== PRESCRIPTIONS RECEIVED ===");
+    Serial.printf("Patient: %s\n", patientName);
+    Serial.printf("Patient ID: %s\n", requestDoc["patient_id"] | "");
+    Serial.printf("Total Prescriptions: %d\n", readInt(requestDoc["total_prescriptions"], 0));
+    Serial.printf("Sent by: %s\n", requestDoc["sent_by"] | "");
+    Serial.printf("Time: %s\n", requestDoc["timestamp"] | "");
+    Serial.println("==============================");
+    
+    // Walk the parsed array once (limit to MAX_PRESCRIPTIONS)
+    int count = 0;
+    for (JsonObjectConst prescription : requestDoc["prescriptions"].as<JsonArrayConst>()) {
+      if (count >= MAX_PRESCRIPTIONS) break;
+      count++;
+      Serial.printf("Prescription %d:\n", count);
+      Serial.printf("  Medicine: %s\n", prescription["medicine_name"] | "");
+      Serial.printf("  Dosage: %s\n", prescription["dosage"] | "");
+      Serial.printf("  Frequency: %s\n", prescription["frequency"] | "");
+    }
+    
+    // Blink LED to indicate data received (advanced from loop())
+    startBlink(3);
+    
+    // Send success response
+    StaticJsonDocument<192> reply;
+    reply["status"] = "received";
+    reply["message"] = "Prescriptions received successfully";
+    reply["patient"] = patientName;
+    reply["count"] = count;
+    sendJson(200, reply);
+  });
+  
+  // Handle 404 errors
+  server.onNotFound([]() {
+    server.send(404, "application/json", "{\"error\":\"Endpoint not found\"}");
+  });
+}
+
+void handleButtonPress() {
+  // Read button state
+  int reading = digitalRead(BUTTON_PIN);
+  
+  // Check for button state change (debouncing)
+  if (reading != lastButtonState) {
+    lastDebounceTime = millis();
+  }
+  
+  if ((millis() - lastDebounceTime) > debounceDelay) {
+    if (reading != buttonState) {
+      buttonState = reading;
+      
+      // Button pressed (LOW because of INPUT_PULLUP)
+      if (buttonState == LOW) {
+        Serial.println("Manual dispense button pressed");
+        
+        if (enqueueJob(1, "manual") != 0) {
+          Serial.println("Manual dispense queued");
+        }
+      }
+    }
+  }
+  
+  lastButtonState = reading;
+}
+
+bool isDispensing() {
+  return dispenseState != STATE_IDLE;
+}
+
+// Queue a dispense job; returns its ID, or 0 when the queue is full
+unsigned long enqueueJob(int quantity, const char* medicine) {
+  if (queueCount >= JOB_QUEUE_SIZE) {
+    return 0;
+  }
+  
+  DispenseJob& job = jobQueue[(queueHead + queueCount) % JOB_QUEUE_SIZE];
+  job.id = nextJobId++;
+  job.quantity = quantity;
+  strncpy(job.medicine, medicine, sizeof(job.medicine) - 1);
+  job.medicine[sizeof(job.medicine) - 1] = '\0';
+  queueCount++;
+  
+  Serial.println("Queued job " + String(job.id) + ": " + String(quantity) + " tablet(s)");
+  return job.id;
+}
+
+// Job queued by an earlier request with this key, or 0
+unsigned long findRecentJob(const char* key) {
+  if (key[0] == '\0') {
+    return 0;
+  }
+  for (int i = 0; i < RECENT_KEYS_SIZE; i++) {
+    if (recentKeys[i].jobId != 0 && strcmp(recentKeys[i].key, key) == 0) {
+      return recentKeys[i].jobId;
+    }
+  }
+  return 0;
+}
+
+// Remember the job a keyed request queued, replacing the oldest entry
+void rememberKey(const char* key, unsigned long jobId) {
+  if (key[0] == '\0' || jobId == 0) {
+    return;
+  }
+  RecentKey& entry = recentKeys[recentKeysNext];
+  strncpy(entry.key, key, MAX_KEY_LENGTH);
+  entry.key[MAX_KEY_LENGTH] = '\0';
+  entry.jobId = jobId;
+  recentKeysNext = (recentKeysNext + 1) % RECENT_KEYS_SIZE;
+}
+
+// Reply 202 with an earlier job's ID; the client follows it through /status
+void sendJobRepeated(unsigned long jobId) {
+  StaticJsonDocument<128> doc;
+  doc["status"] = jobId <= lastCompletedJobId ? "completed" : "queued";
+  doc["job_id"] = jobId;
+  doc["boot_id"] = bootId;
+  doc["repeated"] = true;
+  
+  sendJson(202, doc);
+}
+
+// Reply 202 with the job ID, or 503 if the queue was full
+void sendJobAccepted(unsigned long jobId, int quantity) {
+  if (jobId == 0) {
+    server.send(503, "application/json", "{\"error\":\"Dispense queue full\"}");
+    return;
+  }
+  
+  StaticJsonDocument<192> doc;
+  doc["status"] = "queued";
+  doc["job_id"] = jobId;
+  doc["boot_id"] = bootId;
+  doc["quantity"] = quantity;
+  // Jobs that will run before this one
+  doc["position"] = queueCount - 1 + (isDispensing() ? 1 : 0);
+  
+  sendJson(202, doc);
+}
+
+void enterState(DispenseState state, unsigned long now) {
+  dispenseState = state;
+  stateStartedAt = now;
+}
+
+void startTablet(unsigned long now) {
+  Serial.println("Dispensing tablet " + String(tabletsDone + 1) + " of " + String(currentJob.quantity));
+  medicineServo.write(SERVO_DISPENSE_POSITION);
+  enterState(STATE_TABLET_HOLD, now);
+}
+
+// Dispensing state machine; each call does at most one step and returns
+void handleDispensing() {
+  unsigned long now = millis();
+  
+  switch (dispenseState) {
+    case STATE_IDLE:
+      if (queueCount > 0) {
+        currentJob = jobQueue[queueHead];
+        queueHead = (queueHead + 1) % JOB_QUEUE_SIZE;
+        queueCount--;
+        tabletsDone = 0;
+        
+        // Dispensing owns the LED
+        ledTogglesRemaining = 0;
+        digitalWrite(LED_PIN, HIGH);
+        startTablet(now);
+      }
+      break;
+      
+    case STATE_TABLET_HOLD:
+      if (now - stateStartedAt >= TABLET_HOLD_MS) {
+        medicineServo.write(SERVO_REST_POSITION);
+        enterState(STATE_TABLET_RETURN, now);
+      }
+      break;
+      
+    case STATE_TABLET_RETURN:
+      if (now - stateStartedAt >= TABLET_RETURN_MS) {
+        // Blink LED for each tablet
+        digitalWrite(LED_PIN, LOW);
+        enterState(STATE_TABLET_BLINK, now);
+      }
+      break;
+      
+    case STATE_TABLET_BLINK:
+      if (now - stateStartedAt >= TABLET_BLINK_MS) {
+        tabletsDone++;
+        if (tabletsDone < currentJob.quantity) {
+          digitalWrite(LED_PIN, HIGH);
+          startTablet(now);
+        } else {
+          lastCompletedJobId = currentJob.id;
+          dispenseState = STATE_IDLE;
+          Serial.println("Job " + String(currentJob.id) + " complete - all tablets dispensed");
+        }
+      }
+      break;
+  }
+}
+
+void startBlink(int times) {
+  if (isDispensing()) {
+    return;
+  }
+  ledTogglesRemaining = times * 2;
+  ledToggledAt = millis() - LED_BLINK_MS;  // First toggle happens right away
+}
+
+void handleLedBlink() {
+  if (ledTogglesRemaining > 0 && millis() - ledToggledAt >= LED_BLINK_MS) {
+    digitalWrite(LED_PIN, !digitalRead(LED_PIN));
+    ledToggledAt = millis();
+    ledTogglesRemaining--;
+  }
+}
+
+// Additional utility functions
+void blinkLED(int times, int delayMs) {
+  for (int i = 0; i < times; i++) {
+    digitalWrite(LED_PIN, HIGH);
+    delay(delayMs);
+    digitalWrite(LED_PIN, LOW);
+    delay(delayMs);
+  }
+}
+
+void resetSystem() {
+  Serial.println("Resetting system...");
+  medicineServo.write(SERVO_REST_POSITION);
+  digitalWrite(LED_PIN, LOW);
+  dispenseState = STATE_IDLE;
+  queueCount = 0;
+  delay(1000);
+  ESP.restart();
+}
@@ -0,0 +1,133 @@
+"""
+Filtered and sorted patient queries for /api/patients.
+
+Every request the API accepts becomes one Firestore query that a composite
+index in firestore.indexes.json serves directly, so a page reads only the
+patients it returns:
+
+- equality filters on `created_by` and `has_active_prescriptions`
+- at most one range: a name prefix (on `lowercase_name`), an age range, or
+  a `created_at` range
+- ordered by the range field, or by the requested sort when there is none
+"""
+
+from datetime import datetime, timedelta
+
+from firebase_admin import firestore
+
+ASCENDING = firestore.Query.ASCENDING
+DESCENDING = firestore.Query.DESCENDING
+
+# sort parameter -> (field, direction); each has its indexes declared
+SORTS = {
+    '-created_at': ('created_at', DESCENDING),
+    'created_at': ('created_at', ASCENDING),
+    'name': ('lowercase_name', ASCENDING),
+    'age': ('age', ASCENDING),
+    '-age': ('age', DESCENDING)
+}
+DEFAULT_SORT = '-created_at'
+
+# Sorts a range filter can be combined with: Firestore orders by the
+# range field first
+RANGE_SORTS = {
+    'lowercase_name': ('name',),
+    'age': ('age', '-age'),
+    'created_at': ('-created_at', 'created_at')
+}
+
+TRUE_VALUES = ('1', 'true', 'yes')
+FALSE_VALUES = ('0', 'false', 'no')
+
+
+def _int(args, name):
+    value = args.get(name, '').strip()
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f'{name} must be a whole number')
+
+
+def _date(args, name, end=False):
+    """A YYYY-MM-DD or ISO datetime bound; a date as end covers the whole day"""
+    value = args.get(name, '').strip()
+    if not value:
+        return None
+    try:
+        when = datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f'{name} must be a date (YYYY-MM-DD) or an ISO datetime')
+    if end and len(value) == 10:
+        when += timedelta(days=1)
+    return when
+
+
+def parse_filters(args):
+    """Read the query parameters into a filters dict.
+
+    Raises ValueError, with a message for the client, for malformed values
+    and for combinations no index serves.
+    """
+    active = args.get('active', '').strip().lower()
+    if active and active not in TRUE_VALUES + FALSE_VALUES:
+        raise ValueError('active must be true or false')
+
+    filters = {
+        'name': args.get('name', '').strip().lower() or None,
+        'age_min': _int(args, 'age_min'),
+        'age_max': _int(args, 'age_max'),
+        'created_from': _date(args, 'created_from'),
+        # Exclusive
+        'created_to': _date(args, 'created_to', end=True),
+        'created_by': args.get('created_by', '').strip() or None,
+        'active': active in TRUE_VALUES if active else None
+    }
+
+    ranges = []
+    if filters['name']:
+        ranges.append('lowercase_name')
+    if filters['age_min'] is not None or filters['age_max'] is not None:
+        ranges.append('age')
+    if filters['created_from'] or filters['created_to']:
+        ranges.append('created_at')
+    if len(ranges) > 1:
+        raise ValueError('Filter by at most one of name, age range and created date range')
+    filters['range'] = ranges[0] if ranges else None
+
+    sort = args.get('sort', '').strip()
+    if sort and sort not in SORTS:
+        raise ValueError(f"sort must be one of {', '.join(SORTS)}")
+    if filters['range']:
+        allowed = RANGE_SORTS[filters['range']]
+        if sort and sort not in allowed:
+            raise ValueError(f"With this filter, sort must be {' or '.join(allowed)}")
+        sort = sort or allowed[0]
+    filters['sort'] = sort or DEFAULT_SORT
+    return filters
+
+
+def build_query(collection, filters):
+    """Apply parsed filters and their sort to the patients collection"""
+    query = collection
+    if filters['created_by']:
+        query = query.where('created_by', '==', filters['created_by'])
+    if filters['active'] is not None:
+        query = query.where('has_active_prescriptions', '==', filters['active'])
+
+    if filters['name']:
+        # Prefix range over the lowercase copy of the name
+        query = (query.where('lowercase_name', '>=', filters['name'])
+                      .where('lowercase_name', '<', filters['name'] + '\uf8ff'))
+    if filters['age_min'] is not None:
+        query = query.where('age', '>=', filters['age_min'])
+    if filters['age_max'] is not None:
+        query = query.where('age', '<=', filters['age_max'])
+    if filters['created_from']:
+        query = query.where('created_at', '>=', filters['created_from'])
+    if filters['created_to']:
+        query = query.where('created_at', '<', filters['created_to'])
+
+    field, direction = SORTS[filters['sort']]
+    return query.order_by(field, direction=direction)
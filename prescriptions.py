@@ -0,0 +1,178 @@
+"""
+Prescription storage helpers.
+
+Prescriptions live in a `patients/{patient_id}/prescriptions` subcollection,
+one document per prescription, so prescribing and dispensing each write a
+single small document instead of rewriting the whole patient record. The
+patient keeps an `active_prescription_count` that is adjusted atomically
+alongside those writes, and a `has_active_prescriptions` flag for queries
+that filter on it (see patient_query.py).
+
+Every write also stamps `updated_at` with the server time, and prescriptions
+carry the `assistant_id` of the patient's assistant; live_updates.py follows
+prescription changes through both.
+
+Dispensing a medicine whose stock is tracked also takes the tablets out of
+its inventory (see inventory.py) in the same transaction.
+"""
+
+from firebase_admin import firestore
+
+import analytics
+import inventory
+import stats
+
+
+def prescriptions_ref(db, patient_id):
+    """Return the prescriptions subcollection of a patient"""
+    return db.collection('patients').document(patient_id).collection('prescriptions')
+
+
+def count_active_prescriptions(prescriptions):
+    """Number of prescriptions still waiting to be dispensed"""
+    return sum(1 for prescription in prescriptions if prescription.get('status') == 'active')
+
+
+def list_prescriptions(db, patient_id):
+    """Load a patient's prescriptions, oldest first, each with its `id`"""
+    prescriptions = []
+    for doc in prescriptions_ref(db, patient_id).order_by('prescribed_at').stream():
+        prescription = doc.to_dict()
+        prescription['id'] = doc.id
+        prescriptions.append(prescription)
+    return prescriptions
+
+
+async def list_prescriptions_async(async_db, patient_id):
+    """list_prescriptions for a Firestore AsyncClient"""
+    prescriptions = []
+    async for doc in prescriptions_ref(async_db, patient_id).order_by('prescribed_at').stream():
+        prescription = doc.to_dict()
+        prescription['id'] = doc.id
+        prescriptions.append(prescription)
+    return prescriptions
+
+
+def stamped(updates, assistant_id=None):
+    """updates plus the server-side `updated_at` (and `assistant_id` when known)"""
+    updates = dict(updates, updated_at=firestore.SERVER_TIMESTAMP)
+    if assistant_id:
+        updates['assistant_id'] = assistant_id
+    return updates
+
+
+def add_prescription(db, patient_id, prescription, assistant_id=None):
+    """Insert a prescription and bump the patient's active count atomically.
+
+    The dashboard summaries (clinic-wide, and for assistant_id, the
+    assistant who registered the patient) and the analytics rollups are
+    updated in the same batch.
+
+    Raises google.api_core.exceptions.NotFound if the patient does not exist;
+    in that case nothing is written.
+    """
+    patient_ref = db.collection('patients').document(patient_id)
+    prescription_ref = prescriptions_ref(db, patient_id).document()
+
+    batch = db.batch()
+    batch.set(prescription_ref, stamped(prescription, assistant_id))
+    batch.update(patient_ref, {'active_prescription_count': firestore.Increment(1), 'has_active_prescriptions': True})
+    stats.record_prescribed(batch, db, assistant_id)
+    analytics.record_prescribed(batch, db, prescription, assistant_id)
+    batch.commit()
+    return prescription_ref.id
+
+
+async def add_prescription_async(async_db, patient_id, prescription, assistant_id=None):
+    """add_prescription for a Firestore AsyncClient"""
+    patient_ref = async_db.collection('patients').document(patient_id)
+    prescription_ref = prescriptions_ref(async_db, patient_id).document()
+
+    batch = async_db.batch()
+    batch.set(prescription_ref, stamped(prescription, assistant_id))
+    batch.update(patient_ref, {'active_prescription_count': firestore.Increment(1), 'has_active_prescriptions': True})
+    stats.record_prescribed(batch, async_db, assistant_id)
+    analytics.record_prescribed(batch, async_db, prescription, assistant_id)
+    await batch.commit()
+    return prescription_ref.id
+
+
+def mark_dispensed(db, patient_id, prescription_id, updates):
+    """Mark an active prescription as dispensed.
+
+    Runs in a transaction so a prescription is only ever moved out of the
+    active state once, even when two dispenses race, and the dashboard
+    summaries, analytics rollups and medicine stock are counted exactly
+    once with it (`device_id` in updates names the dispenser used).
+    Returns False if the prescription is missing or was no longer active.
+    """
+    patient_ref = db.collection('patients').document(patient_id)
+    prescription_ref = prescriptions_ref(db, patient_id).document(prescription_id)
+
+    @firestore.transactional
+    def apply(transaction):
+        snapshot = prescription_ref.get(transaction=transaction)
+        if not snapshot.exists or snapshot.get('status') != 'active':
+            return False
+        patient = patient_ref.get(transaction=transaction)
+        patient_data = patient.to_dict() if patient.exists else {}
+        assistant_id = patient_data.get('created_by')
+        # Exact: a concurrent prescription changes the patient and retries this
+        still_active = patient_data.get('active_prescription_count', 1) > 1
+        # Every read has to happen before the first write
+        medicine_id = snapshot.to_dict().get('medicine_id')
+        stock = inventory.inventory_ref(db, medicine_id).get(transaction=transaction) if medicine_id else None
+        transaction.update(prescription_ref, stamped(dict(updates, status='dispensed'), assistant_id))
+        transaction.update(patient_ref, {
+            'active_prescription_count': firestore.Increment(-1),
+            'has_active_prescriptions': still_active
+        })
+        stats.record_dispensed(transaction, db, assistant_id)
+        analytics.record_dispensed(transaction, db, snapshot.to_dict(), updates.get('dispensed_at'),
+                                   updates.get('quantity_dispensed'), updates.get('device_id'), assistant_id)
+        if stock is not None:
+            inventory.record_dispensed(transaction, db, stock,
+                                       analytics.tablet_count(updates.get('quantity_dispensed')))
+        return True
+
+    return apply(db.transaction())
+
+
+def migrate_embedded_prescriptions(db):
+    """Move legacy `prescriptions` arrays into the subcollection.
+
+    Each array entry gets the stable ID `legacy-<index>`, so re-running the
+    migration after an interruption overwrites rather than duplicates.
+    Returns (patients_migrated, prescriptions_migrated).
+    """
+    patients_migrated = 0
+    prescriptions_migrated = 0
+
+    for doc in db.collection('patients').stream():
+        patient_data = doc.to_dict()
+        if 'prescriptions' not in patient_data:
+            continue
+
+        embedded = patient_data.get('prescriptions') or []
+        batch = db.batch()
+        pending = 0
+        for index, prescription in enumerate(embedded):
+            batch.set(doc.reference.collection('prescriptions').document(f'legacy-{index:04d}'), prescription)
+            pending += 1
+            # Leave room in the final batch for the patient update
+            if pending == 499:
+                batch.commit()
+                batch = db.batch()
+                pending = 0
+
+        batch.update(doc.reference, {
+            'prescriptions': firestore.DELETE_FIELD,
+            'active_prescription_count': count_active_prescriptions(embedded),
+            'has_active_prescriptions': count_active_prescriptions(embedded) > 0
+        })
+        batch.commit()
+
+        patients_migrated += 1
+        prescriptions_migrated += len(embedded)
+
+    return patients_migrated, prescriptions_migrated
@@ -1,234 +1,307 @@
-// Main JavaScript functionality
-document.addEventListener('DOMContentLoaded', function() {
-    // Initialize tooltips
-    var tooltipTriggerList = [].slice.call(document.querySelectorAll('[data-bs-toggle="tooltip"]'));
-    var tooltipList = tooltipTriggerList.map(function (tooltipTriggerEl) {
-        return new bootstrap.Tooltip(tooltipTriggerEl);
-    });
-
-    // Auto-hide alerts after 5 seconds
-    setTimeout(function() {
-        var alerts = document.querySelectorAll('.alert');
-        alerts.forEach(function(alert) {
-            var bsAlert = new bootstrap.Alert(alert);
-            bsAlert.close();
-        });
-    }, 5000);
-
-    // Medicine search functionality
-    const medicineSearchInput = document.getElementById('medicineSearch');
-    const medicineSearchResults = document.getElementById('medicineSearchResults');
-    
-    if (medicineSearchInput && medicineSearchResults) {
-        let searchTimeout;
-        
-        medicineSearchInput.addEventListener('input', function() {
-            clearTimeout(searchTimeout);
-            const query = this.value.trim();
-            
-            if (query.length < 2) {
-                medicineSearchResults.style.display = 'none';
-                return;
-            }
-            
-            searchTimeout = setTimeout(() => {
-                searchMedicines(query);
-            }, 300);
-        });
-        
-        // Hide search results when clicking outside
-        document.addEventListener('click', function(e) {
-            if (!medicineSearchInput.contains(e.target) && !medicineSearchResults.contains(e.target)) {
-                medicineSearchResults.style.display = 'none';
-            }
-        });
-    }
-
-    // Dispense button functionality
-    const dispenseButtons = document.querySelectorAll('.dispense-btn');
-    dispenseButtons.forEach(button => {
-        button.addEventListener('click', function(e) {
-            e.preventDefault();
-            
-            const form = this.closest('form');
-            const patientId = form.querySelector('input[name="patient_id"]').value;
-            const prescriptionIndex = form.querySelector('input[name="prescription_index"]').value;
-            
-            // Show loading state
-            this.classList.add('loading');
-            this.disabled = true;
-            
-            // Submit form
-            fetch(form.action, {
-                method: 'POST',
-                body: new FormData(form)
-            })
-            .then(response => {
-                if (response.ok) {
-                    // Show success message
-                    showNotification('Medicine dispensed successfully!', 'success');
-                    
-                    // Update prescription status
-                    const prescriptionCard = this.closest('.prescription-card');
-                    prescriptionCard.classList.remove('active');
-                    prescriptionCard.classList.add('dispensed');
-                    
-                    const statusBadge = prescriptionCard.querySelector('.prescription-status');
-                    statusBadge.textContent = 'Dispensed';
-                    statusBadge.classList.remove('active');
-                    statusBadge.classList.add('dispensed');
-                    
-                    // Disable button
-                    this.disabled = true;
-                    this.textContent = 'Dispensed';
-                } else {
-                    throw new Error('Failed to dispense medicine');
-                }
-            })
-            .catch(error => {
-                console.error('Error:', error);
-                showNotification('Failed to dispense medicine. Please try again.', 'error');
-            })
-            .finally(() => {
-                this.classList.remove('loading');
-                this.disabled = false;
-            });
-        });
-    });
-
-    // Form validation
-    const forms = document.querySelectorAll('.needs-validation');
-    forms.forEach(form => {
-        form.addEventListener('submit', function(event) {
-            if (!form.checkValidity()) {
-                event.preventDefault();
-                event.stopPropagation();
-            }
-            form.classList.add('was-validated');
-        });
-    });
-
-    // Patient search functionality
-    const patientSearchInput = document.getElementById('patientSearch');
-    if (patientSearchInput) {
-        patientSearchInput.addEventListener('input', function() {
-            const query = this.value.toLowerCase();
-            const patientCards = document.querySelectorAll('.patient-card');
-            
-            patientCards.forEach(card => {
-                const patientName = card.querySelector('.patient-name').textContent.toLowerCase();
-                const patientAge = card.querySelector('.patient-age').textContent;
-                
-                if (patientName.includes(query) || patientAge.includes(query)) {
-                    card.style.display = 'block';
-                } else {
-                    card.style.display = 'none';
-                }
-            });
-        });
-    }
-});
-
-// Medicine search function
-function searchMedicines(query) {
-    // This would typically make an AJAX request to your backend
-    // For now, we'll simulate with existing medicines on the page
-    const medicineItems = document.querySelectorAll('.medicine-item');
-    const results = [];
-    
-    medicineItems.forEach(item => {
-        const name = item.dataset.name.toLowerCase();
-        if (name.includes(query.toLowerCase())) {
-            results.push({
-                id: item.dataset.id,
-                name: item.dataset.name,
-                dosage: item.dataset.dosage,
-                frequency: item.dataset.frequency
-            });
-        }
-    });
-    
-    displaySearchResults(results);
-}
-
-// Display search results
-function displaySearchResults(results) {
-    const medicineSearchResults = document.getElementById('medicineSearchResults');
-    
-    if (results.length === 0) {
-        medicineSearchResults.innerHTML = '<div class="medicine-search-item text-muted">No medicines found</div>';
-    } else {
-        medicineSearchResults.innerHTML = results.map(medicine => `
-            <div class="medicine-search-item" onclick="selectMedicine('${medicine.id}', '${medicine.name}')">
-                <div class="fw-bold">${medicine.name}</div>
-                <small class="text-muted">${medicine.dosage} - ${medicine.frequency}</small>
-            </div>
-        `).join('');
-    }
-    
-    medicineSearchResults.style.display = 'block';
-}
-
-// Select medicine from search results
-function selectMedicine(medicineId, medicineName) {
-    const medicineIdInput = document.getElementById('medicine_id');
-    const medicineNameDisplay = document.getElementById('selectedMedicineName');
-    const medicineSearchInput = document.getElementById('medicineSearch');
-    const medicineSearchResults = document.getElementById('medicineSearchResults');
-    
-    if (medicineIdInput) {
-        medicineIdInput.value = medicineId;
-    }
-    
-    if (medicineNameDisplay) {
-        medicineNameDisplay.textContent = medicineName;
-        medicineNameDisplay.style.display = 'block';
-    }
-    
-    if (medicineSearchInput) {
-        medicineSearchInput.value = medicineName;
-    }
-    
-    medicineSearchResults.style.display = 'none';
-}
-
-// Show notification
-function showNotification(message, type = 'info') {
-    const alertDiv = document.createElement('div');
-    alertDiv.className = `alert alert-${type} alert-dismissible fade show`;
-    alertDiv.innerHTML = `
-        ${message}
-        <button type="button" class="btn-close" data-bs-dismiss="alert"></button>
-    `;
-    
-    const container = document.querySelector('.container-fluid');
-    container.insertBefore(alertDiv, container.firstChild);
-    
-    // Auto-hide after 5 seconds
-    setTimeout(() => {
-        const bsAlert = new bootstrap.Alert(alertDiv);
-        bsAlert.close();
-    }, 5000);
-}
-
-// Confirm action
-function confirmAction(message, callback) {
-    if (confirm(message)) {
-        callback();
-    }
-}
-
-// Format date
-function formatDate(dateString) {
-    const date = new Date(dateString);
-    return date.toLocaleDateString() + ' ' + date.toLocaleTimeString();
-}
-
-// Copy to clipboard
-function copyToClipboard(text) {
-    navigator.clipboard.writeText(text).then(() => {
-        showNotification('Copied to clipboard!', 'success');
-    }).catch(() => {
-        showNotification('Failed to copy to clipboard', 'error');
-    });
-}
+// Main JavaScript functionality
+document.addEventListener('DOMContentLoaded', function() {
+    // Initialize tooltips
+    var tooltipTriggerList = [].slice.call(document.querySelectorAll('[data-bs-toggle="tooltip"]'));
+    var tooltipList = tooltipTriggerList.map(function (tooltipTriggerEl) {
+        return new bootstrap.Tooltip(tooltipTriggerEl);
+    });
+
+    // Auto-hide alerts after 5 seconds
+    setTimeout(function() {
+        var alerts = document.querySelectorAll('.alert');
+        alerts.forEach(function(alert) {
+            var bsAlert = new bootstrap.Alert(alert);
+            bsAlert.close();
+        });
+    }, 5000);
+
+    // Dispense button functionality (delegated, so cards pushed by live updates work too)
+    document.addEventListener('click', function(e) {
+        const button = e.target.closest('.dispense-btn');
+        if (!button) {
+            return;
+        }
+        e.preventDefault();
+        dispenseFromButton(button);
+    });
+
+    // Form validation
+    const forms = document.querySelectorAll('.needs-validation');
+    forms.forEach(form => {
+        form.addEventListener('submit', function(event) {
+            if (!form.checkValidity()) {
+                event.preventDefault();
+                event.stopPropagation();
+            }
+            form.classList.add('was-validated');
+        });
+    });
+
+    // Patient search functionality (server-side, over the same paged view)
+    const patientSearchInput = document.getElementById('patientSearch');
+    if (patientSearchInput && document.getElementById('patientsList')) {
+        let patientSearchTimeout;
+        
+        patientSearchInput.addEventListener('input', function() {
+            clearTimeout(patientSearchTimeout);
+            const query = this.value.trim();
+            
+            patientSearchTimeout = setTimeout(() => {
+                searchPatients(query);
+            }, 300);
+        });
+    }
+});
+
+// Random key identifying one dispense request across retries
+function newIdempotencyKey() {
+    const bytes = new Uint8Array(16);
+    crypto.getRandomValues(bytes);
+    return Array.from(bytes, b => b.toString(16).padStart(2, '0')).join('');
+}
+
+// Queue a dispense for the prescription card of a dispense button, then
+// follow the job until the device finishes
+function dispenseFromButton(button) {
+    const form = button.closest('form');
+    const patientId = form.querySelector('input[name="patient_id"]').value;
+    const prescriptionId = form.querySelector('input[name="prescription_id"]').value;
+    
+    // Kept until the server gives a definite answer, so trying again after a
+    // lost response gets the job already queued instead of a second dispense
+    if (!button.dataset.idempotencyKey) {
+        button.dataset.idempotencyKey = newIdempotencyKey();
+    }
+    
+    // Show loading state
+    button.classList.add('loading');
+    button.disabled = true;
+    
+    // Queue the dispense, then follow the job until the device finishes
+    fetch(form.action, {
+        method: 'POST',
+        headers: { 'Accept': 'application/json', 'Idempotency-Key': button.dataset.idempotencyKey },
+        body: new FormData(form)
+    })
+    .then(response => response.json().then(data => {
+        if (!response.ok) {
+            delete button.dataset.idempotencyKey;
+            throw new Error(data.error || 'Failed to dispense medicine');
+        }
+        showNotification('Dispense queued. Waiting for the device...', 'info');
+        return waitForDispenseJob(data.job_id);
+    }))
+    .then(job => {
+        // Show success message
+        showNotification('Medicine dispensed successfully!', 'success');
+        
+        // Update prescription status
+        const prescriptionCard = button.closest('.prescription-card');
+        prescriptionCard.classList.remove('active');
+        prescriptionCard.classList.add('dispensed');
+        
+        const statusBadge = prescriptionCard.querySelector('.prescription-status');
+        statusBadge.textContent = 'Dispensed';
+        statusBadge.classList.remove('active');
+        statusBadge.classList.add('dispensed');
+        
+        button.classList.remove('loading');
+        button.textContent = 'Dispensed';
+    })
+    .catch(error => {
+        console.error('Error:', error);
+        // Network failures (TypeError) keep the key; anything else was final
+        if (!(error instanceof TypeError)) {
+            delete button.dataset.idempotencyKey;
+        }
+        showNotification(error.message || 'Failed to dispense medicine. Please try again.', 'error');
+        button.classList.remove('loading');
+        button.disabled = false;
+    });
+}
+
+// Follow prescription changes pushed by the server (Server-Sent Events);
+// the browser reconnects by itself and resumes after the last event seen
+function followPrescriptionEvents(url, onEvent) {
+    if (!window.EventSource) {
+        return null;
+    }
+    const source = new EventSource(url);
+    const seen = new Set();
+    source.addEventListener('prescription', function(e) {
+        // A stream resumed on another server may repeat an event
+        if (e.lastEventId && seen.has(e.lastEventId)) {
+            return;
+        }
+        seen.add(e.lastEventId);
+        onEvent(JSON.parse(e.data));
+    });
+    // The stream could not be resumed without missing changes
+    source.addEventListener('reset', function() {
+        source.close();
+        location.reload();
+    });
+    return source;
+}
+
+// Poll a queued dispense job until it completes or fails; a job that is
+// recording has already dispensed, only saving the result is pending
+function waitForDispenseJob(jobId, interval = 1000) {
+    return new Promise((resolve, reject) => {
+        const poll = () => {
+            fetch(`/api/dispense_jobs/${encodeURIComponent(jobId)}`)
+                .then(response => response.json())
+                .then(job => {
+                    if (job.status === 'completed' || job.status === 'recording') {
+                        resolve(job);
+                    } else if (job.status === 'failed' || job.error) {
+                        reject(new Error(job.error || 'Failed to dispense medicine'));
+                    } else {
+                        setTimeout(poll, interval);
+                    }
+                })
+                .catch(reject);
+        };
+        poll();
+    });
+}
+
+// Search patients on the server and render the matching page: a number
+// matches the age, anything else a name prefix, and the status filter
+// narrows to patients with or without active prescriptions
+function searchPatients(query, cursor = null) {
+    const patientsList = document.getElementById('patientsList');
+    const patientsPager = document.getElementById('patientsPager');
+    const params = new URLSearchParams({ format: 'html' });
+    if (/^\d+$/.test(query)) {
+        params.set('age_min', query);
+        params.set('age_max', query);
+    } else if (query) {
+        params.set('name', query);
+    }
+    const statusFilter = document.getElementById('statusFilter');
+    if (statusFilter && statusFilter.value) {
+        params.set('active', statusFilter.value === 'active');
+    }
+    if (cursor) {
+        params.set('cursor', cursor);
+    }
+    
+    fetch(`/api/patients?${params.toString()}`)
+        .then(response => response.json())
+        .then(data => {
+            if (data.error) {
+                throw new Error(data.error);
+            }
+            
+            if (cursor) {
+                patientsList.insertAdjacentHTML('beforeend', data.html);
+            } else if (data.count === 0) {
+                patientsList.innerHTML = '<div class="col-12 text-center text-muted py-4"><i class="fas fa-search"></i> No patients found</div>';
+            } else {
+                patientsList.innerHTML = data.html;
+            }
+            
+            const patientCount = document.getElementById('patientCount');
+            if (patientCount) {
+                patientCount.textContent = patientsList.querySelectorAll('.patient-card').length;
+            }
+            
+            if (patientsPager) {
+                patientsPager.innerHTML = '';
+                if (data.next_cursor) {
+                    const loadMore = document.createElement('button');
+                    loadMore.className = 'btn btn-outline-primary btn-sm';
+                    loadMore.innerHTML = 'Load More <i class="fas fa-angle-down"></i>';
+                    loadMore.addEventListener('click', () => searchPatients(query, data.next_cursor));
+                    patientsPager.appendChild(loadMore);
+                }
+            }
+        })
+        .catch(error => {
+            console.error('Patient search error:', error);
+            showNotification('Patient search failed. Please try again.', 'error');
+        });
+}
+
+// Display search results
+function displaySearchResults(results) {
+    const medicineSearchResults = document.getElementById('medicineSearchResults');
+    
+    if (results.length === 0) {
+        medicineSearchResults.innerHTML = '<div class="medicine-search-item text-muted">No medicines found</div>';
+    } else {
+        medicineSearchResults.innerHTML = results.map(medicine => `
+            <div class="medicine-search-item" onclick="selectMedicine('${medicine.id}', '${medicine.name}')">
+                <div class="fw-bold">${medicine.name}</div>
+                <small class="text-muted">${medicine.dosage} - ${medicine.frequency}</small>
+            </div>
+        `).join('');
+    }
+    
+    medicineSearchResults.style.display = 'block';
+}
+
+// Select medicine from search results
+function selectMedicine(medicineId, medicineName) {
+    const medicineIdInput = document.getElementById('medicine_id');
+    const medicineNameDisplay = document.getElementById('selectedMedicineName');
+    const medicineSearchInput = document.getElementById('medicineSearch');
+    const medicineSearchResults = document.getElementById('medicineSearchResults');
+    
+    if (medicineIdInput) {
+        medicineIdInput.value = medicineId;
+    }
+    
+    if (medicineNameDisplay) {
+        medicineNameDisplay.textContent = medicineName;
+        medicineNameDisplay.style.display = 'block';
+    }
+    
+    if (medicineSearchInput) {
+        medicineSearchInput.value = medicineName;
+    }
+    
+    medicineSearchResults.style.display = 'none';
+}
+
+// Show notification
+function showNotification(message, type = 'info') {
+    const alertDiv = document.createElement('div');
+    alertDiv.className = `alert alert-${type} alert-dismissible fade show`;
+    alertDiv.innerHTML = `
+        ${message}
+        <button type="button" class="btn-close" data-bs-dismiss="alert"></button>
+    `;
+    
+    const container = document.querySelector('.container-fluid');
+    container.insertBefore(alertDiv, container.firstChild);
+    
+    // Auto-hide after 5 seconds
+    setTimeout(() => {
+        const bsAlert = new bootstrap.Alert(alertDiv);
+        bsAlert.close();
+    }, 5000);
+}
+
+// Confirm action
+function confirmAction(message, callback) {
+    if (confirm(message)) {
+        callback();
+    }
+}
+
+// Format date
+function formatDate(dateString) {
+    const date = new Date(dateString);
+    return date.toLocaleDateString() + ' ' + date.toLocaleTimeString();
+}
+
+// Copy to clipboard
+function copyToClipboard(text) {
+    navigator.clipboard.writeText(text).then(() => {
+        showNotification('Copied to clipboard!', 'success');
+    }).catch(() => {
+        showNotification('Failed to copy to clipboard', 'error');
+    });
+}
@@ -0,0 +1,158 @@
+"""
+Denormalized dashboard summaries.
+
+`stats/summary` holds clinic-wide counters and `stats/summary/assistants/{uid}`
+the same counters for the patients one assistant registered:
+
+    {
+        'patient_count': 12,
+        'medicine_count': 30,              # clinic-wide summary only
+        'active_prescriptions': 4,
+        'dispensed_total': 57,
+        'recent_patients': [{'id': ..., 'name': ..., 'created_at': ...}, ...]
+    }
+
+The counters are adjusted with Increment in the same batch or transaction
+as the write they describe, so the dashboard header costs one batched read
+instead of scanning collections. Per-day dispense counts are not kept here,
+where they would grow the document every day; "dispensed today" comes from
+the day's analytics rollup (see analytics.py), read in the same get_all.
+"""
+
+from datetime import datetime
+
+from firebase_admin import firestore
+
+import analytics
+
+RECENT_PATIENTS = 5
+
+
+def summary_ref(db):
+    return db.collection('stats').document('summary')
+
+
+def assistant_summary_ref(db, assistant_id):
+    return summary_ref(db).collection('assistants').document(assistant_id)
+
+
+def summary_refs(db, assistant_id):
+    refs = [summary_ref(db)]
+    if assistant_id:
+        refs.append(assistant_summary_ref(db, assistant_id))
+    return refs
+
+
+def today_key(now=None):
+    return (now or datetime.now()).strftime('%Y-%m-%d')
+
+
+def get_summary(db, assistant_id=None):
+    """Summary for the whole clinic, or for one assistant; {} if none exists yet"""
+    ref = assistant_summary_ref(db, assistant_id) if assistant_id else summary_ref(db)
+    day_ref = db.collection(analytics.DAILY_COLLECTION).document(today_key())
+    docs = {doc.reference.path: doc for doc in db.get_all([ref, day_ref])}
+    doc, day = docs[ref.path], docs[day_ref.path]
+    summary = doc.to_dict() if doc.exists else {}
+    summary['update_time'] = doc.update_time if doc.exists else None
+    rollup = day.to_dict() if day.exists else {}
+    counts = rollup.get('assistants', {}).get(assistant_id, {}) if assistant_id else rollup.get('totals', {})
+    summary['dispensed_today'] = counts.get('dispensed', 0)
+    return summary
+
+
+def add_patient(db, patient_data):
+    """Create a patient and count it in the summaries, in one transaction.
+
+    Returns the new patient ID.
+    """
+    patient_ref = db.collection('patients').document()
+    refs = summary_refs(db, patient_data.get('created_by'))
+    recent_entry = {
+        'id': patient_ref.id,
+        'name': patient_data['name'],
+        'created_at': patient_data['created_at']
+    }
+
+    @firestore.transactional
+    def apply(transaction):
+        # All reads come before the writes in a Firestore transaction
+        snapshots = [ref.get(transaction=transaction) for ref in refs]
+        transaction.set(patient_ref, patient_data)
+        for ref, snapshot in zip(refs, snapshots):
+            recent = snapshot.to_dict().get('recent_patients', []) if snapshot.exists else []
+            transaction.set(ref, {
+                'patient_count': firestore.Increment(1),
+                'recent_patients': [recent_entry] + recent[:RECENT_PATIENTS - 1]
+            }, merge=True)
+
+    apply(db.transaction())
+    return patient_ref.id
+
+
+def record_medicine_added(writer, db):
+    writer.set(summary_ref(db), {'medicine_count': firestore.Increment(1)}, merge=True)
+
+
+def record_prescribed(writer, db, assistant_id):
+    """Add the counter updates for a new prescription to a batch or transaction"""
+    for ref in summary_refs(db, assistant_id):
+        writer.set(ref, {'active_prescriptions': firestore.Increment(1)}, merge=True)
+
+
+def record_dispensed(writer, db, assistant_id):
+    """Add the counter updates for a dispensed prescription to a batch or transaction"""
+    for ref in summary_refs(db, assistant_id):
+        writer.set(ref, {
+            'active_prescriptions': firestore.Increment(-1),
+            'dispensed_total': firestore.Increment(1)
+        }, merge=True)
+
+
+def rebuild_summaries(db):
+    """Recompute every summary from the patients and medicines collections.
+
+    Used to create the summaries for existing data or to repair drift.
+    `dispensed_total` is not recomputed; the `dispensed_per_day` map older
+    versions kept is removed. Returns the number of summary documents written.
+    """
+    def empty():
+        return {'patient_count': 0, 'active_prescriptions': 0, 'recent_patients': [],
+                'dispensed_per_day': firestore.DELETE_FIELD}
+
+    def newest_first(entry):
+        created_at = entry['created_at']
+        return created_at.timestamp() if created_at else 0
+
+    clinic = empty()
+    assistants = {}
+    fields = ['name', 'created_by', 'created_at', 'active_prescription_count']
+    # No order_by, so patients without created_at are counted too
+    for doc in db.collection('patients').select(fields).stream():
+        patient = doc.to_dict()
+        entry = {'id': doc.id, 'name': patient.get('name', ''), 'created_at': patient.get('created_at')}
+        targets = [clinic]
+        if patient.get('created_by'):
+            targets.append(assistants.setdefault(patient['created_by'], empty()))
+        for summary in targets:
+            summary['patient_count'] += 1
+            summary['active_prescriptions'] += patient.get('active_prescription_count', 0)
+            recent = sorted(summary['recent_patients'] + [entry], key=newest_first, reverse=True)
+            summary['recent_patients'] = recent[:RECENT_PATIENTS]
+
+    clinic['medicine_count'] = db.collection('medicines').count().get()[0][0].value
+
+    batch = db.batch()
+    batch.set(summary_ref(db), clinic, merge=True)
+    pending = 1
+    for assistant_id, summary in assistants.items():
+        batch.set(assistant_summary_ref(db, assistant_id), summary, merge=True)
+        pending += 1
+        # Firestore caps a write batch at 500 operations
+        if pending == 500:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+    if pending:
+        batch.commit()
+    return 1 + len(assistants)
@@ -0,0 +1,140 @@
+"""
+Template rendering caches.
+
+- Compiled templates are kept in a Jinja bytecode cache on disk, so a fresh
+  worker loads them instead of re-parsing and compiling every template, and
+  all templates are compiled up front (before gunicorn forks when the app
+  is preloaded).
+- `{% cache key, ... %}...{% endcache %}` stores the rendered output of a
+  block in an in-process LRU. Keys carry the Firestore `update_time` of the
+  documents the block shows, so a write produces a new key and stale
+  entries simply age out; nothing has to be invalidated.
+- version_tag() hashes the same update times into a short string used for
+  ETags, letting repeat views answer 304 without rendering at all.
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from jinja2 import FileSystemBytecodeCache, Undefined, nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+
+class FragmentCache:
+    """Thread-safe LRU of rendered template fragments"""
+
+    def __init__(self, max_size=2048):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class FragmentCacheExtension(Extension):
+    """`{% cache key, ... %}body{% endcache %}` backed by environment.fragment_cache"""
+
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(fragment_cache=None)
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        key_parts = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            key_parts.append(parser.parse_expression())
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        # The template name keeps keys from different templates apart
+        key = nodes.List([nodes.Const(parser.name)] + key_parts)
+        return nodes.CallBlock(self.call_method('_render_cached', [key]), [], [], body).set_lineno(lineno)
+
+    def _render_cached(self, key, caller):
+        cache = self.environment.fragment_cache
+        # A missing version would pin whatever rendered first; don't cache
+        if cache is None or any(isinstance(part, Undefined) for part in key):
+            return caller()
+        key = tuple(str(part) for part in key)
+        value = cache.get(key)
+        if value is None:
+            value = Markup(caller())
+            cache.put(key, value)
+        return value
+
+
+def version_tag(*parts):
+    """Short stable hash of the values a response depends on"""
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(repr(part).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()[:20]
+
+
+def templates_version(app):
+    """Hash of the template sources' names, sizes and mtimes.
+
+    Part of every ETag, so a deploy that changes a template does not answer
+    304 with a page rendered from the old one.
+    """
+    folder = os.path.join(app.root_path, app.template_folder)
+    entries = []
+    for root, _, files in os.walk(folder):
+        for name in sorted(files):
+            stat = os.stat(os.path.join(root, name))
+            entries.append((os.path.relpath(os.path.join(root, name), folder), stat.st_size, stat.st_mtime_ns))
+    return version_tag(*sorted(entries))
+
+
+def precompile_templates(app):
+    """Load every template into the environment's cache; returns how many compiled"""
+    env = app.jinja_env
+    compiled = 0
+    for name in env.list_templates(extensions=['html']):
+        try:
+            env.get_template(name)
+            compiled += 1
+        except Exception as e:
+            print(f"Template {name} failed to compile: {e}")
+    return compiled
+
+
+def init_app(app, bytecode_dir=None, max_fragments=2048):
+    """Install the bytecode cache and the {% cache %} tag, then compile all templates.
+
+    bytecode_dir defaults to a per-user directory under the system temp dir.
+    """
+    env = app.jinja_env
+    if bytecode_dir:
+        os.makedirs(bytecode_dir, exist_ok=True)
+    env.bytecode_cache = FileSystemBytecodeCache(bytecode_dir)
+    env.add_extension(FragmentCacheExtension)
+    env.fragment_cache = FragmentCache(max_fragments)
+    app.config['TEMPLATES_VERSION'] = templates_version(app)
+    precompile_templates(app)
+    return env.fragment_cache
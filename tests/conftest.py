@@ -0,0 +1,55 @@
+"""
+Shared fixtures: every test runs against the in-memory Firestore
+(fake_firestore.py), emptied before each test, and never reaches a device.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['FIRESTORE_FAKE'] = 'memory'
+
+import pytest
+
+import fake_firestore
+
+
+@pytest.fixture
+def db():
+    store = fake_firestore.get_store('memory')
+    with store.lock:
+        store.collections.clear()
+        store.indexes.clear()
+        store.transactions.clear()
+    return fake_firestore.client('memory')
+
+
+@pytest.fixture
+def flask_app(db):
+    """The app with its background services left stopped.
+
+    Dispense jobs are persisted and queued but no worker runs them.
+    """
+    import app as app_module
+    import idempotency
+
+    app_module._services_started = True
+    app_module.dispense_queue._db = db
+    app_module.dispense_queue.idempotency_keys = idempotency.IdempotencyKeys()
+    app_module.user_cache.invalidate()
+    app_module.app.config['TESTING'] = True
+    return app_module
+
+
+@pytest.fixture
+def login(flask_app, db):
+    """login(user_id, role) -> a test client signed in as that user"""
+    def sign_in(user_id, role):
+        db.collection('users').document(user_id).set({'name': user_id, 'role': role, 'email': f'{user_id}@example.com'})
+        client = flask_app.app.test_client()
+        with client.session_transaction() as session:
+            session['user_id'] = user_id
+            session['user_role'] = role
+            session['user_name'] = user_id
+        return client
+    return sign_in
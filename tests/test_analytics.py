@@ -0,0 +1,80 @@
+from datetime import datetime
+
+import pytest
+
+import analytics
+from prescriptions import add_prescription, mark_dispensed
+
+PRESCRIPTIONS = [
+    # medicine, doctor, prescribed at, (dispensed at, quantity, device) or None
+    ('m1', 'd1', datetime(2026, 3, 1, 9, 15), (datetime(2026, 3, 1, 9, 40), '2', 'dev-1')),
+    ('m1', 'd2', datetime(2026, 3, 1, 9, 50), (datetime(2026, 3, 2, 8, 5), '1', 'dev-2')),
+    ('m2', 'd1', datetime(2026, 3, 1, 23, 59), (datetime(2026, 3, 2, 0, 1), None, None)),
+    ('m2', 'd2', datetime(2026, 3, 2, 8, 30), None)
+]
+
+
+@pytest.fixture
+def history(db):
+    """Prescribe and dispense PRESCRIPTIONS through the normal write paths"""
+    db.collection('patients').document('p1').set({'name': 'Ann', 'created_by': 'a1', 'active_prescription_count': 0})
+    for medicine_id, doctor_id, prescribed_at, dispense in PRESCRIPTIONS:
+        prescription_id = add_prescription(db, 'p1', {
+            'medicine_id': medicine_id, 'prescribed_by': doctor_id, 'prescribed_at': prescribed_at,
+            'status': 'active'
+        }, 'a1')
+        if dispense:
+            dispensed_at, quantity, device_id = dispense
+            mark_dispensed(db, 'p1', prescription_id, {
+                'dispensed_at': dispensed_at, 'quantity_dispensed': quantity, 'device_id': device_id
+            })
+
+
+def rollups(db):
+    return {collection: {doc.id: doc.to_dict() for doc in db.collection(collection).stream()}
+            for collection in (analytics.HOURLY_COLLECTION, analytics.DAILY_COLLECTION)}
+
+
+def test_daily_report(db, history):
+    loaded = analytics.load_rollups(db, analytics.DAY, analytics.bucket_keys(
+        analytics.DAY, datetime(2026, 2, 28), datetime(2026, 3, 2)))
+
+    summary = analytics.report(loaded)
+    assert summary['totals'] == {'prescribed': 4, 'dispensed': 3, 'tablets': 4}
+    assert [(entry['bucket'], entry['prescribed'], entry['dispensed']) for entry in summary['series']] == [
+        ('2026-02-28', 0, 0), ('2026-03-01', 3, 1), ('2026-03-02', 1, 2)]
+
+    by_device = analytics.report(loaded, 'devices')['breakdown']
+    assert [(entry['id'], entry['tablets']) for entry in by_device] == [('dev-1', 2), ('dev-2', 1)]
+    assert analytics.report(loaded, 'doctors', 'd2')['totals'] == {'prescribed': 2, 'dispensed': 1, 'tablets': 1}
+
+
+def test_hourly_buckets(db, history):
+    hours = dict(analytics.load_rollups(db, analytics.HOUR, ['2026-03-01T09', '2026-03-02T00']))
+    assert hours['2026-03-01T09']['totals'] == {'prescribed': 2, 'dispensed': 1, 'tablets': 2}
+    assert hours['2026-03-02T00']['totals'] == {'dispensed': 1, 'tablets': 1}
+
+
+def test_rebuild_matches_incremental_rollups(db, history):
+    incremental = rollups(db)
+    # A bucket that no prescription accounts for any more
+    db.collection(analytics.DAILY_COLLECTION).document('2026-01-01').set({'totals': {'prescribed': 5}})
+    db.collection(analytics.DAILY_COLLECTION).document('2026-03-01').set({'totals': {'prescribed': 99}})
+
+    written = analytics.rebuild_rollups(db, chunk_size=2)
+
+    assert rollups(db) == incremental
+    assert written == sum(len(documents) for documents in incremental.values())
+
+
+def test_dispense_time_read_back_from_firestore(db):
+    db.collection('times').document('t').set({'at': datetime(2026, 3, 1, 9, 40)})
+    dispensed_at = db.collection('times').document('t').get().get('at')
+
+    batch = db.batch()
+    analytics.record_dispensed(batch, db, {'medicine_id': 'm1'}, dispensed_at, '2')
+    batch.commit()
+
+    hour = db.collection(analytics.HOURLY_COLLECTION).document('2026-03-01T09').get().to_dict()
+    assert hour['totals'] == {'dispensed': 1, 'tablets': 2}
+    assert hour['start'].replace(tzinfo=None) == datetime(2026, 3, 1, 9)
@@ -0,0 +1,113 @@
+import io
+import json
+
+import pytest
+
+import bulk_io
+import stats
+
+
+class Interrupted(Exception):
+    pass
+
+
+def patient_rows(count, bad_rows=()):
+    rows = [{'name': f'Patient {number}', 'age': '40', 'height': '170', 'weight': '70', 'bp': '120/80',
+             'temp': '37'} for number in range(1, count + 1)]
+    for number in bad_rows:
+        rows[number - 1]['age'] = 'forty'
+    return rows
+
+
+def patient_count(db, assistant_id=None):
+    return (stats.get_summary(db, assistant_id) or {}).get('patient_count', 0)
+
+
+def interrupt_after(importer, chunks):
+    """Make importer fail once it has committed this many chunks"""
+    write_chunk = importer._write_chunk
+    written = []
+
+    def write(chunk):
+        write_chunk(chunk)
+        written.append(chunk)
+        if len(written) == chunks:
+            raise Interrupted()
+
+    importer._write_chunk = write
+
+
+def test_import_writes_rows_and_counts(db):
+    rows = patient_rows(1200, bad_rows=[7, 800])
+
+    state = bulk_io.Importer(db, 'patients', 'import-1', 'a1', workers=3).run(iter(rows))
+
+    assert state['status'] == 'completed'
+    assert state['imported'] == 1198 and state['error_count'] == 2
+    assert [error['row'] for error in state['errors']] == [7, 800]
+    assert len(list(db.collection('patients').stream())) == 1198
+    assert patient_count(db) == 1198 and patient_count(db, 'a1') == 1198
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_resumed_import_does_not_duplicate_documents_or_counts(db, workers):
+    rows = patient_rows(2000, bad_rows=[3])
+    importer = bulk_io.Importer(db, 'patients', 'import-1', 'a1', workers=workers)
+    interrupt_after(importer, 2)
+    with pytest.raises(Interrupted):
+        importer.run(iter(rows))
+    checkpoint = bulk_io.get_import(db, 'import-1')
+    assert checkpoint['status'] == 'running' and checkpoint['committed_rows'] < 2000
+
+    state = bulk_io.Importer(db, 'patients', 'import-1', 'a1', workers=workers).run(iter(rows))
+
+    assert state['status'] == 'completed'
+    assert state['imported'] == 1999 and state['error_count'] == 1
+    assert len(list(db.collection('patients').stream())) == 1999
+    assert patient_count(db) == 1999 and patient_count(db, 'a1') == 1999
+
+
+def test_rerunning_a_completed_import_changes_nothing(db):
+    rows = patient_rows(600)
+    bulk_io.Importer(db, 'patients', 'import-1', 'a1').run(iter(rows))
+
+    state = bulk_io.Importer(db, 'patients', 'import-1', 'a1').run(iter(rows))
+
+    assert state['imported'] == 600
+    assert len(list(db.collection('patients').stream())) == 600
+    assert patient_count(db) == 600
+
+
+def test_medicine_import_counts(db):
+    rows = [{'name': f'Medicine {number}', 'description': '', 'dosage': '1', 'frequency': 'Once daily'}
+            for number in range(1, 11)]
+    importer = bulk_io.Importer(db, 'medicines', 'import-2', 'd1')
+    interrupt_after(importer, 1)
+    with pytest.raises(Interrupted):
+        importer.run(iter(rows))
+
+    bulk_io.Importer(db, 'medicines', 'import-2', 'd1').run(iter(rows))
+
+    assert len(list(db.collection('medicines').stream())) == 10
+    assert stats.get_summary(db)['medicine_count'] == 10
+
+
+def test_import_kind_cannot_change(db):
+    bulk_io.Importer(db, 'patients', 'import-1', 'a1').run(iter(patient_rows(1)))
+    with pytest.raises(ValueError):
+        bulk_io.Importer(db, 'medicines', 'import-1', 'a1').run(iter([]))
+
+
+def test_malformed_jsonl_line_is_a_row_error(db):
+    lines = [json.dumps(row) for row in patient_rows(4)]
+    lines[1] = '{"name": "Patient 2", "age": '
+    lines.insert(3, '')
+    source = io.StringIO('\n'.join(lines) + '\n')
+
+    state = bulk_io.Importer(db, 'patients', 'import-1', 'a1').run(bulk_io.read_rows(source, 'jsonl'))
+
+    assert state['status'] == 'completed'
+    assert state['imported'] == 3 and state['error_count'] == 1
+    assert state['errors'][0]['row'] == 2 and 'JSONDecodeError' in state['errors'][0]['error']
+    assert sorted(doc.get('name') for doc in db.collection('patients').stream()) == [
+        'Patient 1', 'Patient 3', 'Patient 4']
@@ -0,0 +1,222 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import dispense_queue
+from dispense_queue import COMPLETED, DISPENSING, FAILED, JOBS_COLLECTION, RECORDING, DispenseError, DispenseQueue
+from prescriptions import add_prescription, mark_dispensed, prescriptions_ref
+
+
+@pytest.fixture
+def prescription(db):
+    """(patient_id, prescription_id) of an active prescription"""
+    db.collection('patients').document('p1').set({'name': 'Ann', 'created_by': 'a1', 'active_prescription_count': 0})
+    prescription_id = add_prescription(db, 'p1', {
+        'medicine_id': 'm1', 'medicine_name': 'Paracetamol', 'dosage': '500mg', 'frequency': 'Twice daily',
+        'status': 'active', 'prescribed_at': datetime.now()
+    }, 'a1')
+    return 'p1', prescription_id
+
+
+def run_jobs(db, dispatch, *submissions, lease_seconds=300):
+    queue = DispenseQueue(dispatch, lease_seconds=lease_seconds)
+    queue.start(db)
+    job_ids = [queue.submit(*submission) for submission in submissions]
+    queue._queue.join()
+    queue.stop(5)
+    return [queue.get(job_id) for job_id in job_ids]
+
+
+def lock_of(db, patient_id, prescription_id):
+    return prescriptions_ref(db, patient_id).document(prescription_id).get().to_dict().get('dispense_job_id')
+
+
+def test_completed_job_dispenses_and_unlocks(db, prescription):
+    patient_id, prescription_id = prescription
+    sent = []
+
+    def dispatch(payload):
+        sent.append(payload)
+        return 'device-1'
+
+    job, = run_jobs(db, dispatch, (patient_id, prescription_id, {'quantity': '2'}, 'u1'))
+
+    assert job['status'] == COMPLETED and job['device_id'] == 'device-1'
+    assert sent[0]['idempotency_key'] == job['id']
+    doc = prescriptions_ref(db, patient_id).document(prescription_id).get().to_dict()
+    assert doc['status'] == 'dispensed' and 'dispense_job_id' not in doc
+
+
+@pytest.mark.parametrize('error', [DispenseError('Device busy'), RuntimeError('Firestore fell over')])
+def test_failed_job_unlocks_prescription(db, prescription, error):
+    patient_id, prescription_id = prescription
+
+    def dispatch(payload):
+        raise error
+
+    job, = run_jobs(db, dispatch, (patient_id, prescription_id, {}, 'u1'))
+
+    assert job['status'] == FAILED and str(error) in job['error']
+    assert lock_of(db, patient_id, prescription_id) is None
+    # The prescription can be dispensed again
+    job, = run_jobs(db, lambda payload: 'device-1', (patient_id, prescription_id, {}, 'u1'))
+    assert job['status'] == COMPLETED
+
+
+def failing_mark_dispensed(monkeypatch, failures):
+    """Make marking prescriptions dispensed raise the first `failures` times"""
+    calls = []
+
+    def mark(*args):
+        calls.append(args)
+        if len(calls) <= failures:
+            raise RuntimeError('Firestore fell over')
+        return mark_dispensed(*args)
+
+    monkeypatch.setattr(dispense_queue, 'RECORD_RETRY_SECONDS', 0)
+    monkeypatch.setattr(dispense_queue, 'mark_dispensed', mark)
+    return calls
+
+
+def test_error_recording_a_dispense_is_retried(db, prescription, monkeypatch):
+    patient_id, prescription_id = prescription
+    failing_mark_dispensed(monkeypatch, failures=dispense_queue.RECORD_ATTEMPTS - 1)
+
+    job, = run_jobs(db, lambda payload: 'device-1', (patient_id, prescription_id, {}, 'u1'))
+
+    assert job['status'] == COMPLETED and job['device_id'] == 'device-1'
+    assert prescriptions_ref(db, patient_id).document(prescription_id).get().get('status') == 'dispensed'
+
+
+def test_error_after_dispensing_keeps_the_prescription_locked(db, prescription, monkeypatch):
+    patient_id, prescription_id = prescription
+    sent = []
+
+    def dispatch(payload):
+        sent.append(payload)
+        return 'device-1'
+
+    failing_mark_dispensed(monkeypatch, failures=100)
+    job, = run_jobs(db, dispatch, (patient_id, prescription_id, {}, 'u1'))
+
+    assert job['status'] == RECORDING and job['error'] is None
+    assert lock_of(db, patient_id, prescription_id) == job['id']
+    # Dispensing it again is refused rather than sent to the device
+    second, = run_jobs(db, dispatch, (patient_id, prescription_id, {}, 'u1'))
+    assert second['status'] == FAILED and len(sent) == 1
+
+    # Once Firestore is back, the next start() records it
+    monkeypatch.setattr(dispense_queue, 'mark_dispensed', mark_dispensed)
+    run_jobs(db, dispatch)
+
+    assert db.collection(JOBS_COLLECTION).document(job['id']).get().get('status') == COMPLETED
+    doc = prescriptions_ref(db, patient_id).document(prescription_id).get().to_dict()
+    assert doc['status'] == 'dispensed' and 'dispense_job_id' not in doc
+    assert len(sent) == 1
+
+
+def test_second_job_for_locked_prescription_fails(db, prescription):
+    patient_id, prescription_id = prescription
+    jobs = db.collection(JOBS_COLLECTION)
+    jobs.document('running').set({
+        'patient_id': patient_id, 'prescription_id': prescription_id, 'payload': {}, 'status': DISPENSING,
+        'lease_expires_at': datetime.now(timezone.utc) + timedelta(minutes=5)
+    })
+    prescriptions_ref(db, patient_id).document(prescription_id).update({'dispense_job_id': 'running'})
+
+    job, = run_jobs(db, lambda payload: 'device-1', (patient_id, prescription_id, {}, 'u1'))
+
+    assert job['status'] == FAILED
+    assert lock_of(db, patient_id, prescription_id) == 'running'
+
+
+def test_lock_of_abandoned_job_is_taken_over(db, prescription):
+    patient_id, prescription_id = prescription
+    jobs = db.collection(JOBS_COLLECTION)
+    jobs.document('abandoned').set({
+        'patient_id': patient_id, 'prescription_id': prescription_id, 'payload': {}, 'status': DISPENSING,
+        'lease_expires_at': datetime.now(timezone.utc) + timedelta(minutes=5)
+    })
+    prescriptions_ref(db, patient_id).document(prescription_id).update({'dispense_job_id': 'abandoned'})
+    queue = DispenseQueue(lambda payload: 'device-1')
+    queue.start(db)
+    # Still leased: start() leaves it alone
+    assert queue.get('abandoned')['status'] == DISPENSING
+    queue.stop(5)
+
+    jobs.document('abandoned').update({'lease_expires_at': datetime.now(timezone.utc) - timedelta(seconds=1)})
+    job, = run_jobs(db, lambda payload: 'device-1', (patient_id, prescription_id, {}, 'u1'))
+
+    assert job['status'] == COMPLETED
+    assert jobs.document('abandoned').get().get('status') == FAILED
+
+
+def test_start_fails_expired_jobs(db, prescription):
+    patient_id, prescription_id = prescription
+    jobs = db.collection(JOBS_COLLECTION)
+    jobs.document('abandoned').set({
+        'patient_id': patient_id, 'prescription_id': prescription_id, 'payload': {}, 'status': DISPENSING,
+        'lease_expires_at': datetime.now(timezone.utc) - timedelta(seconds=1)
+    })
+    prescriptions_ref(db, patient_id).document(prescription_id).update({'dispense_job_id': 'abandoned'})
+
+    queue = DispenseQueue(lambda payload: 'device-1')
+    queue.start(db)
+    queue.stop(5)
+
+    assert jobs.document('abandoned').get().get('status') == FAILED
+    assert lock_of(db, patient_id, prescription_id) is None
+
+
+def test_idempotent_dispense_replays_the_first_job(login, db, prescription):
+    patient_id, prescription_id = prescription
+    client = login('d1', 'doctor')
+    headers = {'Accept': 'application/json', 'Idempotency-Key': 'key-0123456789abcdef'}
+    form = {'patient_id': patient_id, 'prescription_id': prescription_id}
+
+    first = client.post('/dispense_medicine', data=form, headers=headers)
+    repeat = client.post('/dispense_medicine', data=form, headers=headers)
+
+    assert first.status_code == 202 and 'Idempotent-Replayed' not in first.headers
+    assert repeat.status_code == 202 and repeat.headers['Idempotent-Replayed'] == 'true'
+    assert repeat.json['job_id'] == first.json['job_id']
+    assert len(list(db.collection(JOBS_COLLECTION).stream())) == 1
+
+
+def test_idempotent_replay_survives_a_cold_cache(flask_app, login, db, prescription):
+    patient_id, prescription_id = prescription
+    client = login('d1', 'doctor')
+    headers = {'Accept': 'application/json', 'Idempotency-Key': 'key-0123456789abcdef'}
+    form = {'patient_id': patient_id, 'prescription_id': prescription_id}
+
+    first = client.post('/dispense_medicine', data=form, headers=headers)
+    # Another worker process: the key is only in Firestore
+    flask_app.dispense_queue.idempotency_keys._cache.clear()
+    repeat = client.post('/dispense_medicine', data=form, headers=headers)
+
+    assert repeat.status_code == 202 and repeat.json['job_id'] == first.json['job_id']
+
+
+def test_idempotency_key_reused_for_another_prescription(login, db, prescription):
+    patient_id, prescription_id = prescription
+    other_id = add_prescription(db, patient_id, {
+        'medicine_id': 'm1', 'medicine_name': 'Paracetamol', 'dosage': '500mg', 'frequency': 'Twice daily',
+        'status': 'active', 'prescribed_at': datetime.now()
+    }, 'a1')
+    client = login('d1', 'doctor')
+    headers = {'Accept': 'application/json', 'Idempotency-Key': 'key-0123456789abcdef'}
+
+    client.post('/dispense_medicine', data={'patient_id': patient_id, 'prescription_id': prescription_id},
+                headers=headers)
+    reused = client.post('/dispense_medicine', data={'patient_id': patient_id, 'prescription_id': other_id},
+                         headers=headers)
+
+    assert reused.status_code == 422
+
+
+def test_malformed_idempotency_key(login, prescription):
+    patient_id, prescription_id = prescription
+    client = login('d1', 'doctor')
+    response = client.post('/dispense_medicine', data={'patient_id': patient_id, 'prescription_id': prescription_id},
+                           headers={'Accept': 'application/json', 'Idempotency-Key': 'short'})
+    assert response.status_code == 400
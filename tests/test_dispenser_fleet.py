@@ -0,0 +1,126 @@
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from dispenser_fleet import LEASES_COLLECTION, DispenserFleet, NoDispenserAvailable
+from nodemcu_client import CircuitBreaker, DeviceUnavailable
+
+
+class StubClient:
+    """Stands in for NodeMCUClient; dispense blocks while gate is set and not yet opened"""
+
+    def __init__(self, device_id):
+        self.base_url = f'http://{device_id}'
+        self.breaker = CircuitBreaker()
+        self.error = None
+        self.gate = None
+        self.dispensed = []
+        self.displayed = []
+
+    def dispense(self, payload):
+        if self.error:
+            raise self.error
+        if self.gate:
+            self.gate.wait(5)
+        self.dispensed.append(payload)
+        return {'status': 'completed'}
+
+    def send_prescriptions(self, payload):
+        if self.error:
+            raise self.error
+        self.displayed.append(payload)
+        return payload
+
+    def close(self):
+        pass
+
+
+def make_fleet(db, *device_ids, capacity=1, wait_timeout=0.2):
+    """A fleet over stub devices, as one worker process would build it"""
+    fleet = DispenserFleet('unused', wait_timeout=wait_timeout)
+    fleet._db = db
+    for device_id in device_ids:
+        fleet.add(device_id, device_id, capacity=capacity)
+        fleet.devices[device_id].client = StubClient(device_id)
+    return fleet
+
+
+def holders(db, device_id):
+    doc = db.collection(LEASES_COLLECTION).document(device_id).get()
+    return (doc.to_dict() or {}).get('holders') or {}
+
+
+def test_dispense_takes_and_releases_a_lease(db):
+    fleet = make_fleet(db, 'd1')
+
+    assert fleet.dispense({'medicine_id': 'm1', 'quantity': 1, 'idempotency_key': 'job-1'})[0] == 'd1'
+
+    assert holders(db, 'd1') == {}
+    assert fleet.devices['d1'].in_flight == 0
+
+
+def test_capacity_is_shared_between_processes(db):
+    first, second = make_fleet(db, 'd1'), make_fleet(db, 'd1')
+    gate = threading.Event()
+    first.devices['d1'].client.gate = gate
+    running = threading.Thread(target=first.dispense, args=({'medicine_id': 'm1', 'idempotency_key': 'job-1'},))
+    running.start()
+    try:
+        while not holders(db, 'd1'):
+            time.sleep(0.01)
+        with pytest.raises(NoDispenserAvailable):
+            second.dispense({'medicine_id': 'm1', 'idempotency_key': 'job-2'})
+    finally:
+        gate.set()
+        running.join()
+
+    assert second.dispense({'medicine_id': 'm1', 'idempotency_key': 'job-2'})[0] == 'd1'
+    assert second.devices['d1'].client.dispensed[0]['idempotency_key'] == 'job-2'
+
+
+def test_expired_lease_is_ignored(db):
+    db.collection(LEASES_COLLECTION).document('d1').set({
+        'holders': {'crashed': datetime.now(timezone.utc) - timedelta(seconds=1)}
+    })
+    fleet = make_fleet(db, 'd1')
+
+    assert fleet.dispense({'medicine_id': 'm1', 'idempotency_key': 'job-1'})[0] == 'd1'
+    assert holders(db, 'd1') == {}
+
+
+def test_unreachable_device_is_skipped_until_healthy(db):
+    fleet = make_fleet(db, 'd1', 'd2')
+    fleet.devices['d1'].client.error = DeviceUnavailable('unreachable')
+    # Looks busier, so d1 is tried first
+    fleet.devices['d2'].leased = 1
+
+    with pytest.raises(DeviceUnavailable):
+        fleet.dispense({'medicine_id': 'm1', 'idempotency_key': 'job-1'})
+    assert not fleet.devices['d1'].healthy and holders(db, 'd1') == {}
+
+    assert fleet.dispense({'medicine_id': 'm1', 'idempotency_key': 'job-2'})[0] == 'd2'
+
+
+def test_sending_prescriptions_takes_no_lease(db):
+    db.collection(LEASES_COLLECTION).document('d1').set({
+        'holders': {'job-1': datetime.now(timezone.utc) + timedelta(minutes=1)}
+    })
+    fleet = make_fleet(db, 'd1')
+
+    assert fleet.send_prescriptions({'patient_name': 'Ann'}) == {'patient_name': 'Ann'}
+    assert list(holders(db, 'd1')) == ['job-1']
+
+
+def test_sending_prescriptions_fails_over(db):
+    fleet = make_fleet(db, 'd1', 'd2')
+    fleet.devices['d1'].last_checked = datetime.now()
+    fleet.devices['d1'].client.error = DeviceUnavailable('unreachable')
+
+    fleet.send_prescriptions({'patient_name': 'Ann'})
+
+    assert fleet.devices['d2'].client.displayed and not fleet.devices['d1'].healthy
+    fleet.devices['d2'].healthy = False
+    with pytest.raises(NoDispenserAvailable):
+        fleet.send_prescriptions({'patient_name': 'Ann'})
@@ -0,0 +1,100 @@
+from datetime import datetime
+
+import pytest
+
+import inventory
+from prescriptions import add_prescription, mark_dispensed
+
+
+@pytest.fixture
+def patient(db):
+    db.collection('patients').document('p1').set({'name': 'Ann', 'created_by': 'a1', 'active_prescription_count': 0})
+    db.collection('medicines').document('m1').set({'name': 'Paracetamol'})
+    return 'p1'
+
+
+def dispense(db, patient_id, medicine_id, quantity):
+    prescription_id = add_prescription(db, patient_id, {'medicine_id': medicine_id, 'status': 'active',
+                                                        'prescribed_at': datetime.now()}, 'a1')
+    assert mark_dispensed(db, patient_id, prescription_id, {'quantity_dispensed': quantity})
+
+
+def shard_counts(db, medicine_id):
+    return {doc.id: doc.get('count') for doc in inventory.shards_ref(db, medicine_id).stream()}
+
+
+def test_dispenses_are_spread_over_the_shards(db, patient):
+    inventory.restock(db, 'm1', count=100, reorder_level=80, shards=4)
+
+    for _ in range(12):
+        dispense(db, patient, 'm1', '2')
+
+    counts = shard_counts(db, 'm1')
+    assert len(counts) > 1 and sum(counts.values()) == 76
+    assert inventory.count_stock(db, 'm1') == 76
+    # The total on the inventory document waits for the next sync
+    assert inventory.get_stock(db, 'm1')['stock'] == 100
+    assert inventory.sync_stock(db, 'm1') == 76
+    stock = inventory.get_stock(db, 'm1')
+    assert stock['stock'] == 76 and stock['low_stock']
+
+
+def test_untracked_medicine_is_left_alone(db, patient):
+    dispense(db, patient, 'm1', '2')
+
+    assert shard_counts(db, 'm1') == {}
+    assert inventory.get_stock(db, 'm1') is None and inventory.sync_stock(db, 'm1') is None
+
+
+def test_count_replaces_the_shards_and_add_increments(db, patient):
+    inventory.restock(db, 'm1', count=100, shards=8)
+    for _ in range(5):
+        dispense(db, patient, 'm1', '1')
+
+    assert inventory.restock(db, 'm1', count=40) == 40
+    assert shard_counts(db, 'm1') == {'0': 40}
+    assert inventory.restock(db, 'm1', add=25) == 65
+    assert inventory.get_stock(db, 'm1')['shards'] == 8
+
+
+def test_reorder_list(db):
+    inventory.restock(db, 'm1', count=5, reorder_level=10)
+    inventory.restock(db, 'm2', count=50, reorder_level=10)
+    inventory.restock(db, 'm3', count=2, reorder_level=10)
+
+    assert [item['medicine_id'] for item in inventory.low_stock(db)] == ['m3', 'm1']
+
+
+def test_stock_sync_flushes_dispensed_medicines(db, patient):
+    inventory.restock(db, 'm1', count=10, shards=2)
+    dispense(db, patient, 'm1', '3')
+    sync = inventory.StockSync()
+    sync.start(db)
+    sync.mark_dirty('m1')
+    sync.mark_dirty('untracked')
+    sync.stop()
+
+    assert inventory.get_stock(db, 'm1')['stock'] == 7
+
+
+def test_only_doctors_update_stock(login, db, patient):
+    response = login('a1', 'assistant').post('/api/inventory/m1', json={'count': 10})
+    assert response.status_code == 302 and inventory.get_stock(db, 'm1') is None
+
+    response = login('d1', 'doctor').post('/api/inventory/m1', json={'count': 10, 'reorder_level': 20})
+    assert response.status_code == 200 and response.json['stock'] == 10 and response.json['low_stock']
+
+
+def test_only_doctors_refill_slots(login, flask_app, db, monkeypatch):
+    fleet = flask_app.dispenser_fleet
+    monkeypatch.setattr(fleet, 'devices', {})
+    monkeypatch.setattr(fleet, '_db', db)
+    fleet.add('d1', '127.0.0.1')
+    db.collection('dispensers').document('d1').set({'host': '127.0.0.1'})
+
+    assert login('a1', 'assistant').post('/api/dispensers/d1/slots/m1', json={'count': 30}).status_code == 302
+    assert fleet.devices['d1'].slot_stock == {}
+
+    assert login('d1', 'doctor').post('/api/dispensers/d1/slots/m1', json={'count': 30}).status_code == 200
+    assert fleet.devices['d1'].slot_stock == {'m1': 30}
+    assert db.collection('dispensers').document('d1').get().get('slot_stock') == {'m1': 30}
@@ -0,0 +1,88 @@
+import pytest
+
+from medicine_catalog import MedicineCatalog
+
+MEDICINES = [
+    ('Paracetamol', 'Pain and fever relief'),
+    ('Paracetamol Extra', 'With caffeine'),
+    ('Amoxicillin', 'Antibiotic'),
+    ('Ibuprofen', 'Anti-inflammatory pain relief'),
+    ('Metformin', 'Type 2 diabetes'),
+    ('Cetirizine', 'Antihistamine for allergies')
+]
+
+
+@pytest.fixture
+def catalog(db):
+    for number, (name, description) in enumerate(MEDICINES):
+        db.collection('medicines').document(f'm{number}').set({
+            'name': name, 'description': description, 'dosage': '1 tablet', 'frequency': 'Once daily'
+        })
+    catalog = MedicineCatalog(ttl=300)
+    catalog.start(db)
+    yield catalog
+    catalog.stop()
+
+
+def matches(catalog, query, limit=10):
+    return [(medicine['name'], medicine['match']) for medicine in catalog.search(query, limit)]
+
+
+def test_exact_match_comes_first(catalog):
+    assert matches(catalog, 'paracetamol') == [('Paracetamol', 'exact'), ('Paracetamol Extra', 'prefix')]
+
+
+def test_prefix_then_substring(catalog):
+    assert matches(catalog, 'cet') == [('Cetirizine', 'prefix'), ('Paracetamol', 'substring'),
+                                       ('Paracetamol Extra', 'substring')]
+
+
+@pytest.mark.parametrize('query, expected', [
+    # A substitution, a deletion, an insertion, and a swapped pair (two edits)
+    ('paracetomol', 'Paracetamol'),
+    ('amoxicilin', 'Amoxicillin'),
+    ('ibuprofenn', 'Ibuprofen'),
+    ('metfromin', 'Metformin'),
+    # Case and spacing are ignored
+    ('  IBUPROFN ', 'Ibuprofen')
+])
+def test_fuzzy_match_finds_misspellings(catalog, query, expected):
+    results = catalog.search(query)
+    assert results and results[0]['name'] == expected and results[0]['match'] == 'fuzzy'
+
+
+def test_fuzzy_match_is_bounded(catalog):
+    # Three edits from Metformin; short queries are never matched fuzzily
+    assert matches(catalog, 'mxtaformen') == []
+    assert matches(catalog, 'ibu') == [('Ibuprofen', 'prefix')]
+    assert matches(catalog, 'ibx') == []
+
+
+def test_fewest_typos_first(catalog):
+    names = [name for name, match in matches(catalog, 'paracetamolx') if match == 'fuzzy']
+    assert names[0] == 'Paracetamol'
+
+
+def test_description_words(catalog):
+    assert matches(catalog, 'antibiotic') == [('Amoxicillin', 'description')]
+    assert {name for name, _ in matches(catalog, 'pain')} == {'Paracetamol', 'Ibuprofen'}
+
+
+def test_limit(catalog):
+    assert len(catalog.search('a', limit=2)) == 2
+
+
+def test_reload_sees_new_medicines(catalog, db):
+    db.collection('medicines').document('new').set({'name': 'Loratadine', 'description': ''})
+    assert matches(catalog, 'loratadine') == []
+    catalog.reload()
+    assert matches(catalog, 'loratadin') == [('Loratadine', 'prefix')]
+
+
+def test_missing_fields_do_not_break_the_index(catalog, db):
+    db.collection('medicines').document('imported').set({'name': 'Loratadine', 'description': None,
+                                                          'dosage': None})
+    db.collection('medicines').document('legacy').set({'name': None})
+    catalog.reload()
+    assert catalog.search('loratadine')[0]['description'] == ''
+    assert matches(catalog, 'paracetamol')[0] == ('Paracetamol', 'exact')
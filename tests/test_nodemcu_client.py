@@ -0,0 +1,129 @@
+import threading
+import time
+
+import pytest
+import requests
+
+import fake_nodemcu
+from nodemcu_client import CircuitBreaker, DeviceBusy, DeviceUnavailable, NodeMCUClient
+
+
+@pytest.fixture
+def device():
+    """A fake dispenser on a free local port whose tablets take a minute each"""
+    server = fake_nodemcu.serve(port=0, tablet_delay=60)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def client_for(server, **kwargs):
+    host, port = server.server_address
+    return NodeMCUClient(host, port, backoff=0, **kwargs)
+
+
+def test_full_queue_is_busy_not_a_failure(device):
+    # One job dispensing and the queue behind it full
+    device.device.enqueue(1, 'Paracetamol')
+    while not device.device.dispensing:
+        time.sleep(0.01)
+    for _ in range(fake_nodemcu.JOB_QUEUE_SIZE):
+        assert device.device.enqueue(1, 'Paracetamol') is not None
+    client = client_for(device, breaker=CircuitBreaker(failure_threshold=1))
+    client.idempotent_dispense = True
+
+    for _ in range(3):
+        with pytest.raises(DeviceBusy):
+            client.dispense({'quantity': 1, 'idempotency_key': 'job-1'})
+
+    assert client.breaker.state == CircuitBreaker.CLOSED
+    assert client.status()['queued'] == fake_nodemcu.JOB_QUEUE_SIZE
+
+
+class ScriptedSession:
+    """Stands in for requests.Session: answers each request with the next status code or exception"""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = []
+
+    def request(self, method, url, **kwargs):
+        self.calls.append((method, url))
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        response = requests.Response()
+        response.status_code = outcome
+        response._content = b'{"status": "online"}'
+        response.request = requests.Request(method, url).prepare()
+        return response
+
+    def close(self):
+        pass
+
+
+def scripted_client(*outcomes, **kwargs):
+    client = NodeMCUClient('device', backoff=0, **kwargs)
+    client.session = ScriptedSession(*outcomes)
+    return client
+
+
+def test_safe_calls_are_retried():
+    client = scripted_client(requests.ConnectionError('refused'), 500, 200, retries=2)
+
+    assert client.status() == {'status': 'online'}
+    assert len(client.session.calls) == 3 and client.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_client_errors_are_not_retried():
+    client = scripted_client(404, retries=2)
+
+    assert client._request('GET', '/missing', idempotent=True).status_code == 404
+    assert len(client.session.calls) == 1
+
+
+@pytest.mark.parametrize('key, device_deduplicates, attempts', [
+    (None, True, 1),
+    ('job-1', False, 1),
+    ('job-1', True, 3)
+])
+def test_dispense_is_retried_only_when_the_device_deduplicates(key, device_deduplicates, attempts):
+    client = scripted_client(*[requests.Timeout('no reply')] * 3, retries=2)
+    client.idempotent_dispense = device_deduplicates
+
+    with pytest.raises(DeviceUnavailable):
+        client.dispense({'quantity': 1, 'idempotency_key': key})
+    assert len(client.session.calls) == attempts
+
+
+def test_breaker_opens_then_lets_one_trial_through():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    client = scripted_client(*[requests.ConnectionError('refused')] * 3 + [200], retries=0, breaker=breaker)
+
+    for _ in range(2):
+        with pytest.raises(DeviceUnavailable):
+            client.status()
+    assert breaker.state == CircuitBreaker.OPEN
+    # Open: fails fast without calling the device
+    with pytest.raises(DeviceUnavailable, match='not retrying'):
+        client.status()
+    assert len(client.session.calls) == 2
+
+    time.sleep(0.06)
+    # A failed trial opens it again straight away
+    with pytest.raises(DeviceUnavailable):
+        client.status()
+    assert breaker.state == CircuitBreaker.OPEN and len(client.session.calls) == 3
+
+    time.sleep(0.06)
+    assert client.status() == {'status': 'online'}
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_half_open_breaker_allows_a_single_trial():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+    breaker.record_failure()
+
+    assert breaker.allow() and breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()
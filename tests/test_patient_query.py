@@ -0,0 +1,108 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import bulk_io
+import stats
+from prescriptions import add_prescription
+
+PATIENTS = [
+    # name, age, registered by
+    ('Ann Lee', 30, 'a1'),
+    ('anna Bell', 45, 'a1'),
+    ('Bob', 31, 'a2'),
+    ('Andy', 70, 'a2'),
+    ('Zed', 5, 'a1')
+]
+
+
+@pytest.fixture
+def patients(db):
+    """Name -> patient ID; registered a day apart from 2026-01-01, Bob with an active prescription"""
+    ids = {}
+    for day, (name, age, created_by) in enumerate(PATIENTS):
+        record = bulk_io.patient_record({'name': name, 'age': age, 'height': 170, 'weight': 70, 'bp': '120/80',
+                                         'temp': 37}, created_by, datetime(2026, 1, 1) + timedelta(days=day))
+        ids[name] = stats.add_patient(db, record)
+    add_prescription(db, ids['Bob'], {'medicine_id': 'm1', 'status': 'active', 'prescribed_at': datetime.now()}, 'a2')
+    return ids
+
+
+def names(client, query):
+    response = client.get('/api/patients?' + query)
+    assert response.status_code == 200, response.json
+    return [patient['name'] for patient in response.json['patients']]
+
+
+@pytest.mark.parametrize('query, expected', [
+    ('', ['Zed', 'Andy', 'Bob', 'anna Bell', 'Ann Lee']),
+    ('sort=name', ['Andy', 'Ann Lee', 'anna Bell', 'Bob', 'Zed']),
+    ('name=AN', ['Andy', 'Ann Lee', 'anna Bell']),
+    ('name=ann', ['Ann Lee', 'anna Bell']),
+    ('age_min=30&age_max=45', ['Ann Lee', 'Bob', 'anna Bell']),
+    ('age_min=30&age_max=45&sort=-age', ['anna Bell', 'Bob', 'Ann Lee']),
+    ('created_from=2026-01-02&created_to=2026-01-04', ['Andy', 'Bob', 'anna Bell']),
+    ('created_from=2026-01-02&created_to=2026-01-04&sort=created_at', ['anna Bell', 'Bob', 'Andy']),
+    ('created_by=a2&sort=age', ['Bob', 'Andy']),
+    ('active=true', ['Bob']),
+    ('active=false&sort=name', ['Andy', 'Ann Lee', 'anna Bell', 'Zed']),
+    ('active=false&age_min=40', ['anna Bell', 'Andy'])
+])
+def test_filters_and_sorts(login, patients, query, expected):
+    assert names(login('d1', 'doctor'), query) == expected
+
+
+@pytest.mark.parametrize('query', [
+    'name=a&age_min=3',
+    'name=a&sort=age',
+    'age_min=30&sort=name',
+    'sort=bogus',
+    'active=maybe',
+    'age_min=x',
+    'created_from=jan'
+])
+def test_rejected_queries(login, patients, query):
+    response = login('d1', 'doctor').get('/api/patients?' + query)
+    assert response.status_code == 400 and response.json['error']
+
+
+def test_cursor_pages_through_every_patient(login, patients):
+    client = login('d1', 'doctor')
+    seen = []
+    cursor = ''
+    while True:
+        response = client.get(f'/api/patients?sort=name&per_page=2&cursor={cursor}')
+        page = [patient['name'] for patient in response.json['patients']]
+        assert len(page) <= 2
+        seen.extend(page)
+        cursor = response.json['next_cursor']
+        if cursor is None:
+            break
+    assert seen == ['Andy', 'Ann Lee', 'anna Bell', 'Bob', 'Zed']
+
+
+def test_cursor_keeps_the_filter(login, patients):
+    client = login('d1', 'doctor')
+    first = client.get('/api/patients?name=an&per_page=2').json
+    second = client.get(f"/api/patients?name=an&per_page=2&cursor={first['next_cursor']}").json
+    assert [patient['name'] for patient in first['patients']] == ['Andy', 'Ann Lee']
+    assert [patient['name'] for patient in second['patients']] == ['anna Bell']
+    assert second['next_cursor'] is None
+
+
+def test_assistants_only_see_their_own_patients(login, patients):
+    client = login('a1', 'assistant')
+    assert names(client, 'sort=name') == ['Ann Lee', 'anna Bell', 'Zed']
+    assert names(client, 'created_by=a1&age_max=40') == ['Zed', 'Ann Lee']
+    assert client.get('/api/patients?created_by=a2').status_code == 403
+
+
+def test_html_format(login, patients):
+    response = login('d1', 'doctor').get('/api/patients?name=bo&format=html')
+    assert response.json['count'] == 1 and 'Bob' in response.json['html']
+
+
+def test_search_box_as_assistant(login, patients):
+    response = login('a1', 'assistant').get('/api/patients?name=an&format=html')
+    assert response.json['count'] == 2
+    assert 'Ann Lee' in response.json['html'] and 'Andy' not in response.json['html']
@@ -0,0 +1,76 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import bulk_io
+import stats
+from prescriptions import add_prescription, mark_dispensed
+
+
+def register(db, name, assistant_id, day):
+    record = bulk_io.patient_record({'name': name, 'age': 40, 'height': 170, 'weight': 70, 'bp': '120/80',
+                                     'temp': 37}, assistant_id, datetime(2026, 1, day))
+    return stats.add_patient(db, record)
+
+
+def prescribe(db, patient_id, assistant_id):
+    return add_prescription(db, patient_id, {'medicine_id': 'm1', 'prescribed_by': 'd1', 'status': 'active',
+                                             'prescribed_at': datetime.now()}, assistant_id)
+
+
+@pytest.fixture
+def clinic(db):
+    """Patient IDs: seven registered by a1 (one per day), one by a2"""
+    patients = {f'a1-{day}': register(db, f'Patient {day}', 'a1', day) for day in range(1, 8)}
+    patients['a2'] = register(db, 'Other', 'a2', 8)
+    return patients
+
+
+def test_patients_are_counted(db, clinic):
+    clinic_summary, a1, a2 = stats.get_summary(db), stats.get_summary(db, 'a1'), stats.get_summary(db, 'a2')
+
+    assert (clinic_summary['patient_count'], a1['patient_count'], a2['patient_count']) == (8, 7, 1)
+    assert [patient['name'] for patient in clinic_summary['recent_patients']] == [
+        'Other', 'Patient 7', 'Patient 6', 'Patient 5', 'Patient 4']
+    assert [patient['name'] for patient in a2['recent_patients']] == ['Other']
+
+
+def test_prescribing_and_dispensing(db, clinic):
+    first = prescribe(db, clinic['a1-1'], 'a1')
+    prescribe(db, clinic['a1-1'], 'a1')
+    other = prescribe(db, clinic['a2'], 'a2')
+    mark_dispensed(db, clinic['a1-1'], first, {'dispensed_at': datetime.now(), 'quantity_dispensed': '2'})
+    mark_dispensed(db, clinic['a2'], other, {'dispensed_at': datetime.now() - timedelta(days=1)})
+
+    clinic_summary, a1 = stats.get_summary(db), stats.get_summary(db, 'a1')
+    assert clinic_summary['active_prescriptions'] == 1 and clinic_summary['dispensed_total'] == 2
+    # Yesterday's dispense is not counted today
+    assert clinic_summary['dispensed_today'] == 1
+    assert (a1['active_prescriptions'], a1['dispensed_total'], a1['dispensed_today']) == (1, 1, 1)
+    assert stats.get_summary(db, 'a2')['dispensed_today'] == 0
+    # Nothing in the summary grows by the day
+    assert 'dispensed_per_day' not in stats.summary_ref(db).get().to_dict()
+
+
+def test_empty_summary(db):
+    assert stats.get_summary(db) == {'update_time': None, 'dispensed_today': 0}
+
+
+def test_rebuild_summaries_repairs_drift(db, clinic):
+    prescribe(db, clinic['a2'], 'a2')
+    db.collection('medicines').document('m1').set({'name': 'Paracetamol'})
+    expected = {assistant_id: stats.get_summary(db, assistant_id) for assistant_id in (None, 'a1', 'a2')}
+    stats.summary_ref(db).set({'patient_count': 99, 'active_prescriptions': -3, 'dispensed_total': 5,
+                               'dispensed_per_day': {'2025-01-01': 5}})
+    stats.assistant_summary_ref(db, 'a1').delete()
+
+    assert stats.rebuild_summaries(db) == 3
+
+    for assistant_id, summary in expected.items():
+        rebuilt = stats.get_summary(db, assistant_id)
+        for field in ('patient_count', 'active_prescriptions', 'recent_patients'):
+            # Counters never incremented are missing rather than 0
+            assert rebuilt[field] == summary.get(field, 0)
+    clinic_summary = stats.summary_ref(db).get().to_dict()
+    assert clinic_summary['medicine_count'] == 1 and clinic_summary['dispensed_total'] == 5
+    assert 'dispensed_per_day' not in clinic_summary
@@ -0,0 +1,56 @@
+"""
+In-process cache of user profiles from the `users` collection.
+
+Every authenticated request needs the user's name and role. They are served
+from a small LRU cache keyed by uid whose entries expire after a TTL, so a
+role change in Firestore reaches running sessions within TTL seconds without
+costing a Firestore read per request.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class UserProfileCache:
+    """Thread-safe TTL + LRU cache of user profile dicts keyed by uid"""
+
+    def __init__(self, ttl=300, max_size=1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._db = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def start(self, db):
+        self._db = db
+
+    def get(self, uid):
+        """Return the profile for uid, reading Firestore on a miss; None if there is none"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(uid)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(uid)
+                return entry[1]
+
+        doc = self._db.collection('users').document(uid).get()
+        profile = doc.to_dict() if doc.exists else None
+        # Missing users are cached too, so a deleted account is not re-read per request
+        self.put(uid, profile)
+        return profile
+
+    def put(self, uid, profile):
+        with self._lock:
+            self._entries[uid] = (time.monotonic() + self.ttl, profile)
+            self._entries.move_to_end(uid)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, uid=None):
+        """Drop one uid, or everything when uid is None"""
+        with self._lock:
+            if uid is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(uid, None)